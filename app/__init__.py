@@ -3,7 +3,17 @@ from flask_login import LoginManager
 from flask_wtf import CSRFProtect
 from flask_bcrypt import Bcrypt
 from app.models import *  # Import User model for authentication
-from app.database import db  # Import the database instance
+from app.database import db, init_database, load_config as load_database_config
+from app.writer import write_queue
+from app.caching import page_cache
+from app.images import image_pipeline
+from app.instrumentation import instrumentation
+from app import identity
+from app.passwords import password_hasher
+from app.trending import trending
+from app import storage
+from app.purge import purge_runner
+from app import assets
 import os
 
 # Initialize Extensions
@@ -16,11 +26,12 @@ bcrypt = Bcrypt()
 def load_user(user_id):
     """
     User loader callback for Flask-Login.
-    This function retrieves the User instance from the database by its ID.
+    This function retrieves the User instance by its ID, from the identity cache
+    when the session's auth version is current, otherwise from the database.
     :param user_id: User identifier from session.
     :return: User object or None if not found.
     """
-    return User.get_or_none(User.id == user_id)
+    return identity.load_user(user_id)
 
 
 def create_app():
@@ -31,6 +42,49 @@ def create_app():
     app.config["SECRET_KEY"] = os.getenv("SECRET_KEY", "your-secret-key")
     app.config["UPLOAD_FOLDER"] = os.path.join(os.getcwd(), "app", "static", "uploads")
     app.config["MAX_CONTENT_LENGTH"] = 2 * 1024 * 1024  # 2MB file upload limit
+    app.config["POSTS_PER_PAGE"] = int(os.getenv("POSTS_PER_PAGE", 12))
+    app.config["COMMENTS_PER_PAGE"] = int(os.getenv("COMMENTS_PER_PAGE", 20))
+    app.config.update(load_database_config())  # DATABASE path, SQLite pragmas, pool size
+    # Comments and ratings are committed in batches by a writer thread. By default a
+    # request waits (up to the timeout, in seconds) until its write is committed.
+    app.config["WRITE_BEHIND_WAIT"] = os.getenv("WRITE_BEHIND_WAIT", "1") == "1"
+    app.config["WRITE_BEHIND_TIMEOUT"] = float(os.getenv("WRITE_BEHIND_TIMEOUT", 10))
+    app.config["WRITE_BEHIND_INTERVAL_MS"] = float(os.getenv("WRITE_BEHIND_INTERVAL_MS", 5))
+    # In-process cache of the pages served to anonymous readers
+    app.config["PAGE_CACHE_ENABLED"] = os.getenv("PAGE_CACHE_ENABLED", "1") == "1"
+    app.config["PAGE_CACHE_SIZE"] = int(os.getenv("PAGE_CACHE_SIZE", 512))
+    # Apply pending schema migrations when the app starts
+    app.config["AUTO_MIGRATE"] = os.getenv("AUTO_MIGRATE", "1") == "1"
+    # Processes resizing uploaded images into their responsive variants
+    app.config["IMAGE_WORKERS"] = int(os.getenv("IMAGE_WORKERS", 2))
+    # Level of the app's log messages; DEBUG adds per-request details
+    app.config["LOG_LEVEL"] = os.getenv("LOG_LEVEL", "INFO").upper()
+    # Query count, SQL and render time of each request in a Server-Timing header
+    app.config["SERVER_TIMING"] = os.getenv("SERVER_TIMING", "1") == "1"
+    # Queries slower than this (milliseconds) are logged with their plan; 0 disables it
+    app.config["SLOW_QUERY_MS"] = float(os.getenv("SLOW_QUERY_MS", 250))
+    # In-process cache of the logged-in users. Server workers invalidate each other's
+    # entries; changes made outside the server are seen within the TTL (seconds)
+    app.config["IDENTITY_CACHE_SIZE"] = int(os.getenv("IDENTITY_CACHE_SIZE", 1024))
+    app.config["IDENTITY_CACHE_TTL"] = float(os.getenv("IDENTITY_CACHE_TTL", 60))
+    # bcrypt cost of new password hashes; older hashes are upgraded at login
+    app.config["BCRYPT_LOG_ROUNDS"] = int(os.getenv("BCRYPT_LOG_ROUNDS", 12))
+    # Threads hashing passwords, and how long (seconds) a request waits for one
+    app.config["PASSWORD_HASH_WORKERS"] = int(
+        os.getenv("PASSWORD_HASH_WORKERS", max(1, (os.cpu_count() or 2) // 2))
+    )
+    app.config["PASSWORD_HASH_TIMEOUT"] = float(os.getenv("PASSWORD_HASH_TIMEOUT", 5))
+    # Trending feed: half-life of the activity, and seconds between decay sweeps
+    app.config["TRENDING_HALF_LIFE_HOURS"] = float(os.getenv("TRENDING_HALF_LIFE_HOURS", 24))
+    app.config["TRENDING_SWEEP_SECONDS"] = float(os.getenv("TRENDING_SWEEP_SECONDS", 300))
+    # Purge jobs: rows deleted per transaction, pause between transactions, and
+    # seconds between checks for jobs requested by another process
+    app.config["PURGE_CHUNK_ROWS"] = int(os.getenv("PURGE_CHUNK_ROWS", 500))
+    app.config["PURGE_PAUSE_MS"] = float(os.getenv("PURGE_PAUSE_MS", 50))
+    app.config["PURGE_POLL_SECONDS"] = float(os.getenv("PURGE_POLL_SECONDS", 5))
+    # Link the bundles built by `flask build-assets` when they exist; 0 links the
+    # sources as they are, e.g. while editing them
+    app.config["ASSETS_USE_BUILD"] = os.getenv("ASSETS_USE_BUILD", "1") == "1"
 
     # Initialize the extensions with the app instance
     login_manager.init_app(app)
@@ -38,36 +92,73 @@ def create_app():
 
     csrf.init_app(app)  # Enable CSRF protection for all routes
     bcrypt.init_app(app)  # Enable bcrypt for password hashing
-    db.init("app.db")  # Initialize SQLite database
+    init_database(app.config)  # Initialize SQLite database and connection pool
+    write_queue.configure(flush_interval=app.config["WRITE_BEHIND_INTERVAL_MS"] / 1000)
+    page_cache.max_entries = app.config["PAGE_CACHE_SIZE"]
+    identity.identity_cache.max_entries = app.config["IDENTITY_CACHE_SIZE"]
+    identity.identity_cache.ttl = app.config["IDENTITY_CACHE_TTL"]
+    password_hasher.configure(
+        workers=app.config["PASSWORD_HASH_WORKERS"],
+        queue_timeout=app.config["PASSWORD_HASH_TIMEOUT"],
+        rounds=app.config["BCRYPT_LOG_ROUNDS"],
+    )
+    trending.half_life_hours = app.config["TRENDING_HALF_LIFE_HOURS"]
+    trending.sweep_interval = app.config["TRENDING_SWEEP_SECONDS"]
+    # The decay sweeps run on a thread of each server process, started lazily
+    app.before_request(trending.ensure_started)
+    purge_runner.chunk_rows = app.config["PURGE_CHUNK_ROWS"]
+    purge_runner.pause = app.config["PURGE_PAUSE_MS"] / 1000
+    purge_runner.poll_interval = app.config["PURGE_POLL_SECONDS"]
+    purge_runner.upload_folder = app.config["UPLOAD_FOLDER"]
+    # Purge jobs and file deletions run on a thread of each server process too
+    app.before_request(purge_runner.ensure_started)
+    image_pipeline.workers = app.config["IMAGE_WORKERS"]
+    app.logger.setLevel(app.config["LOG_LEVEL"])  # Also the level of the app.* modules
+    instrumentation.init_app(app)
 
-    # Connect to the database before handling requests
+    # Take a connection from the pool before handling requests
     @app.before_request
     def before_request():
         """Ensure that the database connection is open before each request."""
         if db.is_closed():
             db.connect()
 
-    # Close the database connection after processing each request
+    # Return the connection to the pool after processing each request
     @app.teardown_request
     def teardown_request(exception=None):
-        """Ensure that the database connection is closed after each request."""
+        """Release the request's database connection back to the pool."""
         if not db.is_closed():
             db.close()
 
-    # Check if the database exists and create tables if necessary
-    if not os.path.exists("app.db"):
-        print("Creating the database and tables...")
-        with db:
-            db.create_tables(
-                [User, Post, Comment, Rating, Category, Tag, PostTag]
-            )  # Add all models here
-    else:
-        print("Database already exists. Skipping table creation.")
+    # Stored uploads never change, so browsers may cache them forever
+    app.after_request(storage.immutable_cache_headers)
+    # Fingerprinted, precompressed CSS, JS and images, see app/assets.py
+    assets.init_app(app)
+
+    # Apply the pending schema migrations, unless deployments run `flask migrate`
+    if app.config["AUTO_MIGRATE"]:
+        if not os.path.exists(app.config["DATABASE"]):
+            app.logger.info("Creating the database and tables...")
+
+        from app.schema import migrate_database
+
+        with db.connection_context():
+            applied, plans = migrate_database(explain=True)  # Each in its own transaction
+        for version, name in applied:
+            app.logger.info("Applied migration %s: %s", version, name)
+        if applied:
+            app.logger.info("Query plans of the busiest routes:\n%s", "\n".join(plans))
 
     # Register blueprints
     with app.app_context():
         from .routes import bp  # Import the blueprint for routes
+        from .api import bp as api_bp  # JSON API for the mobile and single-page clients
 
         app.register_blueprint(bp)
+        app.register_blueprint(api_bp)
+
+    from app.commands import register_commands
+
+    register_commands(app)
 
     return app
@@ -0,0 +1,328 @@
+import gzip
+import hashlib
+import json
+from functools import wraps
+
+from flask import Blueprint, request, current_app, url_for, make_response, jsonify
+from peewee import fn
+from werkzeug.http import is_resource_modified
+
+from app.models import Post, Rating
+from app.pagination import paginate_keyset
+from app import loaders
+from app import rendering
+from app import caching
+from app import feed as post_feed
+
+bp = Blueprint("api", __name__, url_prefix="/api")
+
+# Most posts returned by one request, by id or per feed page
+MAX_BATCH = 100
+
+# Responses smaller than this (bytes) aren't worth compressing
+GZIP_MIN_SIZE = 1024
+GZIP_LEVEL = 6
+
+
+def _datetime(value):
+    return value.isoformat() + "Z" if value else None
+
+
+def _upload(path, variants):
+    """URL of an upload and of its responsive variants (see app/images.py)."""
+    if not path:
+        return None
+    data = {"url": url_for("static", filename="uploads/" + path)}
+    if variants and variants.get("variants"):
+        data["variants"] = [
+            {
+                "width": variant["width"],
+                "height": variant["height"],
+                "jpeg": url_for("static", filename="uploads/" + variant["jpeg"]),
+                "webp": url_for("static", filename="uploads/" + variant["webp"]),
+            }
+            for variant in variants["variants"]
+        ]
+    return data
+
+
+def _user(user):
+    return {
+        "id": user.id,
+        "username": user.username,
+        "profile_picture": _upload(user.profile_picture, user.profile_picture_variants),
+    }
+
+
+# Fields of a serialized post, in output order
+POST_FIELDS = {
+    "id": lambda post: post.id,
+    "title": lambda post: post.title,
+    "content": lambda post: post.content,  # Markdown source
+    "content_html": rendering.post_html,
+    "author": lambda post: _user(post.author),
+    "category": lambda post: post.category.name,
+    "tags": lambda post: post.tag_names,
+    "image": lambda post: _upload(post.image, post.image_variants),
+    "created_at": lambda post: _datetime(post.created_at),
+    "updated_at": lambda post: _datetime(post.updated_at),
+    "rating": lambda post: {"count": post.rating_count, "average": round(post.rating_avg, 2)},
+    "comment_count": lambda post: post.comment_count,
+}
+
+# Post columns only loaded when one of these fields is requested
+CONTENT_COLUMNS = ("content", "content_html", "content_html_version")
+
+
+class ApiError(Exception):
+    """Error returned to the client as JSON with the given status."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+@bp.errorhandler(ApiError)
+def handle_api_error(error):
+    return jsonify(error=error.message), error.status
+
+
+def requested_fields(extra=()):
+    """
+    Fields selected by the `fields` (keep only these) and `exclude` (drop these)
+    query string parameters, both comma-separated, e.g. `?exclude=content,content_html`.
+    :param extra: Names of the fields a response has besides POST_FIELDS.
+    :return: List of field names, in output order.
+    """
+    available = list(POST_FIELDS) + list(extra)
+    fields = _split(request.args.get("fields")) or available
+    excluded = _split(request.args.get("exclude"))
+    unknown = (set(fields) | set(excluded)) - set(available)
+    if unknown:
+        raise ApiError(400, "Unknown fields: " + ", ".join(sorted(unknown)))
+    # The id is always included, so that batched results can be matched up
+    return [name for name in available if name in fields and name not in excluded or name == "id"]
+
+
+def _split(value):
+    return [part.strip() for part in (value or "").split(",") if part.strip()]
+
+
+def _post_query(fields):
+    """Post query without the content columns unless they are requested."""
+    columns = [
+        field
+        for field in Post._meta.sorted_fields
+        if field.name not in CONTENT_COLUMNS or {"content", "content_html"} & set(fields)
+    ]
+    return Post.select(*columns)
+
+
+def serialize_posts(posts, fields):
+    """Serialize Post objects loaded with their relations (and tag names if requested)."""
+    getters = [(name, POST_FIELDS[name]) for name in fields if name in POST_FIELDS]
+    return [{name: getter(post) for name, getter in getters} for post in posts]
+
+
+def json_response(stamp):
+    """
+    Decorator for the API views, which return the data to send as JSON. The data is
+    serialized compactly, compressed with gzip for the clients accepting it, and
+    sent with an ETag and a Last-Modified header derived from `stamp`, so that
+    revalidations get 304 Not Modified without running the view. Serialized
+    responses are kept in the page cache (see app/caching.py).
+    The API only serves public content, so the responses are the same for every user.
+    :param stamp: Function taking the view arguments and returning
+        (etag, last_modified, tags), or None if the content doesn't exist.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**kwargs):
+            validator = stamp(**kwargs)
+            if validator is None:
+                raise ApiError(404, "Not found")
+            etag, last_modified, tags = validator
+            # The same content is served with different fields and pages
+            etag = hashlib.sha1(f"{etag}|{request.full_path}".encode("utf-8")).hexdigest()
+            compress = request.accept_encodings["gzip"] > 0
+
+            if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+                caching.page_cache.record_not_modified()
+                response = make_response("", 304)
+            else:
+                use_cache = current_app.config["PAGE_CACHE_ENABLED"]
+                key = ("api", request.full_path, compress)
+                page = caching.page_cache.get(key, etag) if use_cache else None
+                if page is None:
+                    body = json.dumps(
+                        view(**kwargs), separators=(",", ":"), ensure_ascii=False
+                    ).encode("utf-8")
+                    encoding = None
+                    if compress and len(body) >= GZIP_MIN_SIZE:
+                        body = gzip.compress(body, GZIP_LEVEL)
+                        encoding = "gzip"
+                    page = (body, encoding)
+                    if use_cache:
+                        caching.page_cache.put(key, etag, tags, page)
+                body, encoding = page
+                response = make_response(body)
+                response.content_type = "application/json"
+                if encoding:
+                    response.content_encoding = encoding
+
+            # A compressed body is another representation of the same content, so
+            # its ETag is weak, as the ones of the proxies compressing responses are
+            response.set_etag(etag, weak=compress)
+            response.last_modified = last_modified
+            response.headers["Cache-Control"] = "no-cache"
+            response.vary.add("Accept-Encoding")
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def _requested_ids():
+    try:
+        ids = list(dict.fromkeys(int(part) for part in _split(request.args.get("ids"))))
+    except ValueError:
+        raise ApiError(400, "ids must be a comma-separated list of post ids")
+    if not ids:
+        raise ApiError(400, "ids is required")
+    if len(ids) > MAX_BATCH:
+        raise ApiError(400, f"At most {MAX_BATCH} ids per request")
+    return ids
+
+
+@bp.route("/posts")
+@json_response(lambda: caching.posts_stamp(_requested_ids()))
+def posts():
+    """
+    Several posts by id, e.g. /api/posts?ids=1,2,3, in two queries (three with
+    tags). Posts are returned in the requested order; unknown ids are listed in
+    `missing`.
+    """
+    ids = _requested_ids()
+    fields = requested_fields()
+    found = list(loaders.with_post_relations(_post_query(fields).where(Post.id.in_(ids))))
+    if "tags" in fields:
+        loaders.attach_tag_names(found)
+    by_id = {post.id: post for post in found}
+    return {
+        "posts": serialize_posts([by_id[post_id] for post_id in ids if post_id in by_id], fields),
+        "missing": [post_id for post_id in ids if post_id not in by_id],
+    }
+
+
+@bp.route("/feed")
+@json_response(caching.feed_stamp)
+def feed():
+    """
+    One page of the homepage feed, with the same filters and sort orders (`q`,
+    `category`, `author`, `author_id`, `tags`, `sort_by`). Pages are linked by the `next` and
+    `prev` cursors, passed back as `after` and `before`. `limit` sets the page size.
+    """
+    fields = requested_fields()
+    sort_by = request.args.get("sort_by", "created_at")
+    if sort_by not in post_feed.SORT_ORDERS:
+        raise ApiError(400, "sort_by must be one of " + ", ".join(post_feed.SORT_ORDERS))
+    try:
+        limit = int(request.args.get("limit", current_app.config["POSTS_PER_PAGE"]))
+    except ValueError:
+        raise ApiError(400, "limit must be a number")
+    if not 1 <= limit <= MAX_BATCH:
+        raise ApiError(400, f"limit must be between 1 and {MAX_BATCH}")
+
+    query = request.args.get("q", "").strip()
+    posts, ranked = post_feed.filter_posts(
+        _post_query(fields),
+        query,
+        category=request.args.get("category"),
+        author=request.args.get("author"),
+        tags=request.args.getlist("tags"),
+        author_id=request.args.get("author_id", type=int),
+    )
+    posts, sort_keys = post_feed.sort_posts(
+        posts, sort_by, by_relevance=ranked and "sort_by" not in request.args
+    )
+    page = paginate_keyset(
+        loaders.with_post_relations(posts),
+        sort_keys,
+        per_page=limit,
+        after=request.args.get("after"),
+        before=request.args.get("before"),
+    )
+    if "tags" in fields:
+        loaders.attach_tag_names(page.items)
+    return {
+        "posts": serialize_posts(page.items, fields),
+        "next": page.next_cursor,
+        "prev": page.prev_cursor,
+    }
+
+
+# Fields of a post bundle besides POST_FIELDS
+BUNDLE_FIELDS = ("comments", "ratings")
+
+
+@bp.route("/posts/<int:post_id>")
+@json_response(caching.post_stamp)
+def post_bundle(post_id):
+    """
+    A post with its author, category, tags, first page of comments (oldest first,
+    with their authors) and rating distribution, in four queries. The following
+    comments are fetched from /api/posts/<id>/comments?after=<comments_next>.
+    """
+    fields = requested_fields(BUNDLE_FIELDS)
+    post = loaders.load_post(post_id)
+    if post is None:
+        raise ApiError(404, "Not found")
+    data = serialize_posts([post], fields)[0]
+
+    if "comments" in fields:
+        page = _comments_page(post_id)
+        data["comments"] = _serialize_comments(page.items)
+        data["comments_next"] = page.next_cursor
+    if "ratings" in fields:
+        # Number of ratings per value, the count and average are in `rating`
+        distribution = dict.fromkeys(range(1, 6), 0)
+        rows = (
+            Rating.select(Rating.rating, fn.COUNT(Rating.user))
+            .where(Rating.post == post_id)
+            .group_by(Rating.rating)
+            .tuples()
+        )
+        distribution.update(rows)
+        data["ratings"] = {str(value): count for value, count in distribution.items()}
+    return data
+
+
+def _comments_page(post_id):
+    return loaders.load_comments(
+        post_id,
+        per_page=current_app.config["COMMENTS_PER_PAGE"],
+        after=request.args.get("after"),
+    )
+
+
+def _serialize_comments(comments):
+    return [
+        {
+            "id": comment.id,
+            "author": _user(comment.author),
+            "content": comment.content,
+            "created_at": _datetime(comment.created_at),
+        }
+        for comment in comments
+    ]
+
+
+@bp.route("/posts/<int:post_id>/comments")
+@json_response(caching.post_stamp)
+def post_comments(post_id):
+    """A page of the comments of a post, oldest first. Pass `next` back as `after`."""
+    page = _comments_page(post_id)
+    return {"comments": _serialize_comments(page.items), "next": page.next_cursor}
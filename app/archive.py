@@ -0,0 +1,85 @@
+import calendar
+import datetime
+import re
+
+from app.models import Post, MonthlyPostCount
+
+# Values of the `month:` search prefix: "December", "December 2024", "2024-12"
+_MONTH_NAME = re.compile(r"^([a-z]+)(?:\s+(\d{4}))?$", re.IGNORECASE)
+_YEAR_MONTH = re.compile(r"^(\d{4})-(\d{1,2})$")
+
+
+def month_bounds(year, month):
+    """
+    Half-open range of creation times in a month.
+    :return: (start, end) datetimes; a post is in the month if start <= created_at < end.
+    """
+    start = datetime.datetime(year, month, 1)
+    if month == 12:
+        return start, datetime.datetime(year + 1, 1, 1)
+    return start, datetime.datetime(year, month + 1, 1)
+
+
+def in_month(year, month):
+    """
+    Filter on the posts created in a month. Unlike a strftime() on the column, the
+    range predicate can use the created_at index.
+    """
+    start, end = month_bounds(year, month)
+    return (Post.created_at >= start) & (Post.created_at < end)
+
+
+def parse_month(value):
+    """
+    Parse the value of a `month:` search, e.g. "December", "december 2024" or
+    "2024-12". A month without a year means the latest such month with posts.
+    :return: (year, month), or None if the value isn't a month.
+    """
+    value = value.strip()
+    match = _YEAR_MONTH.match(value)
+    if match:
+        year, month = int(match.group(1)), int(match.group(2))
+        return (year, month) if 1 <= month <= 12 else None
+
+    match = _MONTH_NAME.match(value)
+    if not match:
+        return None
+    names = [name.lower() for name in calendar.month_name]
+    if match.group(1).lower() not in names:
+        return None
+    month = names.index(match.group(1).lower())
+    if match.group(2):
+        return int(match.group(2)), month
+    return _latest_year(month), month
+
+
+def _latest_year(month):
+    year = (
+        MonthlyPostCount.select(MonthlyPostCount.year)
+        .where((MonthlyPostCount.month == month) & (MonthlyPostCount.count > 0))
+        .order_by(MonthlyPostCount.year.desc())
+        .limit(1)
+        .scalar()
+    )
+    return year or datetime.datetime.utcnow().year
+
+
+def archive_months():
+    """
+    Months that have posts, newest first, for the archive sidebar.
+    :return: List of dicts with year, month, label (e.g. "December 2024") and count.
+    """
+    rows = (
+        MonthlyPostCount.select()
+        .where(MonthlyPostCount.count > 0)
+        .order_by(MonthlyPostCount.year.desc(), MonthlyPostCount.month.desc())
+    )
+    return [
+        {
+            "year": row.year,
+            "month": row.month,
+            "label": f"{calendar.month_name[row.month]} {row.year}",
+            "count": row.count,
+        }
+        for row in rows
+    ]
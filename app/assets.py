@@ -0,0 +1,455 @@
+import base64
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+import urllib.parse
+import urllib.request
+
+from flask import current_app, request, send_file, url_for, abort
+from markupsafe import Markup, escape
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:  # Optional: without it only the gzip siblings are written
+    brotli = None
+
+# Sub-folder of the static folder the build writes to, served by serve_asset()
+DIST_FOLDER = "dist"
+MANIFEST = "manifest.json"
+
+# Bundles built from static files, in the order they are concatenated. Bootstrap
+# stays a bundle of its own, linked after the page styles as it always was, so it
+# keeps winning the ties with them.
+BUNDLES = {
+    "css/site.css": ["css/layout.css", "vendor/fontawesome/css/all.min.css"],
+    "css/view_post.css": ["css/view_post.css"],
+    "css/bootstrap.css": ["vendor/bootstrap/css/bootstrap.min.css"],
+    "js/site.js": ["js/script.js"],
+    "js/bootstrap.js": ["vendor/bootstrap/js/bootstrap.bundle.min.js"],
+}
+
+# Third-party files vendored into the static folder by `flask vendor-assets`:
+# path -> (URL, Subresource Integrity hash or None). Until they are downloaded,
+# pages link them from the CDN.
+VENDOR = {
+    "vendor/bootstrap/css/bootstrap.min.css": (
+        "https://cdn.jsdelivr.net/npm/bootstrap@5.3.3/dist/css/bootstrap.min.css",
+        "sha384-QWTKZyjpPEjISv5WaRU9OFeRpok6YctnYmDr5pNlyT2bRjXh0JMhjY6hW+ALEwIH",
+    ),
+    "vendor/bootstrap/js/bootstrap.bundle.min.js": (
+        "https://cdn.jsdelivr.net/npm/bootstrap@5.3.3/dist/js/bootstrap.bundle.min.js",
+        "sha384-YvpcrYf0tY3lHB60NNkmXc5s9fDVZLESaAA55NDzOxhy9GkcIdslK1eN7N6jIeHz",
+    ),
+    "vendor/fontawesome/css/all.min.css": (
+        "https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0-beta3/css/all.min.css",
+        None,
+    ),
+}
+
+# Static folders whose files are fingerprinted too, for asset_url() in templates
+ASSET_FOLDERS = ("images",)
+
+# Types worth precompressing; images and fonts like WOFF2 are compressed already
+COMPRESSIBLE = (".css", ".js", ".svg", ".json", ".txt", ".ttf", ".eot")
+# Precompressed siblings must save at least this fraction of the size
+MIN_SAVING = 0.05
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+CSS_URL = re.compile(r"""url\(\s*(['"]?)([^'")]+?)\1\s*\)""")
+SOURCE_MAP = re.compile(r"^\s*(?://# sourceMappingURL=.*|/\*# sourceMappingURL=.*?\*/)\s*$", re.M)
+
+
+class AssetError(Exception):
+    """An asset can't be built or vendored, e.g. a source file is missing."""
+
+
+# Minification
+
+
+def minify_css(css):
+    """
+    Remove the comments (except /*! license */ ones) and the whitespace CSS
+    doesn't need. Strings are kept as they are.
+    """
+    tokens = re.split(r"""("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*'|/\*.*?\*/)""", css, flags=re.S)
+    out = []
+    for token in tokens:
+        if token.startswith("/*"):
+            if token.startswith("/*!"):
+                out.append(token)
+            continue
+        if token[:1] in ("'", '"'):
+            out.append(token)
+            continue
+        token = re.sub(r"\s+", " ", token)
+        token = re.sub(r"\s*([{};,>])\s*", r"\1", token)
+        # Only after a colon: "a :hover" is a selector, "color: red" isn't
+        token = re.sub(r":\s+", ":", token)
+        out.append(token.replace(";}", "}"))
+    return "".join(out).strip()
+
+
+# A slash after these starts a regular expression rather than a division
+REGEX_PRECEDERS = set("(,=:[!&|?{};+-*%<>~^")
+REGEX_KEYWORDS = (
+    "return", "typeof", "case", "do", "else", "in", "of", "void", "throw", "delete", "new"
+)
+
+
+def minify_js(js):
+    """
+    Remove the comments and the indentation, trailing spaces and blank lines of
+    JavaScript. Line breaks are kept, so automatic semicolon insertion works as
+    in the source; strings, template literals and regular expressions are kept
+    as they are.
+    """
+    out = []  # Alternating code and literal pieces
+    code = []
+    i, n = 0, len(js)
+
+    def previous_code():
+        # After a literal, a slash is a division
+        return "".join(code).rstrip() or "".join(out).rstrip()
+
+    while i < n:
+        char = js[i]
+        if js.startswith("//", i):
+            end = js.find("\n", i)
+            i = n if end < 0 else end
+        elif js.startswith("/*", i):
+            end = js.find("*/", i + 2)
+            i = n if end < 0 else end + 2
+            code.append(" ")
+        elif char in ("'", '"', "`") or (char == "/" and _starts_regex(previous_code())):
+            j = i + 1
+            in_class = False
+            while j < n:
+                if js[j] == "\\":
+                    j += 2
+                    continue
+                if char == "/" and js[j] == "[":
+                    in_class = True
+                elif char == "/" and js[j] == "]":
+                    in_class = False
+                elif js[j] == char and not in_class:
+                    break
+                j += 1
+            out.append(_collapse("".join(code)))
+            out.append(js[i : j + 1])
+            code = []
+            i = j + 1
+        else:
+            code.append(char)
+            i += 1
+    out.append(_collapse("".join(code)))
+    return "".join(out).strip()
+
+
+def _starts_regex(before):
+    if not before:
+        return True
+    if before[-1] in REGEX_PRECEDERS:
+        return True
+    return re.search(r"(?:^|[^\w$])(?:%s)$" % "|".join(REGEX_KEYWORDS), before) is not None
+
+
+def _collapse(code):
+    # Runs of whitespace become one line break if they contain one, else one space
+    code = re.sub(r"[ \t]*\n\s*", "\n", code)
+    return re.sub(r"[ \t]+", " ", code)
+
+
+# Build
+
+
+def fingerprinted_name(name, data):
+    """Name of a file with the hash of its content, e.g. css/site.3f2a1b4c5d.css."""
+    stem, extension = posixpath.splitext(name)
+    return f"{stem}.{hashlib.sha256(data).hexdigest()[:10]}{extension}"
+
+
+def _write(dist, name, data):
+    """
+    Write a fingerprinted file with its precompressed siblings, unless it exists.
+    :return: The fingerprinted name.
+    """
+    hashed = fingerprinted_name(name, data)
+    path = os.path.join(dist, hashed)
+    if os.path.exists(path):
+        return hashed
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    siblings = {}
+    if name.endswith(COMPRESSIBLE):
+        # mtime=0 makes the output reproducible
+        siblings[".gz"] = gzip.compress(data, 9, mtime=0)
+        if brotli is not None:
+            siblings[".br"] = brotli.compress(data, quality=11)
+    for suffix, compressed in siblings.items():
+        if len(compressed) <= len(data) * (1 - MIN_SAVING):
+            _write_file(path + suffix, compressed)
+    # The file itself last, so a file that exists always has its siblings
+    _write_file(path, data)
+    return hashed
+
+
+def _write_file(path, data):
+    temp = path + ".tmp"
+    with open(temp, "wb") as file:
+        file.write(data)
+    os.replace(temp, path)
+
+
+def _rewrite_urls(css, source, bundle, static_folder, dist, entries):
+    """
+    Point the url()s of a CSS source at fingerprinted copies of the files they
+    reference, relative to the bundle the source goes into.
+    """
+
+    def replace(match):
+        url = match.group(2).strip()
+        if url.startswith(("data:", "http:", "https:", "//", "#")):
+            return match.group(0)
+        path, suffix = re.match(r"([^?#]*)(.*)", url).groups()
+        if path.startswith("/static/"):
+            name = path[len("/static/") :]
+        elif path.startswith("/"):
+            return match.group(0)
+        else:
+            name = posixpath.normpath(posixpath.join(posixpath.dirname(source), path))
+        full_path = safe_join(static_folder, name)
+        if full_path is None or not os.path.isfile(full_path):
+            raise AssetError(f"{source}: {url} not found")
+        if name not in entries:
+            with open(full_path, "rb") as file:
+                entries[name] = _write(dist, name, file.read())
+        relative = posixpath.relpath(entries[name], posixpath.dirname(bundle))
+        return f"url({relative}{suffix})"
+
+    return CSS_URL.sub(replace, css)
+
+
+def build(static_folder, clean=False):
+    """
+    Build the bundles into the dist folder: concatenated, minified and named after
+    the hash of their content, with gzip (and with Brotli installed, brotli)
+    siblings. The files of ASSET_FOLDERS and the files the CSS references are
+    fingerprinted too. The manifest mapping each name to its fingerprinted name
+    is written last, so pages only link files that exist.
+    :param clean: Delete the files of earlier builds the new manifest doesn't use.
+        Pages still open in browsers may request them, so keep them for a while
+        after a deployment.
+    :return: The manifest, dict of name -> fingerprinted name.
+    :raise AssetError: If a source or a file it references is missing.
+    """
+    dist = os.path.join(static_folder, DIST_FOLDER)
+    entries = {}
+    for folder in ASSET_FOLDERS:
+        for root, _, files in os.walk(os.path.join(static_folder, folder)):
+            for filename in sorted(files):
+                full_path = os.path.join(root, filename)
+                name = os.path.relpath(full_path, static_folder).replace(os.sep, "/")
+                with open(full_path, "rb") as file:
+                    entries[name] = _write(dist, name, file.read())
+
+    for bundle, sources in BUNDLES.items():
+        parts = []
+        for source in sources:
+            full_path = os.path.join(static_folder, source)
+            if not os.path.isfile(full_path):
+                hint = " (run `flask vendor-assets` first)" if source in VENDOR else ""
+                raise AssetError(f"{source} not found{hint}")
+            with open(full_path, encoding="utf-8") as file:
+                text = file.read()
+            # The source maps of the vendored files aren't vendored
+            text = SOURCE_MAP.sub("", text)
+            if bundle.endswith(".css"):
+                text = _rewrite_urls(text, source, bundle, static_folder, dist, entries)
+            minified = ".min." in source  # e.g. vendored files
+            if bundle.endswith(".css"):
+                parts.append(text.strip() if minified else minify_css(text))
+            else:
+                # A source without a trailing semicolon must not run into the next one
+                parts.append((text.strip() if minified else minify_js(text)) + ";")
+        entries[bundle] = _write(dist, bundle, "\n".join(parts).encode("utf-8"))
+
+    _write_file(
+        os.path.join(dist, MANIFEST),
+        json.dumps(entries, indent=2, sort_keys=True).encode("utf-8"),
+    )
+    if clean:
+        keep = set(entries.values()) | {MANIFEST}
+        for root, _, files in os.walk(dist):
+            for filename in files:
+                full_path = os.path.join(root, filename)
+                name = os.path.relpath(full_path, dist).replace(os.sep, "/")
+                if re.sub(r"\.(gz|br)$", "", name) not in keep:
+                    os.remove(full_path)
+    return entries
+
+
+def vendor(static_folder):
+    """
+    Download the VENDOR files into the static folder, with the fonts and images
+    their CSS references, and check them against their integrity hashes.
+    :return: List of (path, integrity) of the downloaded VENDOR files.
+    :raise AssetError: If a download doesn't match its integrity hash.
+    """
+    downloaded = []
+    for name, (url, integrity) in VENDOR.items():
+        data = _download(url)
+        actual = "sha384-" + base64.b64encode(hashlib.sha384(data).digest()).decode("ascii")
+        if integrity and actual != integrity:
+            raise AssetError(f"{url}: integrity {actual} doesn't match {integrity}")
+        if name.endswith(".css"):
+            package = "/".join(name.split("/")[:2]) + "/"  # e.g. vendor/fontawesome/
+            for match in CSS_URL.finditer(data.decode("utf-8")):
+                reference = re.match(r"[^?#]*", match.group(2).strip()).group(0)
+                if not reference or reference.startswith(("data:", "http:", "https:", "/")):
+                    continue
+                target = posixpath.normpath(posixpath.join(posixpath.dirname(name), reference))
+                if not target.startswith(package):
+                    raise AssetError(f"{url}: {reference} is outside {package}")
+                full_path = os.path.join(static_folder, target)
+                if not os.path.exists(full_path):
+                    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                    _write_file(full_path, _download(urllib.parse.urljoin(url, reference)))
+        full_path = os.path.join(static_folder, name)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        _write_file(full_path, data)
+        downloaded.append((name, actual))
+    return downloaded
+
+
+def _download(url):
+    try:
+        with urllib.request.urlopen(url, timeout=30) as response:
+            return response.read()
+    except OSError as e:
+        raise AssetError(f"{url}: {e}")
+
+
+# Serving
+
+
+class AssetManifest:
+    """The manifest of the last build, read when the app is created."""
+
+    def __init__(self):
+        self.entries = {}
+        # Hash of the manifest, part of the ETags of the pages linking the assets
+        self.version = ""
+
+    def load(self, static_folder):
+        """
+        Read the manifest written by build(); without one (e.g. in development)
+        the sources are linked as they are.
+        """
+        path = os.path.join(static_folder, DIST_FOLDER, MANIFEST)
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            self.clear()
+            return
+        self.entries = json.loads(data)
+        self.version = hashlib.sha256(data).hexdigest()[:10]
+
+    def clear(self):
+        """Link the sources as they are."""
+        self.entries = {}
+        self.version = ""
+
+
+# Shared manifest used by the templates
+manifest = AssetManifest()
+
+
+def asset_url(filename):
+    """
+    URL of a static file or bundle, like url_for("static", filename=...): its
+    fingerprinted copy once built, else the file itself.
+    """
+    hashed = manifest.entries.get(filename)
+    if hashed is not None:
+        return url_for("assets", filename=hashed)
+    return url_for("static", filename=filename)
+
+
+def asset_tags(bundle):
+    """
+    The <link> or <script> tag of a bundle, or without a build one tag per source,
+    with the vendored files that weren't downloaded linked from their CDN.
+    """
+    if bundle in manifest.entries:
+        urls = [(asset_url(bundle), None)]
+    else:
+        urls = []
+        for source in BUNDLES[bundle]:
+            if source in VENDOR and not os.path.isfile(
+                os.path.join(current_app.static_folder, source)
+            ):
+                urls.append(VENDOR[source])
+            else:
+                urls.append((url_for("static", filename=source), None))
+
+    tags = []
+    for url, integrity in urls:
+        attributes = ""
+        if integrity:
+            attributes = f' integrity="{escape(integrity)}" crossorigin="anonymous"'
+        if bundle.endswith(".css"):
+            tags.append(f'<link rel="stylesheet" href="{escape(url)}"{attributes}>')
+        else:
+            tags.append(f'<script defer src="{escape(url)}"{attributes}></script>')
+    return Markup("\n".join(tags))
+
+
+def serve_asset(filename):
+    """
+    Serve a built file. Their names change with their content, so they are cached
+    forever; clients accepting Brotli or gzip get the precompressed sibling.
+    """
+    dist = os.path.join(current_app.static_folder, DIST_FOLDER)
+    path = safe_join(dist, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+
+    encoding = None
+    for candidate in sorted(("br", "gzip"), key=lambda name: -request.accept_encodings[name]):
+        suffix = ".br" if candidate == "br" else ".gz"
+        if request.accept_encodings[candidate] > 0 and os.path.isfile(path + suffix):
+            encoding, path = candidate, path + suffix
+            break
+
+    response = send_file(
+        path,
+        mimetype=mimetypes.guess_type(filename)[0] or "application/octet-stream",
+        conditional=True,
+        max_age=IMMUTABLE_MAX_AGE,
+    )
+    if encoding:
+        response.content_encoding = encoding
+    response.vary.add("Accept-Encoding")
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+def init_app(app):
+    """Load the manifest, serve the dist folder and add the template helpers."""
+    if app.config["ASSETS_USE_BUILD"]:
+        manifest.load(app.static_folder)
+    else:
+        manifest.clear()
+    app.add_url_rule(
+        f"{app.static_url_path}/{DIST_FOLDER}/<path:filename>",
+        endpoint="assets",
+        view_func=serve_asset,
+    )
+    app.jinja_env.globals.update(asset_url=asset_url, asset_tags=asset_tags)
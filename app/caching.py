@@ -0,0 +1,236 @@
+import datetime
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+from flask import request, session, make_response, current_app
+from flask_login import current_user
+from werkzeug.http import is_resource_modified
+
+from app.models import Post, ChangeStamp
+from app import rendering
+from app import assets
+
+# Name of the ChangeStamp bumped whenever the homepage feed may change
+FEED_STAMP = "feed"
+
+
+class PageCache:
+    """
+    Bounded, thread-safe LRU cache of rendered pages for anonymous readers.
+
+    Each entry is stored with the ETag of the content it was rendered from and is
+    only served while that ETag is still current, so a stale page is never served
+    even if an invalidation was missed (e.g. a write made by another process).
+    Entries are also dropped as soon as a write to their post is seen in-process,
+    so they don't occupy the cache after they become stale.
+    """
+
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._not_modified = 0
+
+    def get(self, key, etag):
+        """
+        Return the cached (body, content type) for key if it was stored for this ETag.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != etag:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[2]
+
+    def put(self, key, etag, tags, page):
+        """
+        Store a rendered page.
+        :param key: Cache key (the request path and query string).
+        :param etag: ETag of the content the page was rendered from.
+        :param tags: Set of tags used by invalidate(), e.g. {("post", 1)}.
+        :param page: (body, content type) to serve on a hit.
+        """
+        with self._lock:
+            self._entries[key] = (etag, tags, page)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, tag):
+        """Drop every entry stored with the given tag."""
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if tag in entry[1]]:
+                del self._entries[key]
+
+    def record_not_modified(self):
+        with self._lock:
+            self._not_modified += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Hit-rate counters."""
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self._hits,
+                "misses": self._misses,
+                "not_modified": self._not_modified,
+                "hit_rate": round(self._hits / lookups, 4) if lookups else 0,
+            }
+
+
+# Shared page cache used by the routes
+page_cache = PageCache()
+
+
+def touch_posts(post_ids, feed=True):
+    """
+    Record that posts, their comments or their ratings changed by bumping the stamps
+    their validators are derived from. Call inside the transaction writing the change.
+    :param post_ids: Ids of the changed posts.
+    :param feed: Whether the change also shows on the homepage feed.
+    """
+    if post_ids:
+        Post.update(changed_at=datetime.datetime.utcnow()).where(
+            Post.id.in_(list(post_ids))
+        ).execute()
+    if feed:
+        ChangeStamp.bump(FEED_STAMP)
+
+
+def forget_posts(post_ids, feed=True):
+    """
+    Drop the cached pages showing the given posts (and the feed pages), once the
+    change recorded by touch_posts() is committed.
+    """
+    for post_id in post_ids:
+        page_cache.invalidate(("post", post_id))
+    if feed:
+        page_cache.invalidate(FEED_STAMP)
+
+
+def invalidate_post(post_id, feed=True):
+    """
+    touch_posts() and forget_posts() for a single post changed by the current request.
+    """
+    touch_posts([post_id], feed)
+    forget_posts([post_id], feed)
+
+
+def invalidate_feed():
+    """Record that the homepage feed changed without any single post page changing."""
+    touch_posts([], feed=True)
+    forget_posts([], feed=True)
+
+
+def _make_etag(*parts):
+    # Rendering changes (new Markdown renderer, new app version, new asset build)
+    # change every ETag
+    parts += (rendering.RENDERER_VERSION, os.getenv("APP_VERSION", "1"), assets.manifest.version)
+    raw = "|".join(str(part) for part in parts).encode("utf-8")
+    return hashlib.sha1(raw).hexdigest()
+
+
+def post_stamp(post_id):
+    """Validator of a post page: (etag, last_modified, tags) or None if it doesn't exist."""
+    changed_at = Post.select(Post.changed_at).where(Post.id == post_id).scalar()
+    if changed_at is None:
+        return None
+    return _make_etag("post", post_id, changed_at), changed_at, {("post", post_id)}
+
+
+def posts_stamp(post_ids):
+    """
+    Validator of a response showing several posts: (etag, last_modified, tags).
+    Missing posts are left out, so the ETag changes if one of them appears.
+    """
+    rows = list(
+        Post.select(Post.id, Post.changed_at)
+        .where(Post.id.in_(list(post_ids)))
+        .order_by(Post.id)
+        .tuples()
+    )
+    last_modified = max((changed_at for _, changed_at in rows), default=None)
+    return (
+        _make_etag("posts", *[part for row in rows for part in row]),
+        last_modified,
+        {("post", post_id) for post_id, _ in rows},
+    )
+
+
+def feed_stamp(**view_args):
+    """
+    Validator of the homepage feed pages and the other post listings:
+    (etag, last_modified, tags).
+    """
+    version, changed_at = ChangeStamp.current(FEED_STAMP)
+    return _make_etag(FEED_STAMP, version, changed_at), changed_at, {FEED_STAMP}
+
+
+def anonymous_cache(stamp):
+    """
+    Decorator for GET views whose anonymous output depends only on the content
+    described by `stamp`. For anonymous readers it adds a strong ETag and a
+    Last-Modified header, answers revalidations with 304 Not Modified without
+    running the view, and serves repeat requests from the page cache.
+    Logged-in users and requests with pending flash messages bypass it.
+    :param stamp: Function taking the view arguments and returning
+        (etag, last_modified, tags), or None to bypass the cache.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**kwargs):
+            if (
+                request.method != "GET"
+                or current_user.is_authenticated
+                or session.get("_flashes")
+                or not current_app.config["PAGE_CACHE_ENABLED"]
+            ):
+                return view(**kwargs)
+
+            validator = stamp(**kwargs)
+            if validator is None:
+                return view(**kwargs)
+            etag, last_modified, tags = validator
+
+            if not is_resource_modified(
+                request.environ, etag=etag, last_modified=last_modified
+            ):
+                page_cache.record_not_modified()
+                response = make_response("", 304)
+            else:
+                key = request.full_path
+                page = page_cache.get(key, etag)
+                if page is None:
+                    response = make_response(view(**kwargs))
+                    if response.status_code != 200:
+                        return response
+                    page = (response.get_data(), response.headers.get("Content-Type"))
+                    page_cache.put(key, etag, tags, page)
+                body, content_type = page
+                response = make_response(body)
+                response.content_type = content_type
+
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            # Browsers must revalidate, which the ETag makes cheap
+            response.headers["Cache-Control"] = "no-cache"
+            response.vary.add("Cookie")
+            return response
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,335 @@
+import os
+
+import click
+from flask import current_app
+
+from app.database import db
+from app.models import Post, User, Rating, StoredFile, MonthlyPostCount, FacetCount, PurgeJob
+from app import search
+from app import rendering
+from app import schema
+from app import images
+from app import caching
+from app import storage
+from app import transfer
+from app import purge
+from app import assets
+from app.trending import trending
+from app.server import PreforkServer, multiprocess_settings
+
+
+def register_commands(app):
+    """
+    Register the maintenance commands with the Flask CLI.
+    Run them with e.g. `flask --app run rebuild-search-index`.
+    """
+
+    @app.cli.command("migrate")
+    def migrate():
+        """Apply the pending schema migrations and show the query plans."""
+        with db.connection_context():
+            applied, plans = schema.migrate_database(explain=True)
+            for version, name in applied:
+                click.echo(f"Applied migration {version}: {name}")
+            click.echo(f"Schema version {schema.schema_version()}.")
+            if not applied:
+                # Migrations may have been applied when the app was created
+                plans = schema.describe_plans(None, schema.query_plans())
+        click.echo("\n".join(plans))
+
+    @app.cli.command("rebuild-search-index")
+    def rebuild_search_index():
+        """Rebuild the full-text search index from the Post table."""
+        with db:
+            search.ensure_index()
+            count = search.rebuild_index()
+        click.echo(f"Indexed {count} posts.")
+
+    @app.cli.command("reconcile-ratings")
+    @click.option("--fix", is_flag=True, help="Overwrite the aggregates that drifted.")
+    def reconcile_ratings(fix):
+        """Recompute post rating aggregates from Rating and report drift."""
+        with db:
+            drift = Rating.reconcile_aggregates(fix=fix)
+        for post_id, (count, total), (actual_count, actual_total) in drift:
+            click.echo(
+                f"Post {post_id}: stored count={count} sum={total}, "
+                f"actual count={actual_count} sum={actual_total}"
+            )
+        status = "fixed" if fix else "found"
+        click.echo(f"{len(drift)} drifted posts {status}.")
+
+    @app.cli.command("rebuild-archive-counts")
+    def rebuild_archive_counts():
+        """Recount the posts of each month shown in the archive sidebar."""
+        with db.atomic():
+            MonthlyPostCount.rebuild()
+        caching.invalidate_feed()
+        click.echo("Archive counts rebuilt.")
+
+    @app.cli.command("rebuild-facet-counts")
+    def rebuild_facet_counts():
+        """Recount the posts of each category, tag and author shown in the sidebar."""
+        with db.atomic():
+            FacetCount.rebuild()
+        caching.invalidate_feed()
+        click.echo("Facet counts rebuilt.")
+
+    @app.cli.command("rebuild-trending")
+    def rebuild_trending():
+        """Recompute the trending score of every recently active post."""
+        with db:
+            count = trending.rebuild()
+        caching.invalidate_feed()
+        click.echo(f"{count} posts have a trending score.")
+
+    @app.cli.command("rerender-posts")
+    def rerender_posts():
+        """Re-render the stored HTML of posts rendered by an older renderer."""
+        with db:
+            count = rendering.rerender_stale_posts()
+        click.echo(f"Re-rendered {count} posts.")
+
+    @app.cli.command("backfill-image-variants")
+    @click.option("--all", "rebuild_all", is_flag=True, help="Also regenerate existing variants.")
+    def backfill_image_variants(rebuild_all):
+        """Generate the responsive variants of uploaded post images and profile pictures."""
+        _backfill_image_variants(current_app.config["UPLOAD_FOLDER"], rebuild_all)
+
+    @app.cli.command("import-uploads")
+    @click.option("--prune", is_flag=True, help="Delete the original files once imported.")
+    def import_uploads(prune):
+        """Move the uploads saved under their original name into the deduplicated store."""
+        upload_folder = current_app.config["UPLOAD_FOLDER"]
+        imported = set()
+        with db:
+            for model, field, variants_field in (
+                (Post, Post.image, Post.image_variants),
+                (User, User.profile_picture, User.profile_picture_variants),
+            ):
+                rows = model.select(model.id, field).where(
+                    field.is_null(False) & ~field.startswith(storage.STORE_FOLDER + "/")
+                )
+                for row_id, filename in list(rows.tuples()):
+                    full_path = os.path.join(upload_folder, filename)
+                    if not os.path.exists(full_path):
+                        click.echo(f"Skipping {filename}: file not found.")
+                        continue
+                    with db.atomic(), open(full_path, "rb") as file:
+                        path = storage.save_upload(file, filename, upload_folder)
+                        model.update({field: path, variants_field: None}).where(
+                            model.id == row_id
+                        ).execute()
+                    imported.add(filename)
+
+        if prune:
+            for filename in imported:
+                storage.remove_file(upload_folder, filename)
+        click.echo(f"Imported {len(imported)} files.")
+        # The variants of the stored files get content-addressed names too
+        _backfill_image_variants(upload_folder, rebuild_all=False)
+
+    @app.cli.command("gc-uploads")
+    def gc_uploads():
+        """Recount the references to stored uploads and delete unreferenced files."""
+        upload_folder = current_app.config["UPLOAD_FOLDER"]
+        with db:
+            # Files copied from another instance along with an import are kept
+            storage.register_referenced(upload_folder)
+            drift = StoredFile.reconcile_references(fix=True)
+            for path, count, actual in drift:
+                click.echo(f"{path}: stored count={count}, actual count={actual}")
+            garbage = storage.collect_garbage(upload_folder)
+            orphans = storage.collect_orphans(upload_folder)
+        click.echo(
+            f"{len(drift)} counts fixed, {len(garbage)} unreferenced "
+            f"and {len(orphans)} orphaned files deleted."
+        )
+
+    @app.cli.command("export")
+    @click.argument("output", type=click.File("w", encoding="utf-8"), default="-")
+    def export(output):
+        """Export the users, posts, tags, comments and ratings as NDJSON (stdout by default)."""
+        count = 0
+        with db.connection_context():
+            for line in transfer.export_ndjson():
+                output.write(line)
+                count += 1
+        click.echo(f"Exported {count - 1} records.", err=True)
+
+    @app.cli.command("import")
+    @click.argument("source", type=click.File("r", encoding="utf-8"))
+    @click.option(
+        "--chunk-size", default=transfer.CHUNK_SIZE, show_default=True, help="Rows per transaction."
+    )
+    @click.option("--restart", is_flag=True, help="Import the file again from the start.")
+    def import_export(source, chunk_size, restart):
+        """Import an NDJSON export, resuming an interrupted import of the same file."""
+        with db.connection_context():
+            try:
+                counts = transfer.import_ndjson(
+                    source,
+                    upload_folder=current_app.config["UPLOAD_FOLDER"],
+                    chunk_size=chunk_size,
+                    restart=restart,
+                )
+            except transfer.TransferError as error:
+                raise click.ClickException(str(error))
+        if counts["resumed"]:
+            click.echo(f"Resumed after {counts['resumed']} records imported earlier.")
+        for kind in transfer.EXPORTED:
+            click.echo(f"{kind}: {counts.get(kind, 0)} imported")
+        click.echo(
+            f"{counts['matched']} existing users, categories and tags reused, "
+            f"{counts['skipped']} records with missing references skipped."
+        )
+        if counts["missing_uploads"]:
+            click.echo(
+                f"{counts['missing_uploads']} uploaded files not found: copy them into "
+                "the upload folder, then run gc-uploads to register them."
+            )
+
+    @app.cli.command("purge")
+    @click.option("--user", help="Username of the user to delete.")
+    @click.option("--tag", help="Name of the tag to delete.")
+    def purge_content(user, tag):
+        """Delete a user or tag with all its posts, comments and ratings, in chunks."""
+        if bool(user) == bool(tag):
+            raise click.UsageError("Pass either --user or --tag.")
+        with db.connection_context():
+            try:
+                job = purge.purge_runner.request("user" if user else "tag", user or tag)
+            except purge.PurgeError as error:
+                raise click.ClickException(str(error))
+            # Runs the pending jobs, unless a server process already claimed them
+            while purge.purge_runner.run_next() is not None:
+                pass
+            job = PurgeJob.get_by_id(job.id)
+        deleted = ", ".join(f"{count} {kind}" for kind, count in job.deleted.items())
+        click.echo(
+            f"Purge of the {job.kind} {job.target_name}: {job.status} "
+            f"({deleted or 'nothing deleted'})."
+        )
+        if job.error:
+            click.echo(f"Error: {job.error}")
+
+    @app.cli.command("vendor-assets")
+    def vendor_assets():
+        """Download the third-party CSS, JS and fonts into the static folder."""
+        try:
+            downloaded = assets.vendor(current_app.static_folder)
+        except assets.AssetError as error:
+            raise click.ClickException(str(error))
+        for name, integrity in downloaded:
+            click.echo(f"{name} ({integrity})")
+
+    @app.cli.command("build-assets")
+    @click.option("--clean", is_flag=True, help="Delete the files of earlier builds.")
+    def build_assets(clean):
+        """Bundle, minify, fingerprint and precompress the static CSS, JS and images."""
+        try:
+            entries = assets.build(current_app.static_folder, clean=clean)
+        except assets.AssetError as error:
+            raise click.ClickException(str(error))
+        dist = os.path.join(current_app.static_folder, assets.DIST_FOLDER)
+        for bundle in assets.BUNDLES:
+            path = os.path.join(dist, entries[bundle])
+            sizes = [f"{os.path.getsize(path)} bytes"]
+            for suffix, encoding in ((".gz", "gzip"), (".br", "brotli")):
+                if os.path.exists(path + suffix):
+                    sizes.append(f"{os.path.getsize(path + suffix)} {encoding}")
+            click.echo(f"{entries[bundle]}: {', '.join(sizes)}")
+        if assets.brotli is None:
+            click.echo("Install Brotli to also write .br files.")
+        click.echo(f"{len(entries)} files in the manifest. Restart the server to use them.")
+
+    @app.cli.command("serve")
+    @click.option("--host", default="127.0.0.1", show_default=True, help="Address to listen on.")
+    @click.option("--port", default=8000, show_default=True, help="Port to listen on.")
+    @click.option("--workers", default=2, show_default=True, help="Number of worker processes.")
+    @click.option("--threads", default=1, show_default=True, help="Threads per worker.")
+    @click.option(
+        "--max-requests",
+        default=0,
+        show_default=True,
+        help="Restart a worker after this many requests (0 never restarts it).",
+    )
+    @click.option(
+        "--max-requests-jitter",
+        default=0,
+        show_default=True,
+        help="Random number of extra requests added to each worker's limit.",
+    )
+    @click.option(
+        "--graceful-timeout",
+        default=30,
+        show_default=True,
+        help="Seconds a stopping worker gets to finish its requests.",
+    )
+    def serve(host, port, workers, threads, max_requests, max_requests_jitter, graceful_timeout):
+        """Serve the app with several worker processes forked from this one."""
+        try:
+            changed = multiprocess_settings(current_app.config)
+        except ValueError as error:
+            raise click.UsageError(str(error))
+        for setting in changed:
+            click.echo(f"Using {setting} for the worker processes.")
+        server = PreforkServer(
+            current_app._get_current_object(),
+            host=host,
+            port=port,
+            workers=workers,
+            threads=threads,
+            max_requests=max_requests,
+            max_requests_jitter=max_requests_jitter,
+            graceful_timeout=graceful_timeout,
+        )
+        server.run()
+
+
+def _backfill_image_variants(upload_folder, rebuild_all):
+    """Generate the missing variants of every post image and profile picture."""
+    with db:
+        posts = Post.select(Post.id, Post.image).where(Post.image.is_null(False))
+        users = User.select(User.id, User.profile_picture).where(
+            User.profile_picture.is_null(False)
+        )
+        if not rebuild_all:
+            posts = posts.where(Post.image_variants.is_null())
+            users = users.where(User.profile_picture_variants.is_null())
+        # (model, id, image field, variants field, filename) of each image to process
+        pending = [
+            (Post, post.id, Post.image, Post.image_variants, post.image) for post in posts
+        ]
+        pending += [
+            (User, user.id, User.profile_picture, User.profile_picture_variants, user.profile_picture)
+            for user in users
+        ]
+
+    missing = [
+        entry for entry in pending if not os.path.exists(os.path.join(upload_folder, entry[4]))
+    ]
+    for _, _, _, _, filename in missing:
+        click.echo(f"Skipping {filename}: file not found.")
+    pending = [entry for entry in pending if entry not in missing]
+
+    # The same file can be used by several posts or users; process it once
+    filenames = list(dict.fromkeys(entry[4] for entry in pending))
+    results = dict(images.image_pipeline.map(upload_folder, filenames))
+    images.image_pipeline.shutdown()
+
+    done = 0
+    with db:
+        for model, row_id, image_field, variants_field, filename in pending:
+            metadata = results[filename]
+            if isinstance(metadata, Exception):
+                click.echo(f"Failed {filename}: {metadata}")
+                continue
+            model.update({variants_field: metadata}).where(
+                (model.id == row_id) & (image_field == filename)
+            ).execute()
+            done += 1
+        # Cached pages were rendered without the srcset
+        caching.touch_posts([row_id for model, row_id, *_ in pending if model is Post])
+    caching.page_cache.clear()
+    click.echo(f"Generated variants for {len(filenames)} files ({done} posts and users).")
@@ -0,0 +1,78 @@
+from peewee import fn
+
+from app.models import Post, Category, Tag, PostTag, User, FacetCount
+
+# Values shown per facet in the sidebar
+FACET_LIMIT = 10
+
+
+def _rows(query):
+    # Rows of (name, count), or (name, count, value) when the filter takes an id
+    return [
+        {"name": row[0], "count": row[1], "value": row[2] if len(row) > 2 else row[0]}
+        for row in query.tuples()
+    ]
+
+
+def facet_counts(posts=None, limit=FACET_LIMIT):
+    """
+    Number of posts per category, tag and author, with one aggregated query per
+    facet. Without filters the counts are read from the FacetCount table.
+    :param posts: Post query with the current filters, or None for all posts.
+    :param limit: Number of values returned per facet, the most frequent first.
+    :return: Dict of facet ("category", "tag", "author") -> list of dicts with the
+        name shown, the value taken by the filter (the name, or the user id for the
+        authors) and the number of posts.
+    """
+    if posts is None:
+        return _global_counts(limit)
+
+    # The filters may join other tables (e.g. the search index), so the counts are
+    # grouped over the ids of the matching posts
+    matching = posts.select(Post.id).order_by()
+    count = fn.COUNT(Post.id)
+    categories = (
+        Post.select(Category.name, count)
+        .join(Category, on=(Post.category == Category.id))
+        .where(Post.id.in_(matching))
+        .group_by(Category.id)
+        .order_by(count.desc(), Category.name)
+        .limit(limit)
+    )
+    authors = (
+        Post.select(User.username, count, User.id)
+        .join(User, on=(Post.author == User.id))
+        .where(Post.id.in_(matching))
+        .group_by(User.id)
+        .order_by(count.desc(), User.username)
+        .limit(limit)
+    )
+    tag_count = fn.COUNT(PostTag.post)
+    tags = (
+        PostTag.select(Tag.name, tag_count)
+        .join(Tag, on=(PostTag.tag == Tag.id))
+        .where(PostTag.post.in_(matching))
+        .group_by(Tag.id)
+        .order_by(tag_count.desc(), Tag.name)
+        .limit(limit)
+    )
+    return {"category": _rows(categories), "tag": _rows(tags), "author": _rows(authors)}
+
+
+def _global_counts(limit):
+    counts = {}
+    for facet, model, name in (
+        ("category", Category, Category.name),
+        ("tag", Tag, Tag.name),
+        ("author", User, User.username),
+    ):
+        columns = [name, FacetCount.count] + ([model.id] if facet == "author" else [])
+        query = (
+            FacetCount.select(*columns)
+            .join(model, on=(FacetCount.value == model.id))
+            .where((FacetCount.facet == facet) & (FacetCount.count > 0))
+            .order_by(FacetCount.count.desc(), name)
+            .limit(limit)
+        )
+        counts[facet] = _rows(query)
+    return counts
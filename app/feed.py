@@ -0,0 +1,120 @@
+from app.models import Post, Category, Tag, PostTag, User, TrendingScore
+from app.pagination import SortKey
+from app import search as post_search
+from app import archive as post_archive
+
+# Sort orders of the post listings
+SORT_ORDERS = ("created_at", "popularity", "trending")
+
+
+def posts_tagged(tag_name):
+    """Subquery selecting the ids of the posts carrying the given tag."""
+    return PostTag.select(PostTag.post).join(Tag).where(Tag.name == tag_name)
+
+
+def authors_matching(username):
+    """Subquery selecting the ids of the users whose username contains the text."""
+    return User.select(User.id).where(User.username.contains(username))
+
+
+def filter_posts(posts, query="", category=None, author=None, tags=(), author_id=None):
+    """
+    Apply the filters of the homepage (and of the feed API) to a Post query.
+    :param posts: Post select query.
+    :param query: Search box text. A prefix selects the kind of search: `#tag`,
+        `@author`, `>words` (title and content only), `month:December 2024`,
+        `popularity:4`; anything else is a full-text search.
+    :param category: Category name.
+    :param author: Text contained in the author's username.
+    :param tags: Tag names, all of which the posts must carry.
+    :param author_id: Id of the author, e.g. selected in the author facet.
+    :return: (posts, ranked) where ranked tells whether a full-text search was
+        applied, so the results can be ordered by relevance.
+    """
+    ranked = False
+
+    if query:
+        # Tag filtering: if query starts with #
+        if query.startswith("#"):
+            tag = query[1:]  # Extract the tag name
+            posts = posts.where(Post.id.in_(posts_tagged(tag)))
+        # Author filtering: if query starts with @
+        elif query.startswith("@"):
+            author_name = query[1:]
+            posts = posts.where(Post.author.in_(authors_matching(author_name)))
+        # Search in title/content
+        elif query.startswith(">"):
+            posts, ranked = post_search.search_posts(
+                posts, query[1:], columns=post_search.POST_TEXT_COLUMNS
+            )
+        # Search by month, e.g. month:December 2024 (a created_at range, see archive.py)
+        elif query.startswith("month:"):
+            year_month = post_archive.parse_month(query.split(":", 1)[1])
+            if year_month:
+                posts = posts.where(post_archive.in_month(*year_month))
+            # Invalid month, no filtering applied
+        # Search by popularity
+        elif query.startswith("popularity:"):
+            try:
+                popularity_score = float(query.split(":", 1)[1])
+                posts = posts.where(
+                    (Post.rating_count > 0) & (Post.rating_avg >= popularity_score)
+                )  # Filter by popularity score
+            except ValueError:
+                pass  # Invalid popularity scale, no filtering applied
+        # Default search (full-text search over title, content, category and tags)
+        else:
+            posts, ranked = post_search.search_posts(posts, query)
+
+    # Category and author filters given directly (without prefix in the query).
+    # These are subqueries rather than joins so that they combine with any of the above
+    if category:
+        posts = posts.where(
+            Post.category.in_(Category.select(Category.id).where(Category.name == category))
+        )
+    if author:
+        posts = posts.where(Post.author.in_(authors_matching(author)))
+    if author_id:
+        posts = posts.where(Post.author == author_id)
+
+    for tag in tags:
+        posts = posts.where(Post.id.in_(posts_tagged(tag)))
+
+    return posts, ranked
+
+
+def sort_posts(posts, sort_by="created_at", by_relevance=False):
+    """
+    Order a filtered Post query for keyset pagination.
+    :param posts: Post query returned by filter_posts().
+    :param sort_by: One of SORT_ORDERS; anything else sorts by creation date.
+    :param by_relevance: Order full-text search results by bm25 instead.
+    :return: (posts, sort_keys) to pass to paginate_keyset(). The last sort key is
+        always the (unique) post id.
+    """
+    id_key = SortKey(Post.id, "id", True)
+    if sort_by == "popularity":
+        # Only rated posts are ranked, ordered by their stored average rating
+        posts = posts.where(Post.rating_count > 0)
+        sort_keys = [SortKey(Post.rating_avg, "rating_avg", True)]
+    elif sort_by == "trending":
+        # Only the recently active posts have a score (see trending.py). The post id
+        # is taken from the score table, so the whole order comes from its index.
+        # "+ 0" keeps SQLite from looking scores up by post id, so the score index
+        # drives the join even when the statistics (ANALYZE) predate the table.
+        posts = posts.join(
+            TrendingScore, on=(TrendingScore.post + 0 == Post.id), attr="trending"
+        ).select_extend(TrendingScore.score)
+        # Trending cursors are approximate: a sweep rewrites every score and a rescore
+        # moves a post, so the next page can skip or repeat the posts that moved
+        # across the cursor in between.
+        sort_keys = [SortKey(TrendingScore.score, "trending.score", True)]
+        id_key = SortKey(TrendingScore.post, "id", True)
+    elif by_relevance:
+        rank = post_search.rank()
+        posts = posts.select_extend(rank.alias("search_rank"))
+        sort_keys = [SortKey(rank, "search_rank", False)]
+    else:
+        sort_keys = [SortKey(Post.created_at, "created_at", True)]
+    sort_keys.append(id_key)
+    return posts, sort_keys
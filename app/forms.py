@@ -73,3 +73,13 @@ class ProfilePictureForm(FlaskForm):
         ],
     )
     submit = SubmitField("Upload")
+
+
+class PurgeForm(FlaskForm):
+    """
+    Form used by admins to delete a user or a tag with all its posts, comments and ratings.
+    """
+
+    kind = SelectField("Purge", choices=[("user", "User"), ("tag", "Tag")])
+    name = StringField("Username or tag", validators=[DataRequired(), Length(max=255)])
+    submit = SubmitField("Purge")
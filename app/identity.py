@@ -0,0 +1,176 @@
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict
+
+from flask import has_request_context, session
+from flask_login import current_user
+
+from app.models import User
+
+# Session key holding the auth version of the logged-in user
+SESSION_KEY = "_auth_version"
+
+
+class IdentityCache:
+    """
+    Bounded, thread-safe LRU cache of user snapshots (their column values) keyed by
+    user id. A snapshot is only served for the auth version and change stamp (see
+    ChangeStamps) it was stored with, so it's refreshed as soon as a session
+    carries a newer version or a server worker commits a change to the user.
+    Snapshots also expire after `ttl` seconds, which bounds how long a change made
+    by a process that doesn't share the stamps (e.g. a `flask purge` command) goes
+    unnoticed.
+    """
+
+    def __init__(self, max_entries=1024, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._stale = 0
+
+    def get(self, user_id, version, stamp=0):
+        """
+        Return the snapshot of a user if it was stored for this auth version and
+        change stamp.
+        """
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                self._misses += 1
+                return None
+            if entry[0] != (version, stamp) or time.monotonic() - entry[1] > self.ttl:
+                del self._entries[user_id]
+                self._stale += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self._hits += 1
+            return entry[2]
+
+    def put(self, user_id, version, data, stamp=0):
+        with self._lock:
+            self._entries[user_id] = ((version, stamp), time.monotonic(), data)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def forget(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Hit-rate counters."""
+        with self._lock:
+            lookups = self._hits + self._misses + self._stale
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self._hits,
+                "misses": self._misses,
+                "stale": self._stale,
+                "hit_rate": round(self._hits / lookups, 4) if lookups else 0,
+            }
+
+
+class ChangeStamps:
+    """
+    Change counters of the users, in memory shared with the processes forked from
+    this one, i.e. the workers of `flask serve`. A user's counter is bumped once a
+    change to them is committed, so the snapshots the other workers cached before
+    are no longer served, without a query per request. Users share counters
+    modulo `size`, which only costs an occasional reload.
+    """
+
+    def __init__(self, size=4096):
+        self._counters = multiprocessing.Array("q", size)
+
+    def get(self, user_id):
+        # Reading one aligned integer needs no lock
+        return self._counters.get_obj()[user_id % len(self._counters)]
+
+    def bump(self, user_id):
+        with self._counters.get_lock():
+            self._counters.get_obj()[user_id % len(self._counters)] += 1
+
+
+# Shared identity cache used by load_user(), and the stamps of its snapshots.
+# The stamps are created on import, before `flask serve` forks its workers.
+identity_cache = IdentityCache()
+change_stamps = ChangeStamps()
+
+
+def _snapshot(user):
+    return dict(user.__data__)
+
+
+def _from_snapshot(data):
+    # A new instance per request, so a request changing its user can't affect others
+    user = User(__no_default__=True, **data)
+    user._dirty.clear()
+    return user
+
+
+def remember(user, stamp=None):
+    """
+    Cache a user and store their auth version in the session. Call after
+    login_user() and whenever the logged-in user was loaded from the database.
+    :param stamp: Change stamp of the user read before loading them, if known.
+    """
+    if stamp is None:
+        stamp = change_stamps.get(user.id)
+    identity_cache.put(user.id, user.auth_version, _snapshot(user), stamp)
+    if session.get(SESSION_KEY) != user.auth_version:
+        session[SESSION_KEY] = user.auth_version
+
+
+def load_user(user_id):
+    """
+    Load the logged-in user, from the identity cache when the session's auth
+    version and the user's change stamp match the cached ones, without a query.
+    :return: User object or None if not found or deactivated.
+    """
+    user_id = int(user_id)
+    version = session.get(SESSION_KEY)
+    # Read before loading, so a change committed meanwhile can't be cached as current
+    stamp = change_stamps.get(user_id)
+    if version is not None:
+        data = identity_cache.get(user_id, version, stamp)
+        if data is not None:
+            return _from_snapshot(data)
+
+    user = User.get_or_none(User.id == user_id)
+    if user is None or not user.is_active:
+        return None  # e.g. a user being purged is logged out
+    remember(user, stamp)
+    return user
+
+
+def touch_user(user_id):
+    """
+    Bump the auth version of a user whose profile, role, password or is_active
+    changed. Call inside the transaction writing the change, then forget_user()
+    once it is committed. The session of the current user gets the new version,
+    so their next request loads the change.
+    :return: The new auth version.
+    """
+    User.update(auth_version=User.auth_version + 1).where(User.id == user_id).execute()
+    version = User.select(User.auth_version).where(User.id == user_id).scalar()
+    if has_request_context() and current_user.is_authenticated and current_user.id == user_id:
+        session[SESSION_KEY] = version
+    return version
+
+
+def forget_user(user_id):
+    """
+    Drop the cached snapshot of a user, once the change is committed, in this
+    process and in the other workers of the server.
+    """
+    identity_cache.forget(user_id)
+    change_stamps.bump(user_id)
@@ -0,0 +1,255 @@
+import glob
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageOps
+
+from app.database import db
+from app.models import Post, User
+from app import caching
+from app import identity
+
+logger = logging.getLogger(__name__)
+
+# Width bounds of the generated variants, smallest first. Images are never upscaled.
+VARIANT_WIDTHS = {"thumb": 320, "card": 640, "full": 1280}
+
+# Sub-folder of the upload folder the variants are written to
+VARIANTS_FOLDER = "variants"
+
+JPEG_QUALITY = 82
+WEBP_QUALITY = 80
+
+
+def build_variants(upload_folder, filename):
+    """
+    Write the width-bounded JPEG and WebP variants of an uploaded image.
+    Runs in a worker process, so it only touches the filesystem.
+    :param upload_folder: Absolute path of the upload folder.
+    :param filename: Path of the original, relative to the upload folder.
+    :return: Metadata to store with the image, e.g.
+        {"width": 1920, "height": 1080, "variants": [
+            {"name": "thumb", "width": 320, "height": 180,
+             "jpeg": "variants/photo-320.jpg", "webp": "variants/photo-320.webp"}, ...]}
+    """
+    stem = os.path.splitext(filename)[0]
+
+    with Image.open(os.path.join(upload_folder, filename)) as original:
+        # Apply the EXIF orientation, since the variants are saved without EXIF
+        image = ImageOps.exif_transpose(original)
+        if image.mode in ("RGBA", "LA", "P"):
+            # JPEG has no transparency; flatten onto white instead of black
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, "white")
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        elif image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        width, height = image.size
+
+        variants = []
+        for name, bound in VARIANT_WIDTHS.items():
+            target = min(bound, width)
+            resized = image.resize(
+                (target, max(1, round(height * target / width))), Image.LANCZOS
+            )
+            paths = {
+                "jpeg": f"{VARIANTS_FOLDER}/{stem}-{target}.jpg",
+                "webp": f"{VARIANTS_FOLDER}/{stem}-{target}.webp",
+            }
+            _save(
+                resized,
+                os.path.join(upload_folder, paths["jpeg"]),
+                "JPEG",
+                quality=JPEG_QUALITY,
+                optimize=True,
+                progressive=True,
+            )
+            _save(
+                resized,
+                os.path.join(upload_folder, paths["webp"]),
+                "WEBP",
+                quality=WEBP_QUALITY,
+                method=4,
+            )
+            variants.append(
+                {"name": name, "width": resized.width, "height": resized.height, **paths}
+            )
+            if bound >= width:
+                break  # Larger variants would only repeat the original size
+
+    return {"width": width, "height": height, "variants": variants}
+
+
+def _save(image, path, *args, **kwargs):
+    """
+    Save an image, creating its folder. The folder is created again if it was
+    deleted in between, as storage.remove_file() deletes the emptied shard folders.
+    """
+    for attempt in range(2):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            return image.save(path, *args, **kwargs)
+        except FileNotFoundError:
+            if attempt:
+                raise
+
+
+class ImagePipeline:
+    """
+    Background process pool generating image variants. Resizing and encoding are
+    CPU-bound, so they run in separate processes instead of on request threads.
+    """
+
+    def __init__(self, workers=2):
+        self.workers = workers
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        # A pool can't be shared with forked server workers, so each process gets its own
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                # Workers only run build_variants(), so they never use the database
+                # connections or locks inherited from the server process
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                self._pid = os.getpid()
+            return self._executor
+
+    def submit(self, upload_folder, filename, on_done):
+        """
+        Generate the variants of an image in the background.
+        :param upload_folder: Absolute path of the upload folder.
+        :param filename: Path of the original, relative to the upload folder.
+        :param on_done: Called with the metadata when the variants are written.
+            It runs on a background thread of this process.
+        :return: Future of the metadata.
+        """
+        future = self._get_executor().submit(build_variants, upload_folder, filename)
+
+        def callback(done):
+            try:
+                on_done(done.result())
+            except Exception:
+                logger.exception("Generating the variants of %s failed", filename)
+
+        future.add_done_callback(callback)
+        return future
+
+    def map(self, upload_folder, filenames):
+        """
+        Generate the variants of many images using every worker, for batch jobs.
+        :return: Iterator of (filename, metadata or exception), in order.
+        """
+        executor = self._get_executor()
+        futures = [(name, executor.submit(build_variants, upload_folder, name)) for name in filenames]
+        for name, future in futures:
+            try:
+                yield name, future.result()
+            except Exception as e:
+                yield name, e
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown()
+            self._executor = None
+
+
+# Shared pipeline used by the routes
+image_pipeline = ImagePipeline()
+
+
+def _store_post_variants(post_id, filename, metadata):
+    updated = (
+        Post.update(image_variants=metadata)
+        .where((Post.id == post_id) & (Post.image == filename))
+        .execute()
+    )
+    if updated:
+        caching.invalidate_post(post_id)  # Cached pages don't have the srcset yet
+
+
+def _store_profile_picture_variants(user_id, filename, metadata):
+    updated = (
+        User.update(profile_picture_variants=metadata, auth_version=User.auth_version + 1)
+        .where((User.id == user_id) & (User.profile_picture == filename))
+        .execute()
+    )
+    if updated:
+        identity.forget_user(user_id)
+        caching.invalidate_feed()  # The feed shows the author pictures
+
+
+def _process(upload_folder, filename, store):
+    # Stored files are deduplicated, so the same file may already have variants
+    metadata = known_variants(filename)
+    if metadata:
+        store(metadata)
+        return None
+
+    def store_in_background(metadata):
+        with db.connection_context():
+            store(metadata)
+
+    return image_pipeline.submit(upload_folder, filename, store_in_background)
+
+
+def process_post_image(upload_folder, post_id, filename):
+    """
+    Generate the variants of a post image in the background and store their
+    metadata on the post, unless the image was replaced in the meantime.
+    :return: Future of the metadata, or None if the variants already existed.
+    """
+    return _process(
+        upload_folder,
+        filename,
+        lambda metadata: _store_post_variants(post_id, filename, metadata),
+    )
+
+
+def process_profile_picture(upload_folder, user_id, filename):
+    """
+    Generate the variants of a profile picture in the background and store their
+    metadata on the user, unless the picture was replaced in the meantime.
+    :return: Future of the metadata, or None if the variants already existed.
+    """
+    return _process(
+        upload_folder,
+        filename,
+        lambda metadata: _store_profile_picture_variants(user_id, filename, metadata),
+    )
+
+
+def variant_paths(upload_folder, filename):
+    """Paths (relative to the upload folder) of the variant files of an image."""
+    stem = os.path.splitext(filename)[0]
+    pattern = os.path.join(upload_folder, VARIANTS_FOLDER, glob.escape(stem) + "-*")
+    return [
+        os.path.relpath(path, upload_folder).replace(os.sep, "/")
+        for path in glob.glob(pattern)
+        if os.path.splitext(path)[0].rsplit("-", 1)[1].isdigit()
+    ]
+
+
+def known_variants(filename):
+    """
+    Variants already generated for a stored file, from any post or user using it.
+    :return: The metadata, or None.
+    """
+    for model, field, variants in (
+        (Post, Post.image, Post.image_variants),
+        (User, User.profile_picture, User.profile_picture_variants),
+    ):
+        metadata = (
+            model.select(variants)
+            .where((field == filename) & variants.is_null(False))
+            .limit(1)
+            .scalar()
+        )
+        if metadata:
+            return metadata
+    return None
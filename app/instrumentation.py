@@ -0,0 +1,141 @@
+import logging
+import threading
+import time
+
+from flask import g, has_request_context, before_render_template, template_rendered
+
+from app.database import db
+
+logger = logging.getLogger(__name__)
+
+# Statements worth an EXPLAIN QUERY PLAN in the slow-query log
+_EXPLAINABLE = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE", "REPLACE")
+
+
+class RequestTimings:
+    """Queries, SQL time and template render time of one request."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.sql = 0.0
+        self.render = 0.0
+        self._rendering = []
+
+    def server_timing(self):
+        """
+        Value of the Server-Timing header, durations in milliseconds, e.g.
+        'sql;desc="3 queries";dur=1.20, render;dur=4.51, total;dur=7.03'.
+        SQL run while rendering (e.g. lazy loads in templates) is in both sql and render.
+        """
+        total = time.perf_counter() - self.started
+        return (
+            f'sql;desc="{self.queries} queries";dur={self.sql * 1000:.2f}, '
+            f"render;dur={self.render * 1000:.2f}, total;dur={total * 1000:.2f}"
+        )
+
+
+class Instrumentation:
+    """
+    Per-request instrumentation: counts the queries, the SQL time and the Jinja
+    render time of each request, sends them in a Server-Timing header, and logs
+    the queries slower than a threshold with their parameters and query plan.
+    """
+
+    def __init__(self, slow_query_ms=250, server_timing=True):
+        self.slow_query_ms = slow_query_ms
+        self.server_timing = server_timing
+        self._listening = False
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._queries = 0
+        self._slow_queries = 0
+
+    def init_app(self, app):
+        self.slow_query_ms = app.config["SLOW_QUERY_MS"]
+        self.server_timing = app.config["SERVER_TIMING"]
+        if not self._listening:
+            # The database is shared by every app, the listener is added once
+            db.on_query(self._on_query)
+            self._listening = True
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        before_render_template.connect(self._start_render, app)
+        template_rendered.connect(self._finish_render, app)
+
+    def _start_request(self):
+        g.timings = RequestTimings()
+
+    def _finish_request(self, response):
+        timings = g.pop("timings", None)
+        if timings is None:
+            return response
+        with self._lock:
+            self._requests += 1
+            self._queries += timings.queries
+        if self.server_timing:
+            response.headers["Server-Timing"] = timings.server_timing()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s: %s", response.status, timings.server_timing())
+        return response
+
+    def _start_render(self, sender, template, context, **extra):
+        timings = g.get("timings")
+        if timings is not None:
+            timings._rendering.append(time.perf_counter())
+
+    def _finish_render(self, sender, template, context, **extra):
+        timings = g.get("timings")
+        if timings is not None and timings._rendering:
+            started = timings._rendering.pop()
+            if not timings._rendering:  # Nested renders are part of the outer one
+                timings.render += time.perf_counter() - started
+
+    def _on_query(self, sql, params, seconds):
+        # Queries outside requests (writer thread, CLI commands) are only checked
+        # for slowness
+        if has_request_context():
+            timings = g.get("timings")
+            if timings is not None:
+                timings.queries += 1
+                timings.sql += seconds
+        if self.slow_query_ms and seconds * 1000 >= self.slow_query_ms:
+            with self._lock:
+                self._slow_queries += 1
+            self._log_slow_query(sql, params, seconds)
+
+    def _log_slow_query(self, sql, params, seconds):
+        if not logger.isEnabledFor(logging.WARNING):
+            return
+        plan = ""
+        if sql.lstrip().upper().startswith(_EXPLAINABLE):
+            from app.schema import explain_sql
+
+            try:
+                plan = "\n".join("  " + step for step in explain_sql(sql, params))
+            except Exception as e:
+                plan = f"  (no plan: {e})"
+        logger.warning(
+            "Slow query (%.1f ms): %s\nParameters: %r\nQuery plan:\n%s",
+            seconds * 1000,
+            sql,
+            params,
+            plan,
+        )
+
+    def stats(self):
+        """Query counters since the start of the process."""
+        with self._lock:
+            return {
+                "requests": self._requests,
+                "queries": self._queries,
+                "queries_per_request": (
+                    round(self._queries / self._requests, 2) if self._requests else 0
+                ),
+                "slow_queries": self._slow_queries,
+                "slow_query_ms": self.slow_query_ms,
+            }
+
+
+# Shared instrumentation of the app's database
+instrumentation = Instrumentation()
@@ -0,0 +1,97 @@
+from collections import defaultdict
+
+from peewee import JOIN
+
+from app.models import User, Post, Category, Tag, PostTag, Comment, Rating
+from app.pagination import SortKey, paginate_keyset
+
+
+# Loaders fetch the related rows a template touches (authors, categories, tags,
+# comment authors) up front, with joins for to-one relations and batched queries
+# for to-many relations. Without them every `post.author` or `comment.author` in a
+# loop costs one more query.
+
+
+def with_post_relations(query):
+    """
+    Join the author and category of each post into a Post query, so that
+    `post.author` and `post.category` are populated from the same row.
+    :param query: Post select query.
+    :return: The query with the author and category selected alongside each post.
+    """
+    return (
+        query.select_extend(User, Category)
+        .switch(Post)
+        .join(User, on=(Post.author == User.id))
+        .switch(Post)
+        .join(Category, JOIN.LEFT_OUTER, on=(Post.category == Category.id))
+    )
+
+
+def attach_tag_names(posts):
+    """
+    Load the tag names of a list of posts with a single query and cache them on
+    each post, where they are returned by `post.tag_names`.
+    :param posts: List of Post objects.
+    :return: The same list of posts.
+    """
+    tag_names = defaultdict(list)
+    if posts:
+        rows = (
+            PostTag.select(PostTag.post, Tag.name)
+            .join(Tag)
+            .where(PostTag.post.in_([post.id for post in posts]))
+            .order_by(Tag.name)
+            .tuples()
+        )
+        for post_id, name in rows:
+            tag_names[post_id].append(name)
+
+    for post in posts:
+        post.tag_names = tag_names[post.id]
+    return posts
+
+
+def load_post(post_id):
+    """
+    Load a single post with its author, category and tag names, in two queries.
+    Its comments are loaded a page at a time by load_comments().
+    :param post_id: Id of the post.
+    :return: Post object or None if not found.
+    """
+    posts = list(with_post_relations(Post.select()).where(Post.id == post_id))
+    if not posts:
+        return None
+    return attach_tag_names(posts)[0]
+
+
+def load_comments(post_id, per_page, after=None):
+    """
+    Load one page of the comments of a post, oldest first, with their authors.
+    Pages are fetched with keyset pagination over the (post, created_at, id) index,
+    so a page deep into a long discussion costs the same as the first one.
+    :param post_id: Id of the post.
+    :param per_page: Number of comments per page.
+    :param after: Cursor of the last comment of the previous page.
+    :return: KeysetPage of Comment objects with `comment.author` populated.
+    """
+    return paginate_keyset(
+        Comment.select(Comment, User).join(User).where(Comment.post == post_id),
+        [SortKey(Comment.created_at, "created_at", False), SortKey(Comment.id, "id", False)],
+        per_page=per_page,
+        after=after,
+    )
+
+
+def load_user_ratings(user):
+    """
+    Load the ratings a user has given, each with the rated post.
+    :param user: The user object.
+    :return: List of Rating objects with `rating.post` populated.
+    """
+    return list(
+        Rating.select(Rating, Post)
+        .join(Post)
+        .where(Rating.user == user)
+        .order_by(Rating.created_at.desc())
+    )
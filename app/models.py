@@ -1,4 +1,5 @@
 from peewee import *
+from playhouse.sqlite_ext import FTS5Model, SearchField, JSONField
 from app.database import db
 import datetime
 from flask_login import UserMixin
@@ -27,10 +28,15 @@ class User(UserMixin, BaseModel):
     role = CharField(default="user")  # Default role is 'user', can be 'admin'
     bio = TextField(null=True)  # Bio is optional for the user
     profile_picture = CharField(null=True)  # Optional profile picture
+    # Resized variants of the profile picture, see app/images.py
+    profile_picture_variants = JSONField(null=True)
     created_at = DateTimeField(
         default=datetime.datetime.utcnow
     )  # Store creation time in UTC
     is_active = BooleanField(default=True)  # User is active by default
+    # Bumped whenever the profile, role, password or is_active changes, so cached
+    # copies of the user are refreshed (see app/identity.py)
+    auth_version = IntegerField(default=0)
 
 
 # Category Model
@@ -59,24 +65,55 @@ class Post(BaseModel):
 
     title = CharField(max_length=255)
     content = TextField()
+    content_html = TextField(null=True)  # content rendered from Markdown on save
+    content_html_version = CharField(null=True)  # Renderer that produced content_html
+    # Indexed by the composite indexes in Meta
     author = ForeignKeyField(
-        User, backref="posts", on_delete="CASCADE"
+        User, backref="posts", on_delete="CASCADE", index=False
     )  # Each post has an author
     category = ForeignKeyField(
-        Category, backref="posts", on_delete="CASCADE"
+        Category, backref="posts", on_delete="CASCADE", index=False
     )  # Each post belongs to a category
     image = CharField(null=True)  # Optional image associated with the post
+    image_variants = JSONField(null=True)  # Resized variants of the image, see app/images.py
     created_at = DateTimeField(default=datetime.datetime.utcnow)  # Creation time in UTC
     updated_at = DateTimeField(
         default=datetime.datetime.utcnow
     )  # Last updated time in UTC
+    # Last time the post, its comments or its ratings changed (UTC); page cache validator
+    changed_at = DateTimeField(default=datetime.datetime.utcnow)
+
+    # Rating aggregates, maintained by Rating.refresh_aggregates() when the write-behind
+    # queue (WriteBehindQueue._write) writes ratings, in the same transaction
+    rating_count = IntegerField(default=0)  # Number of ratings
+    rating_sum = IntegerField(default=0)  # Sum of all rating values
+    rating_avg = FloatField(default=0)  # rating_sum / rating_count, stored for indexing
+    # Number of comments, maintained by Comment.refresh_counts() when comments are written
+    comment_count = IntegerField(default=0)
+
+    class Meta:
+        indexes = (
+            (("created_at", "id"), False),  # Keyset pagination of the feed
+            (("rating_avg", "id"), False),  # Popularity ordering
+            (("author", "created_at"), False),  # Posts of a user profile, newest first
+            (("category", "created_at", "id"), False),  # Feed filtered by category
+        )
 
     @property
     def tag_names(self):
         """
         Property to access the tag names directly for a post.
+        Uses the names cached by app.loaders.attach_tag_names() when available.
         """
-        return [tag.name for tag in self.tags]  # Access the tags directly
+        cached = getattr(self, "_tag_names", None)
+        if cached is None:
+            cached = [post_tag.tag.name for post_tag in self.tags.join(Tag)]
+            self._tag_names = cached
+        return cached
+
+    @tag_names.setter
+    def tag_names(self, names):
+        self._tag_names = names
 
 
 # PostTag Model - Define it after the Post model is fully defined
@@ -85,11 +122,14 @@ class PostTag(BaseModel):
     Join model to establish a many-to-many relationship between posts and tags.
     """
 
-    post = ForeignKeyField(Post, backref="tags", on_delete="CASCADE")  # Link to Post
-    tag = ForeignKeyField(Tag, backref="posts", on_delete="CASCADE")  # Link to Tag
+    # The composite key and the (tag, post) index below cover both foreign keys
+    post = ForeignKeyField(Post, backref="tags", on_delete="CASCADE", index=False)
+    tag = ForeignKeyField(Tag, backref="posts", on_delete="CASCADE", index=False)
 
     class Meta:
-        primary_key = False  # Composite primary key to ensure no duplicate entries for the same post/tag
+        # A post carries each tag once; also serves lookups of a post's tags
+        primary_key = CompositeKey("post", "tag")
+        indexes = ((("tag", "post"), False),)  # Posts carrying a tag, for #tag filters
 
 
 # Comment Model
@@ -101,7 +141,7 @@ class Comment(BaseModel):
 
     content = TextField()
     post = ForeignKeyField(
-        Post, backref="comments", on_delete="CASCADE"
+        Post, backref="comments", on_delete="CASCADE", index=False
     )  # Link to the post
     author = ForeignKeyField(
         User, backref="comments", on_delete="CASCADE"
@@ -110,6 +150,23 @@ class Comment(BaseModel):
         default=datetime.datetime.utcnow
     )  # Time when the comment was created
 
+    class Meta:
+        indexes = (
+            (("post", "created_at", "id"), False),  # Comments of a post, oldest first
+        )
+
+    @classmethod
+    def refresh_counts(cls, post_ids=None):
+        """
+        Recompute the comment count stored on the given posts, with a single UPDATE.
+        :param post_ids: Ids of the posts whose comments changed, or None for all posts.
+        """
+        count = cls.select(fn.COUNT(cls.id)).where(cls.post == Post.id)
+        query = Post.update(comment_count=count)
+        if post_ids is not None:
+            query = query.where(Post.id.in_(list(post_ids)))
+        query.execute()
+
 
 # Rating Model
 class Rating(BaseModel):
@@ -118,11 +175,12 @@ class Rating(BaseModel):
     The rating is between 1 and 5.
     """
 
+    # Indexed by the composite indexes in Meta
     post = ForeignKeyField(
-        Post, backref="ratings", on_delete="CASCADE"
+        Post, backref="ratings", on_delete="CASCADE", index=False
     )  # Link to the post
     user = ForeignKeyField(
-        User, backref="ratings", on_delete="CASCADE"
+        User, backref="ratings", on_delete="CASCADE", index=False
     )  # Link to the user who made the rating
     rating = IntegerField(
         constraints=[Check("rating BETWEEN 1 AND 5")]
@@ -132,19 +190,66 @@ class Rating(BaseModel):
     class Meta:
         indexes = (
             (("post", "user"), True),  # Ensures a user can rate a post only once
+            (("user", "created_at"), False),  # Ratings of a user profile, newest first
         )
 
     @classmethod
     def average_rating(cls, post):
         """
-        Calculate the average rating for a given post.
+        Average rating for a given post, read from the aggregates stored on the post.
         :param post: The post object to calculate average for.
         :return: Average rating (0 if no ratings exist).
         """
-        avg = cls.select(fn.AVG(cls.rating)).where(cls.post == post).scalar()
-
         # If there are no ratings yet, return a default value (0)
-        return avg if avg is not None else 0
+        return post.rating_avg if post.rating_count else 0
+
+    @classmethod
+    def refresh_aggregates(cls, post_ids):
+        """
+        Recompute the rating aggregates stored on the given posts from their ratings,
+        with a single UPDATE. Used after bulk rating writes.
+        :param post_ids: Ids of the posts whose ratings changed.
+        """
+        count = cls.select(fn.COUNT(cls.id)).where(cls.post == Post.id)
+        total = cls.select(fn.COALESCE(fn.SUM(cls.rating), 0)).where(cls.post == Post.id)
+        average = cls.select(fn.COALESCE(fn.AVG(cls.rating), 0)).where(cls.post == Post.id)
+        Post.update(
+            rating_count=count, rating_sum=total, rating_avg=average
+        ).where(Post.id.in_(list(post_ids))).execute()
+
+    @classmethod
+    def reconcile_aggregates(cls, fix=False):
+        """
+        Recompute the rating aggregates of every post from the Rating table and
+        compare them with the stored values.
+        :param fix: Overwrite the stored aggregates of the posts that drifted.
+        :return: List of (post_id, stored (count, sum), actual (count, sum)) for each
+            post whose stored aggregates differ.
+        """
+        actual = (
+            cls.select(cls.post, fn.COUNT(cls.id), fn.SUM(cls.rating))
+            .group_by(cls.post)
+            .tuples()
+        )
+        actual = {post_id: (count, total) for post_id, count, total in actual}
+        stored = Post.select(Post.id, Post.rating_count, Post.rating_sum).tuples()
+
+        drift = []
+        for post_id, count, total in stored:
+            expected = actual.get(post_id, (0, 0))
+            if (count, total) != expected:
+                drift.append((post_id, (count, total), expected))
+
+        if fix:
+            with cls._meta.database.atomic():
+                for post_id, _, (count, total) in drift:
+                    Post.update(
+                        rating_count=count,
+                        rating_sum=total,
+                        rating_avg=total / count if count else 0,
+                    ).where(Post.id == post_id).execute()
+
+        return drift
 
     @classmethod
     def user_rating(cls, post, user):
@@ -156,3 +261,310 @@ class Rating(BaseModel):
         """
         rating = cls.get_or_none((cls.post == post.id) & (cls.user == user.id))
         return rating.rating if rating else None
+
+
+# Change stamps
+class ChangeStamp(BaseModel):
+    """
+    Named version counters for content that spans many rows, e.g. the homepage feed.
+    Bumped whenever that content changes, so HTTP validators and caches can tell
+    whether it changed with a single primary key lookup.
+    """
+
+    name = CharField(primary_key=True)
+    version = IntegerField(default=0)
+    changed_at = DateTimeField(default=datetime.datetime.utcnow)
+
+    @classmethod
+    def bump(cls, name):
+        """
+        Record a change of the named content.
+        :param name: Name of the stamp, e.g. "feed".
+        """
+        now = datetime.datetime.utcnow()
+        cls.insert(name=name, version=1, changed_at=now).on_conflict(
+            conflict_target=[cls.name],
+            update={cls.version: cls.version + 1, cls.changed_at: now},
+        ).execute()
+
+    @classmethod
+    def current(cls, name):
+        """
+        Current version of the named content.
+        :return: (version, changed_at); version 0 if it never changed.
+        """
+        stamp = cls.get_or_none(cls.name == name)
+        if stamp is None:
+            return 0, datetime.datetime(1970, 1, 1)
+        return stamp.version, stamp.changed_at
+
+
+class StoredFile(BaseModel):
+    """
+    An uploaded file in the content-addressed store (see app/storage.py), with the
+    number of Post.image and User.profile_picture values referencing it. Files whose
+    count drops to zero are garbage-collected.
+    """
+
+    path = CharField(primary_key=True)  # Relative to the upload folder
+    size = IntegerField()  # Bytes
+    ref_count = IntegerField(default=0)
+    created_at = DateTimeField(default=datetime.datetime.utcnow)
+
+    @classmethod
+    def acquire(cls, path, size):
+        """
+        Add a reference to a stored file, registering the file on first use.
+        Call in the transaction that saves the referencing row.
+        """
+        cls.insert(path=path, size=size, ref_count=1).on_conflict(
+            conflict_target=[cls.path],
+            update={cls.ref_count: cls.ref_count + 1},
+        ).execute()
+
+    @classmethod
+    def release(cls, path):
+        """
+        Drop a reference to a stored file. Paths outside the store are ignored.
+        Call in the transaction that removes or replaces the reference.
+        """
+        if path:
+            cls.update(ref_count=cls.ref_count - 1).where(cls.path == path).execute()
+
+    @classmethod
+    def reconcile_references(cls, fix=False):
+        """
+        Compare the stored reference counts with the actual references.
+        :param fix: Overwrite the counts that drifted.
+        :return: List of (path, stored count, actual count) for the drifted files.
+        """
+        actual = {}
+        for model, field in ((Post, Post.image), (User, User.profile_picture)):
+            query = (
+                model.select(field, fn.COUNT(SQL("*")))
+                .where(field.in_(cls.select(cls.path)))
+                .group_by(field)
+                .tuples()
+            )
+            for path, count in query:
+                actual[path] = actual.get(path, 0) + count
+
+        drift = [
+            (path, ref_count, actual.get(path, 0))
+            for path, ref_count in cls.select(cls.path, cls.ref_count).tuples()
+            if ref_count != actual.get(path, 0)
+        ]
+        if fix:
+            for path, _, count in drift:
+                cls.update(ref_count=count).where(cls.path == path).execute()
+        return drift
+
+
+class MonthlyPostCount(BaseModel):
+    """
+    Number of posts created in each calendar month (UTC), for the archive sidebar.
+    Maintained by adjust() in the transactions creating and deleting posts.
+    """
+
+    year = IntegerField()
+    month = IntegerField()
+    count = IntegerField(default=0)
+
+    class Meta:
+        primary_key = CompositeKey("year", "month")
+
+    @classmethod
+    def adjust(cls, created_at, delta):
+        """
+        Count posts created or deleted in the month of `created_at`.
+        :param created_at: Creation time of the posts.
+        :param delta: Number of posts created, negative for deleted posts.
+        """
+        cls.insert(year=created_at.year, month=created_at.month, count=delta).on_conflict(
+            conflict_target=[cls.year, cls.month],
+            update={cls.count: cls.count + delta},
+        ).execute()
+
+    @classmethod
+    def rebuild(cls):
+        """Recount the posts of every month from the Post table."""
+        cls.delete().execute()
+        year = fn.strftime("%Y", Post.created_at).cast("INTEGER")
+        month = fn.strftime("%m", Post.created_at).cast("INTEGER")
+        cls.insert_from(
+            Post.select(year, month, fn.COUNT(Post.id)).group_by(year, month),
+            [cls.year, cls.month, cls.count],
+        ).execute()
+
+
+class FacetCount(BaseModel):
+    """
+    Number of posts per category, tag and author, for the facet sidebar of the
+    unfiltered homepage (see app/facets.py). Maintained by adjust() and
+    adjust_post_tags() in the transactions writing posts and their tags.
+    """
+
+    facet = CharField()  # "category", "tag" or "author"
+    value = IntegerField()  # Id of the category, tag or user
+    count = IntegerField(default=0)
+
+    class Meta:
+        primary_key = CompositeKey("facet", "value")
+        indexes = ((("facet", "count"), False),)  # Top values of a facet
+
+    @classmethod
+    def adjust(cls, facet, values, delta):
+        """
+        Count posts added to or removed from facet values, with one statement.
+        :param facet: "category", "tag" or "author".
+        :param values: Ids of the values, repeated once per post; None (e.g. no
+            category) is skipped.
+        :param delta: Number of posts added, negative for removed posts.
+        """
+        rows = [{"facet": facet, "value": value, "count": delta} for value in values if value]
+        if rows:
+            cls.insert_many(rows).on_conflict(
+                conflict_target=[cls.facet, cls.value],
+                update={cls.count: cls.count + EXCLUDED.count},
+            ).execute()
+
+    @classmethod
+    def adjust_post_tags(cls, post_ids, delta):
+        """
+        Count posts added to (delta 1) or removed from (delta -1) each of their tags,
+        with one statement.
+        :param post_ids: Ids of the posts.
+        """
+        cls.insert_from(
+            PostTag.select(Value("tag"), PostTag.tag, fn.COUNT(PostTag.post) * delta)
+            .where(PostTag.post.in_(list(post_ids)))
+            .group_by(PostTag.tag),
+            [cls.facet, cls.value, cls.count],
+        ).on_conflict(
+            conflict_target=[cls.facet, cls.value],
+            update={cls.count: cls.count + EXCLUDED.count},
+        ).execute()
+
+    @classmethod
+    def rebuild(cls):
+        """Recount the posts of every category, tag and author."""
+        cls.delete().execute()
+        fields = [cls.facet, cls.value, cls.count]
+        for facet, column in (("category", Post.category), ("author", Post.author)):
+            cls.insert_from(
+                Post.select(Value(facet), column, fn.COUNT(Post.id))
+                .where(column.is_null(False))
+                .group_by(column),
+                fields,
+            ).execute()
+        cls.insert_from(
+            PostTag.select(Value("tag"), PostTag.tag, fn.COUNT(PostTag.post)).group_by(
+                PostTag.tag
+            ),
+            fields,
+        ).execute()
+
+
+class TrendingScore(BaseModel):
+    """
+    Materialized trending score of the recently active posts, maintained by
+    app/trending.py. Posts whose score decayed below the threshold have no row.
+    """
+
+    post = ForeignKeyField(Post, primary_key=True, backref="trending", on_delete="CASCADE")
+    score = FloatField()
+    computed_at = DateTimeField()  # Time the score is decayed to
+
+    class Meta:
+        # Top-N read of the trending feed, in keyset order
+        indexes = ((("score", "post"), False),)
+
+
+class ImportCheckpoint(BaseModel):
+    """
+    Progress of an import of an NDJSON export (see app/transfer.py), committed with
+    each chunk of rows, so an interrupted import resumes after the last chunk.
+    """
+
+    export_id = CharField(primary_key=True)  # From the header of the export
+    line = IntegerField(default=0)  # Last line of the file whose chunk is committed
+    completed = BooleanField(default=False)
+    updated_at = DateTimeField(default=datetime.datetime.utcnow)
+
+
+class ImportedRow(BaseModel):
+    """
+    Id given in this database to a user, category, tag or post of an imported export,
+    used to remap the foreign keys of the rows referencing it.
+    """
+
+    export_id = CharField()
+    kind = CharField()  # "user", "category", "tag" or "post"
+    old_id = IntegerField()  # Id in the exported database
+    new_id = IntegerField()
+
+    class Meta:
+        primary_key = CompositeKey("export_id", "kind", "old_id")
+
+
+class PurgeJob(BaseModel):
+    """
+    Deletion of the content of a user or tag, run in chunks in the background (see
+    app/purge.py). The progress is committed with each chunk, so admins can follow
+    it and a job interrupted by a restart resumes where it stopped.
+    """
+
+    kind = CharField()  # "user" or "tag"
+    target = IntegerField()  # Id of the user or tag
+    target_name = CharField()  # Username or tag name, kept once it's deleted
+    requested_by = CharField(null=True)  # Username of the admin
+    status = CharField(default="pending")  # "pending", "running", "done" or "failed"
+    stage = CharField(null=True)  # Step being run, e.g. "posts"
+    total = IntegerField(default=0)  # Posts, comments and ratings to delete
+    deleted = JSONField(default=dict)  # Rows deleted so far, per kind
+    error = TextField(null=True)
+    created_at = DateTimeField(default=datetime.datetime.utcnow)
+    started_at = DateTimeField(null=True)
+    # Updated with each chunk; a running job not updated for long was interrupted
+    updated_at = DateTimeField(default=datetime.datetime.utcnow)
+    finished_at = DateTimeField(null=True)
+
+    class Meta:
+        indexes = ((("status", "created_at"), False),)  # Next job to run
+
+    @property
+    def progress(self):
+        """Percentage of the posts, comments and ratings deleted."""
+        if self.status == "done":
+            return 100
+        done = sum(self.deleted.get(kind, 0) for kind in ("posts", "comments", "ratings"))
+        return min(99, int(100 * done / self.total)) if self.total else 0
+
+
+class SchemaMigration(BaseModel):
+    """
+    Schema migrations applied to the database (see app/schema.py). The highest
+    version is the version of the schema.
+    """
+
+    version = IntegerField(primary_key=True)
+    name = CharField()
+    applied_at = DateTimeField(default=datetime.datetime.utcnow)
+
+
+# Full-text search index
+class PostSearch(FTS5Model):
+    """
+    FTS5 index over the searchable text of a post. The rowid of each entry is the id
+    of the post it indexes, and the category and tag names are denormalized into it
+    so a single MATCH covers everything the homepage search looks at.
+    """
+
+    title = SearchField()
+    content = SearchField()
+    category = SearchField()
+    tags = SearchField()
+
+    class Meta:
+        database = db
+        options = {"tokenize": "porter unicode61"}
@@ -0,0 +1,142 @@
+import base64
+import binascii
+import datetime
+import json
+from collections import namedtuple
+from operator import attrgetter
+
+from peewee import Tuple
+
+
+# One column of a keyset sort order.
+# expression: the SQL expression the rows are ordered by.
+# attr: name of the attribute holding that value on each fetched row, dotted for
+#   a joined model, e.g. "trending.score".
+# descending: whether the column is sorted in descending order.
+SortKey = namedtuple("SortKey", ["expression", "attr", "descending"])
+
+
+class KeysetPage:
+    """
+    One page of results from paginate_keyset(), with the cursors needed to link to
+    the neighbouring pages.
+    """
+
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def encode_cursor(values):
+    """
+    Encode the sort key values of a row into an opaque, URL-safe cursor.
+    Datetimes are stored in the same text format SQLite stores them in, so the
+    decoded values compare correctly against the database columns.
+    """
+    values = [str(value) if isinstance(value, datetime.datetime) else value for value in values]
+    raw = json.dumps(values, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor, length):
+    """
+    Decode a cursor produced by encode_cursor().
+    :param cursor: Cursor string taken from the URL.
+    :param length: Number of sort keys the cursor must contain.
+    :return: List of values, or None if the cursor is missing or malformed.
+    """
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (binascii.Error, ValueError):
+        return None
+    if not isinstance(values, list) or len(values) != length:
+        return None
+    return values
+
+
+def _seek_condition(keys, values, forward):
+    """
+    Build the predicate selecting the rows that come after (forward=True) or before
+    (forward=False) the row with the given sort key values.
+    """
+    # A row value comparison lets SQLite seek straight into a matching index
+    if len({key.descending for key in keys}) == 1:
+        left = Tuple(*[key.expression for key in keys])
+        right = Tuple(*values)
+        if keys[0].descending == forward:
+            return left < right
+        return left > right
+
+    # Mixed directions: (k1 > v1) OR (k1 = v1 AND k2 < v2) OR ...
+    condition = None
+    for i, key in enumerate(keys):
+        if key.descending == forward:
+            term = key.expression < values[i]
+        else:
+            term = key.expression > values[i]
+        for previous, value in zip(keys[:i], values):
+            term = (previous.expression == value) & term
+        condition = term if condition is None else (condition | term)
+    return condition
+
+
+def _row_values(row, keys):
+    return [attrgetter(key.attr)(row) for key in keys]
+
+
+def paginate_keyset(query, keys, per_page, after=None, before=None, having=False):
+    """
+    Fetch one page of a query using keyset (seek) pagination. Unlike OFFSET based
+    pagination, every page costs the same because the database seeks directly to
+    the cursor position instead of counting past the earlier rows.
+    :param query: Select query to paginate. Any existing ordering is replaced.
+    :param keys: List of SortKey describing the sort order. The last key must be
+        unique (e.g. the primary key) so that the order is total.
+    :param per_page: Number of rows per page.
+    :param after: Cursor of the last row of the previous page (next page link).
+    :param before: Cursor of the first row of the following page (prev page link).
+    :param having: Apply the cursor predicate as HAVING, for keys that are aggregates.
+    :return: KeysetPage.
+    """
+    after_values = decode_cursor(after, len(keys))
+    before_values = decode_cursor(before, len(keys)) if after_values is None else None
+    forward = before_values is None
+    seek_values = after_values if forward else before_values
+
+    if seek_values is not None:
+        condition = _seek_condition(keys, seek_values, forward)
+        query = query.having(condition) if having else query.where(condition)
+
+    # Walking backwards, read the rows in reverse order and flip them afterwards
+    ordering = []
+    for key in keys:
+        descending = key.descending if forward else not key.descending
+        ordering.append(key.expression.desc() if descending else key.expression.asc())
+
+    rows = list(query.order_by(*ordering).limit(per_page + 1))
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if not forward:
+        rows.reverse()
+
+    if not rows:
+        return KeysetPage(rows)
+
+    next_cursor = prev_cursor = None
+    if has_more or not forward:
+        next_cursor = encode_cursor(_row_values(rows[-1], keys))
+    if (has_more and not forward) or (forward and seek_values is not None):
+        prev_cursor = encode_cursor(_row_values(rows[0], keys))
+    return KeysetPage(rows, next_cursor, prev_cursor)
@@ -0,0 +1,136 @@
+import collections
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask_bcrypt import Bcrypt
+
+
+class PasswordHasherBusy(Exception):
+    """No hashing thread became free within the queue timeout."""
+
+
+class PasswordHasher:
+    """
+    Bounded pool of threads hashing and checking passwords with bcrypt.
+
+    bcrypt is slow on purpose (hundreds of milliseconds at the default cost), and it
+    releases the GIL while it works, so running it on a few dedicated threads caps
+    the CPU a burst of logins or registrations can take from the other requests.
+    Requests wait for their result; a request whose job doesn't start within
+    `queue_timeout` seconds gets PasswordHasherBusy instead of waiting longer.
+    """
+
+    def __init__(self, workers=2, queue_timeout=5.0, rounds=12):
+        self.workers = workers
+        self.queue_timeout = queue_timeout
+        self.rounds = rounds
+        self._bcrypt = Bcrypt()
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        # Recent (queue wait, hash time) in seconds, for the percentiles
+        self._samples = collections.deque(maxlen=1000)
+        self._jobs = 0
+        self._busy = 0
+        self._rehashed = 0
+
+    def configure(self, workers=None, queue_timeout=None, rounds=None):
+        """Change the number of threads, the queue timeout (seconds) and the bcrypt cost."""
+        with self._lock:
+            if workers is not None and workers != self.workers:
+                self.workers = workers
+                if self._executor is not None:
+                    self._executor.shutdown(wait=False)
+                    self._executor = None
+        if queue_timeout is not None:
+            self.queue_timeout = queue_timeout
+        if rounds is not None:
+            self.rounds = rounds
+
+    def _get_executor(self):
+        # Threads don't survive fork(), so a forked worker starts its own pool
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="password-hash"
+                )
+                self._pid = os.getpid()
+            return self._executor
+
+    def _run(self, function, *args):
+        submitted = time.perf_counter()
+        started = threading.Event()
+        timings = {}
+
+        def job():
+            started.set()
+            timings["wait"] = time.perf_counter() - submitted
+            begin = time.perf_counter()
+            try:
+                return function(*args)
+            finally:
+                timings["hash"] = time.perf_counter() - begin
+
+        future = self._get_executor().submit(job)
+        if not started.wait(self.queue_timeout) and future.cancel():
+            with self._stats_lock:
+                self._busy += 1
+            raise PasswordHasherBusy()
+        result = future.result()
+        with self._stats_lock:
+            self._jobs += 1
+            self._samples.append((timings["wait"], timings["hash"]))
+        return result
+
+    def hash(self, password):
+        """
+        Hash a password at the configured cost.
+        :return: The bcrypt hash, as stored in User.password_hash.
+        :raise PasswordHasherBusy: If the pool is saturated.
+        """
+        return self._run(self._bcrypt.generate_password_hash, password, self.rounds).decode(
+            "utf-8"
+        )
+
+    def check(self, password_hash, password):
+        """
+        Check a password against its stored hash.
+        :raise PasswordHasherBusy: If the pool is saturated.
+        """
+        return self._run(self._bcrypt.check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """Whether a hash was made with another cost than the configured one."""
+        # bcrypt hashes look like $2b$12$<salt and hash>, 12 being the cost
+        parts = password_hash.split("$")
+        return len(parts) < 4 or not parts[2].isdigit() or int(parts[2]) != self.rounds
+
+    def record_rehash(self):
+        with self._stats_lock:
+            self._rehashed += 1
+
+    def stats(self):
+        """Hash latency and queue wait (milliseconds) counters over the recent jobs."""
+        with self._stats_lock:
+            samples = list(self._samples)
+            stats = {
+                "workers": self.workers,
+                "rounds": self.rounds,
+                "jobs": self._jobs,
+                "busy": self._busy,
+                "rehashed": self._rehashed,
+            }
+        for index, name in ((0, "wait"), (1, "hash")):
+            values = sorted(sample[index] for sample in samples)
+            count = len(values)
+            stats[f"avg_{name}_ms"] = round(sum(values) * 1000 / count, 3) if count else 0
+            stats[f"p95_{name}_ms"] = round(values[int(0.95 * (count - 1))] * 1000, 3) if count else 0
+            stats[f"max_{name}_ms"] = round(values[-1] * 1000, 3) if count else 0
+        return stats
+
+
+# Shared pool hashing the passwords of every request
+password_hasher = PasswordHasher()
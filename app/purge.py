@@ -0,0 +1,477 @@
+import datetime
+import logging
+import os
+import queue
+import threading
+import time
+from collections import Counter
+
+from peewee import fn
+
+from app.database import db
+from app.models import (
+    User,
+    Tag,
+    Post,
+    PostTag,
+    Comment,
+    Rating,
+    StoredFile,
+    MonthlyPostCount,
+    FacetCount,
+    TrendingScore,
+    PurgeJob,
+)
+from app import caching
+from app import identity
+from app import search
+from app import storage
+from app.trending import trending
+
+logger = logging.getLogger(__name__)
+
+# Steps of each kind of job, in order
+STAGES = {
+    "user": ["posts", "comments", "ratings", "account"],
+    "tag": ["posts", "tag"],
+}
+
+# Statuses of the jobs that still have work to do
+UNFINISHED = ("pending", "running")
+
+
+class PurgeError(Exception):
+    """A purge can't be requested, e.g. the user doesn't exist."""
+
+
+def delete_posts(post_ids):
+    """
+    Delete posts with their comments, ratings, tags, search index entries and
+    trending scores, updating the archive and facet counts and the references to
+    their images. Call inside a transaction; once it is committed, call
+    caching.forget_posts() with the ids and storage.collect_garbage() with the
+    returned paths.
+    :param post_ids: Ids of the posts.
+    :return: (dict of the number of deleted rows per kind, released image paths).
+    """
+    posts = list(
+        Post.select(Post.id, Post.author, Post.category, Post.image, Post.created_at).where(
+            Post.id.in_(list(post_ids))
+        )
+    )
+    if not posts:
+        return {}, []
+    ids = [post.id for post in posts]
+
+    FacetCount.adjust_post_tags(ids, -1)  # Before the tags are deleted
+    FacetCount.adjust("category", [post.category_id for post in posts], -1)
+    FacetCount.adjust("author", [post.author_id for post in posts], -1)
+    months = Counter(
+        datetime.datetime(post.created_at.year, post.created_at.month, 1) for post in posts
+    )
+    for month, count in months.items():
+        MonthlyPostCount.adjust(month, -count)
+    for post in posts:
+        StoredFile.release(post.image)
+    search.remove_posts(ids)
+    TrendingScore.delete().where(TrendingScore.post.in_(ids)).execute()
+
+    # The rows referencing the posts go first, so deleting the posts cascades nothing
+    deleted = {
+        "comments": Comment.delete().where(Comment.post.in_(ids)).execute(),
+        "ratings": Rating.delete().where(Rating.post.in_(ids)).execute(),
+        "post_tags": PostTag.delete().where(PostTag.post.in_(ids)).execute(),
+        "posts": Post.delete().where(Post.id.in_(ids)).execute(),
+    }
+    caching.touch_posts([], feed=True)
+    return deleted, [post.image for post in posts if post.image]
+
+
+class Chunk:
+    """What one chunk of a job deleted, for the work done once it is committed."""
+
+    def __init__(self, counts=None, deleted_posts=(), changed_posts=(), paths=(), user=None):
+        self.counts = counts or {}  # Rows deleted per kind; empty when the stage is done
+        self.deleted_posts = set(deleted_posts)
+        self.changed_posts = set(changed_posts)  # Posts that lost comments or ratings
+        self.paths = list(paths)  # Released stored files
+        self.user = user  # Id of the deleted user
+
+
+class PurgeRunner:
+    """
+    Runs the purge jobs on a background thread of each server process.
+
+    A job deletes the content of a user or tag in chunks, each committed in its
+    own short transaction of about `chunk_rows` rows (a post counts with its
+    comments and ratings), and pauses `pause` seconds between chunks so that
+    requests get the write lock in between. The progress of the job is committed
+    with each chunk. Files whose last reference was deleted are removed by the same
+    thread, never by a request. Jobs are stored in the PurgeJob table, so any
+    process picks them up; one left running by a process that died is resumed
+    once it hasn't progressed for `stale_after` seconds.
+    """
+
+    def __init__(self, chunk_rows=500, pause=0.05, poll_interval=5.0, stale_after=300.0):
+        self.chunk_rows = chunk_rows
+        self.pause = pause
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self.upload_folder = None
+        # Released paths to collect, or [] to look for jobs right away
+        self._queue = queue.Queue()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._jobs = 0
+        self._failed = 0
+        self._chunks = 0
+        self._rows = 0
+        self._files = 0
+        self._last_chunk = 0.0
+        self._max_chunk = 0.0
+
+    def request(self, kind, name, requested_by=None):
+        """
+        Queue the purge of a user (by username) or a tag (by name). A user is
+        deactivated at once, so they can't log in while their content is deleted.
+        Requires an open connection.
+        :param requested_by: Username of the admin requesting it.
+        :return: The PurgeJob; an unfinished job purging the same target is reused.
+        :raise PurgeError: If the user or tag doesn't exist.
+        """
+        if kind == "user":
+            if name == requested_by:
+                raise PurgeError("You can't purge your own account.")
+            target = User.get_or_none(User.username == name)
+        elif kind == "tag":
+            target = Tag.get_or_none(Tag.name == name)
+        else:
+            raise PurgeError(f"Unknown purge kind: {kind}")
+        if target is None:
+            raise PurgeError(f"No {kind} named {name}.")
+
+        with db.atomic():
+            job = PurgeJob.get_or_none(
+                (PurgeJob.kind == kind)
+                & (PurgeJob.target == target.id)
+                & PurgeJob.status.in_(UNFINISHED)
+            )
+            if job is None:
+                job = PurgeJob.create(
+                    kind=kind, target=target.id, target_name=name, requested_by=requested_by
+                )
+            if kind == "user":
+                User.update(is_active=False).where(User.id == target.id).execute()
+                identity.touch_user(target.id)
+        if kind == "user":
+            identity.forget_user(target.id)
+        self._queue.put([])
+        return job
+
+    def retry(self, job_id):
+        """
+        Run a failed job again, from the chunk that failed.
+        :return: Whether the job was failed.
+        """
+        retried = (
+            PurgeJob.update(status="pending", error=None, finished_at=None)
+            .where((PurgeJob.id == job_id) & (PurgeJob.status == "failed"))
+            .execute()
+        )
+        self._queue.put([])
+        return bool(retried)
+
+    def collect_files(self, paths):
+        """
+        Delete the stored files whose last reference was released by a committed
+        transaction (see storage.collect_garbage()) on the background thread.
+        """
+        paths = [path for path in paths if path]
+        if paths:
+            self.ensure_started()
+            self._queue.put(paths)
+
+    def run_next(self):
+        """
+        Claim the oldest unfinished job and run it to completion in this thread.
+        Requires an open connection.
+        :return: The job, or None if there was none to claim.
+        """
+        job = self._claim()
+        if job is None:
+            return None
+        try:
+            while job.status == "running":
+                self._step(job)
+                if job.status == "running":
+                    time.sleep(self.pause)
+        except Exception as e:
+            logger.exception("Purge job %s failed", job.id)
+            now = datetime.datetime.utcnow()
+            job.status = "failed"
+            PurgeJob.update(status="failed", error=str(e), updated_at=now, finished_at=now).where(
+                PurgeJob.id == job.id
+            ).execute()
+            with self._stats_lock:
+                self._failed += 1
+        else:
+            with self._stats_lock:
+                self._jobs += 1
+        return job
+
+    def _claim(self):
+        # Checked without the write lock first, as the thread of each process polls
+        if not PurgeJob.select().where(PurgeJob.status.in_(UNFINISHED)).exists():
+            return None
+        now = datetime.datetime.utcnow()
+        stale = now - datetime.timedelta(seconds=self.stale_after)
+        # Take the write lock first, so two processes can't claim the same job
+        with db.atomic("IMMEDIATE"):
+            job = (
+                PurgeJob.select()
+                .where(
+                    (PurgeJob.status == "pending")
+                    | ((PurgeJob.status == "running") & (PurgeJob.updated_at < stale))
+                )
+                .order_by(PurgeJob.created_at, PurgeJob.id)
+                .first()
+            )
+            if job is None:
+                return None
+            if job.stage is None:
+                job.stage = STAGES[job.kind][0]
+                job.total = self._count(job)
+            job.status = "running"
+            job.started_at = job.started_at or now
+            job.updated_at = now
+            job.save()
+        return job
+
+    def _count(self, job):
+        """Number of posts, comments and ratings a job will delete."""
+        posts = Post.select(Post.id).where(self._posts_of(job))
+        total, dependents = (
+            Post.select(fn.COUNT(Post.id), fn.SUM(Post.comment_count + Post.rating_count))
+            .where(self._posts_of(job))
+            .tuples()
+            .first()
+        )
+        total += dependents or 0
+        if job.kind == "user":
+            # Comments and ratings on the posts of other users
+            total += (
+                Comment.select()
+                .where((Comment.author == job.target) & Comment.post.not_in(posts))
+                .count()
+            )
+            total += (
+                Rating.select()
+                .where((Rating.user == job.target) & Rating.post.not_in(posts))
+                .count()
+            )
+        return total
+
+    @staticmethod
+    def _posts_of(job):
+        if job.kind == "user":
+            return Post.author == job.target
+        return Post.id.in_(PostTag.select(PostTag.post).where(PostTag.tag == job.target))
+
+    def _step(self, job):
+        """Delete one chunk of a job and commit it with the job's progress."""
+        started = time.perf_counter()
+        with db.atomic("IMMEDIATE"):
+            chunk = getattr(self, f"_{job.kind}_{job.stage}")(job)
+            deleted = dict(job.deleted)
+            for kind, count in chunk.counts.items():
+                deleted[kind] = deleted.get(kind, 0) + count
+            job.deleted = deleted
+            job.updated_at = datetime.datetime.utcnow()
+            if not chunk.counts:
+                stages = STAGES[job.kind]
+                if job.stage == stages[-1]:
+                    job.status = "done"
+                    job.finished_at = job.updated_at
+                else:
+                    job.stage = stages[stages.index(job.stage) + 1]
+            job.save()
+
+        caching.forget_posts(chunk.deleted_posts | chunk.changed_posts, feed=bool(chunk.counts))
+        if chunk.user is not None:
+            identity.forget_user(chunk.user)
+        trending.refresh(chunk.changed_posts)
+        self._collect(chunk.paths)
+
+        elapsed = time.perf_counter() - started
+        with self._stats_lock:
+            self._chunks += 1
+            self._rows += sum(chunk.counts.values())
+            self._last_chunk = elapsed
+            self._max_chunk = max(self._max_chunk, elapsed)
+
+    def _delete_posts_chunk(self, job):
+        # The next posts, as many as fit in chunk_rows with their comments and ratings
+        rows = (
+            Post.select(Post.id, Post.comment_count + Post.rating_count)
+            .where(self._posts_of(job))
+            .order_by(Post.id)
+            .limit(self.chunk_rows)
+            .tuples()
+        )
+        post_ids, size = [], 0
+        for post_id, dependents in rows:
+            if size + 1 + dependents > self.chunk_rows:
+                if not post_ids:
+                    # Too many comments and ratings for one chunk: they go first
+                    chunk = self._delete_dependents_chunk(post_id)
+                    if chunk.counts:
+                        return chunk
+                    post_ids.append(post_id)  # Nothing left but the post
+                break
+            post_ids.append(post_id)
+            size += 1 + dependents
+        counts, paths = delete_posts(post_ids)
+        return Chunk(counts, deleted_posts=post_ids, paths=paths)
+
+    def _delete_dependents_chunk(self, post_id):
+        """
+        Delete up to chunk_rows comments, or else ratings, of a post too large for a
+        single chunk, refreshing its stored counts. The post is deleted by a later
+        chunk, once the rest fits. Its tags stay until then, as a post has few.
+        """
+        for model, kind, refresh in (
+            (Comment, "comments", Comment.refresh_counts),
+            (Rating, "ratings", Rating.refresh_aggregates),
+        ):
+            ids = [
+                row_id
+                for (row_id,) in model.select(model.id)
+                .where(model.post == post_id)
+                .limit(self.chunk_rows)
+                .tuples()
+            ]
+            if ids:
+                count = model.delete().where(model.id.in_(ids)).execute()
+                refresh([post_id])
+                caching.touch_posts([post_id], feed=True)
+                return Chunk({kind: count}, changed_posts=[post_id])
+        return Chunk()  # Its stored counts were stale
+
+    _user_posts = _tag_posts = _delete_posts_chunk
+
+    def _user_comments(self, job):
+        """The user's comments on the posts of other users."""
+        rows = list(
+            Comment.select(Comment.id, Comment.post)
+            .where(Comment.author == job.target)
+            .limit(self.chunk_rows)
+            .tuples()
+        )
+        if not rows:
+            return Chunk()
+        post_ids = {post_id for _, post_id in rows}
+        count = Comment.delete().where(Comment.id.in_([row[0] for row in rows])).execute()
+        Comment.refresh_counts(post_ids)
+        caching.touch_posts(post_ids, feed=False)
+        return Chunk({"comments": count}, changed_posts=post_ids)
+
+    def _user_ratings(self, job):
+        """The user's ratings of the posts of other users."""
+        rows = list(
+            Rating.select(Rating.id, Rating.post)
+            .where(Rating.user == job.target)
+            .limit(self.chunk_rows)
+            .tuples()
+        )
+        if not rows:
+            return Chunk()
+        post_ids = {post_id for _, post_id in rows}
+        count = Rating.delete().where(Rating.id.in_([row[0] for row in rows])).execute()
+        Rating.refresh_aggregates(post_ids)
+        caching.touch_posts(post_ids, feed=True)  # Ratings order the popular feed
+        return Chunk({"ratings": count}, changed_posts=post_ids)
+
+    def _user_account(self, job):
+        # Content the user wrote while the earlier stages ran (e.g. through a
+        # session opened before they were deactivated) goes first
+        for stage in (self._user_posts, self._user_comments, self._user_ratings):
+            chunk = stage(job)
+            if chunk.counts:
+                return chunk
+        user = User.get_or_none(User.id == job.target)
+        if user is None:
+            return Chunk()
+        StoredFile.release(user.profile_picture)
+        FacetCount.delete().where(
+            (FacetCount.facet == "author") & (FacetCount.value == user.id)
+        ).execute()
+        user.delete_instance()
+        return Chunk({"users": 1}, paths=[user.profile_picture], user=user.id)
+
+    def _tag_tag(self, job):
+        chunk = self._tag_posts(job)
+        if chunk.counts:
+            return chunk
+        tag = Tag.get_or_none(Tag.id == job.target)
+        if tag is None:
+            return Chunk()
+        FacetCount.delete().where(
+            (FacetCount.facet == "tag") & (FacetCount.value == tag.id)
+        ).execute()
+        tag.delete_instance()
+        return Chunk({"tags": 1})
+
+    def _collect(self, paths):
+        paths = [path for path in paths if path]
+        if not paths or not self.upload_folder:
+            return
+        deleted = storage.collect_garbage(self.upload_folder, paths)
+        with self._stats_lock:
+            self._files += len(deleted)
+
+    def ensure_started(self):
+        """Start the thread running the jobs of this process if it isn't running."""
+        # Threads don't survive fork(), so each server worker starts its own
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive() or self._pid != os.getpid():
+                if self._pid != os.getpid():
+                    # Files released in the parent process are collected by the parent
+                    self._queue = queue.Queue()
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name="purge", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                paths = self._queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                paths = []
+            try:
+                with db.connection_context():
+                    self._collect(paths)
+                    while self.run_next() is not None:
+                        pass
+            except Exception:
+                logger.exception("Purge failed")
+
+    def stats(self):
+        """Job, chunk and file counters, and chunk latency (milliseconds)."""
+        with self._stats_lock:
+            return {
+                "jobs": self._jobs,
+                "failed": self._failed,
+                "chunks": self._chunks,
+                "rows": self._rows,
+                "files": self._files,
+                "last_chunk_ms": round(self._last_chunk * 1000, 3),
+                "max_chunk_ms": round(self._max_chunk * 1000, 3),
+            }
+
+
+# Shared purge runner used by the routes
+purge_runner = PurgeRunner()
@@ -0,0 +1,83 @@
+import markdown
+
+from app.database import db
+from app.models import Post
+
+# Markdown extensions used to render post content
+MARKDOWN_EXTENSIONS = []
+
+# Bump this when the rendered output changes for any other reason (e.g. a fix to
+# the rendering code), so stored HTML gets re-rendered
+RENDER_REVISION = 1
+
+# Stamp stored next to the rendered HTML. Posts with a different stamp are stale.
+RENDERER_VERSION = "%d;markdown-%s;%s" % (
+    RENDER_REVISION,
+    markdown.__version__,
+    ",".join(MARKDOWN_EXTENSIONS),
+)
+
+
+def render_markdown(text):
+    """
+    Convert Markdown post content to HTML.
+    """
+    return markdown.markdown(text, extensions=MARKDOWN_EXTENSIONS)
+
+
+def render_post(post):
+    """
+    Render the content of a post and store the HTML and renderer version on it.
+    The post is not saved; call this before saving new or edited content.
+    :param post: The post object.
+    """
+    post.content_html = render_markdown(post.content)
+    post.content_html_version = RENDERER_VERSION
+
+
+def post_html(post):
+    """
+    HTML of a post's content. Serves the stored HTML when it was produced by the
+    current renderer, otherwise re-renders it once and stores the result.
+    :param post: The post object.
+    :return: Rendered HTML.
+    """
+    if post.content_html is None or post.content_html_version != RENDERER_VERSION:
+        render_post(post)
+        Post.update(
+            content_html=post.content_html,
+            content_html_version=post.content_html_version,
+        ).where(Post.id == post.id).execute()
+    return post.content_html
+
+
+def rerender_stale_posts(batch_size=200):
+    """
+    Re-render every post whose stored HTML is missing or was produced by another
+    renderer version, committing one batch at a time.
+    :param batch_size: Number of posts re-rendered per transaction.
+    :return: Number of posts re-rendered.
+    """
+    stale = (Post.content_html.is_null()) | (
+        Post.content_html_version != RENDERER_VERSION
+    )
+    total = 0
+    last_id = 0
+    while True:
+        batch = list(
+            Post.select(Post.id, Post.content)
+            .where(stale & (Post.id > last_id))
+            .order_by(Post.id)
+            .limit(batch_size)
+        )
+        if not batch:
+            return total
+
+        with db.atomic():
+            for post in batch:
+                Post.update(
+                    content_html=render_markdown(post.content),
+                    content_html_version=RENDERER_VERSION,
+                ).where(Post.id == post.id).execute()
+        total += len(batch)
+        last_id = batch[-1].id
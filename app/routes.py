@@ -6,27 +6,65 @@ from flask import (
     url_for,
     flash,
     current_app,
+    abort,
+    jsonify,
+    session,
+    Response,
+    stream_with_context,
 )
 from flask_login import login_user, logout_user, login_required, current_user
-from flask_bcrypt import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
-import os
-import markdown
+import calendar
 import datetime
-
-from app.models import User, Post, Category, Tag, PostTag, Comment, Rating
+import logging
+
+from app.models import (
+    User,
+    Post,
+    Category,
+    Rating,
+    StoredFile,
+    MonthlyPostCount,
+    FacetCount,
+    PurgeJob,
+)
 from app.database import db
-from app.forms import RegisterForm, LoginForm, PostForm, CommentForm, ProfilePictureForm
-from peewee import fn
-from app import bcrypt
-from peewee import fn
-import datetime
+from app.forms import (
+    RegisterForm,
+    LoginForm,
+    PostForm,
+    CommentForm,
+    ProfilePictureForm,
+    PurgeForm,
+)
+from app import search as post_search
+from app.pagination import SortKey, paginate_keyset
+from app import loaders
+from app import rendering
+from app.writer import write_queue
+from app import caching
+from app.instrumentation import instrumentation
+from app import identity
+from app.passwords import password_hasher, PasswordHasherBusy
+from app import images
+from app import storage
+from app import tagging
+from app import archive as post_archive
+from app.trending import trending
+from app import facets as post_facets
+from app import feed as post_feed
+from app import server
+from app import transfer
+from app import purge
+from app.purge import purge_runner
 
 
 bp = Blueprint("routes", __name__)
 
+logger = logging.getLogger(__name__)
+
 
 @bp.route("/")
+@caching.anonymous_cache(caching.feed_stamp)
 def index():
     """This route provides dynamic homepage where users can search for posts
     by various criteria, apply filters like category, author, and popularity,
@@ -37,94 +75,118 @@ def index():
     query = request.args.get("q", "").strip()  # Search query
     category = request.args.get("category")  # Category filter
     author = request.args.get("author")  # Author filter
+    author_id = request.args.get("author_id", type=int)  # Author facet
     sort_by = request.args.get(
         "sort_by", "created_at"
     )  # Sorting option (default by created_at)
     tags = request.args.getlist("tags")  # List of tags for filtering
     popularity = request.args.get("popularity")  # Allow user to input popularity scale
 
-    # Start by selecting all posts ordered by creation date (descending) by default
-    posts = Post.select()
-
-    # General search query
-    if query:
-        # Tag filtering: if query starts with #
-        if query.startswith("#"):
-            tag = query[1:]  # Extract the tag name
-            posts = posts.join(PostTag).join(Tag).where(Tag.name == tag)
-        # Author filtering: if query starts with @
-        elif query.startswith("@"):
-            author_name = query[1:]
-            posts = posts.join(User).where(User.username.contains(author_name))
-        # Search in title/content
-        elif query.startswith(">"):
-            posts = posts.where(
-                Post.title.contains(query[1:]) | Post.content.contains(query[1:])
-            )
-        # Search by month
-        elif query.startswith("month:"):
-            month_name = query.split(":", 1)[1].capitalize()
-            try:
-                month = datetime.datetime.strptime(month_name, "%B").month
-                posts = posts.where(
-                    fn.strftime("%m", Post.created_at) == str(month).zfill(2)
-                )
-            except ValueError:
-                pass  # Invalid month, no filtering applied
-        # Search by popularity
-        elif query.startswith("popularity:"):
-            try:
-                popularity_score = float(query.split(":", 1)[1])
-                posts = posts.join(Rating, on=(Post.id == Rating.post_id))
-                posts = posts.select(
-                    Post, fn.Avg(Rating.rating).alias("avg_rating")
-                ).group_by(Post.id)
-                posts = posts.having(
-                    fn.Avg(Rating.rating) >= popularity_score
-                )  # Filter by popularity score
-            except ValueError:
-                pass  # Invalid popularity scale, no filtering applied
-        # Default search (general search by content, title, and category)
-        else:
-            posts = posts.join(Category).where(
-                (Post.content.contains(query))
-                | (Post.title.contains(query))
-                | (Category.name.contains(query))  # Search in category name
-            )
+    # Search query, category, author and tag filters (see feed.py)
+    posts, ranked = post_feed.filter_posts(
+        Post.select(), query, category=category, author=author, tags=tags, author_id=author_id
+    )
 
-    # Handle other filters like category and author if passed directly (without prefix in the query)
-    if category:
-        posts = posts.where(Category.name == category)
-    if author:
-        posts = posts.join(User).where(User.username.contains(author))
-
-    # Filter by tags if present
-    if tags:
-        for tag in tags:
-            posts = posts.join(PostTag).join(Tag).where(Tag.name == tag)
-
-    # Sorting by popularity or creation date
-    if sort_by == "popularity":
-        posts = posts.join(Rating, on=(Post.id == Rating.post_id))
-        posts = posts.select(Post, fn.Avg(Rating.rating).alias("avg_rating")).group_by(
-            Post.id
-        )
-        posts = posts.order_by(fn.Avg(Rating.rating).desc())
-    else:
-        posts = posts.order_by(Post.created_at.desc())
+    # Posts per category, tag and author among the matching posts, for the sidebar
+    filtered = bool(query or category or author or tags or author_id)
+    facets = post_facets.facet_counts(posts if filtered else None)
+
+    # Sorting by popularity, trending score, relevance or creation date. Full-text
+    # results are ranked by bm25 unless a sort order was requested.
+    posts, sort_keys = post_feed.sort_posts(
+        posts, sort_by, by_relevance=ranked and "sort_by" not in request.args
+    )
+
+    page = paginate_keyset(
+        loaders.with_post_relations(posts),
+        sort_keys,
+        per_page=current_app.config["POSTS_PER_PAGE"],
+        after=request.args.get("after"),
+        before=request.args.get("before"),
+    )
 
     return render_template(
         "index.html",
-        posts=posts,
+        posts=page.items,
+        page=page,
+        next_url=_page_url(after=page.next_cursor) if page.has_next else None,
+        prev_url=_page_url(before=page.prev_cursor) if page.has_prev else None,
         query=query,
         category=category,
         author=author,
+        author_id=author_id,
         sort_by=sort_by,
         tags=tags,
         popularity=popularity,  # Include popularity in template context
+        archive_months=post_archive.archive_months(),
+        facets=facets,
+        facet_url=_facet_url,
+    )
+
+
+@bp.route("/archive/<int:year>/<int:month>")
+@caching.anonymous_cache(caching.feed_stamp)
+def archive(year, month):
+    """Posts created in a given month, newest first."""
+    if not 1 <= month <= 12:
+        abort(404)
+
+    page = paginate_keyset(
+        loaders.with_post_relations(
+            Post.select().where(post_archive.in_month(year, month))
+        ),
+        [SortKey(Post.created_at, "created_at", True), SortKey(Post.id, "id", True)],
+        per_page=current_app.config["POSTS_PER_PAGE"],
+        after=request.args.get("after"),
+        before=request.args.get("before"),
+    )
+
+    return render_template(
+        "index.html",
+        posts=page.items,
+        page=page,
+        next_url=_page_url(after=page.next_cursor) if page.has_next else None,
+        prev_url=_page_url(before=page.prev_cursor) if page.has_prev else None,
+        archive_title=f"{calendar.month_name[month]} {year}",
+        archive_months=post_archive.archive_months(),
     )
 
 
+def _page_url(**cursor):
+    """
+    Build the URL of a neighbouring page of the current post listing, keeping the
+    current filters and sort order and replacing the pagination cursor.
+    """
+    args = request.args.to_dict(flat=False)
+    args.pop("after", None)
+    args.pop("before", None)
+    args.update(cursor)
+    return url_for(request.endpoint, **request.view_args, **args)
+
+
+# Query string parameter filtering on each facet. Authors are selected by id, as
+# their facet counts are exact while the `author` filter matches part of the name.
+FACET_PARAMS = {"category": "category", "tag": "tags", "author": "author_id"}
+
+
+def _facet_url(facet, value):
+    """
+    Build the URL of the current post listing with a facet value selected, or
+    unselected if it already is. Tags add up, categories and authors replace.
+    """
+    param = FACET_PARAMS[facet]
+    name = str(value)
+    args = request.args.to_dict(flat=False)
+    args.pop("after", None)
+    args.pop("before", None)
+    selected = args.get(param, [])
+    if name in selected:
+        args[param] = [value for value in selected if value != name]
+    else:
+        args[param] = selected + [name] if facet == "tag" else [name]
+    return url_for(request.endpoint, **request.view_args, **args)
+
+
 @bp.route("/register", methods=["GET", "POST"])
 def register():
     form = RegisterForm()
@@ -142,10 +204,12 @@ def register():
             )
             return redirect(url_for("routes.register"))
 
-        # Hash the password
-        hashed_password = bcrypt.generate_password_hash(form.password.data).decode(
-            "utf-8"
-        )
+        # Hash the password on the hashing pool
+        try:
+            hashed_password = password_hasher.hash(form.password.data)
+        except PasswordHasherBusy:
+            flash("The server is busy, please try again in a moment.", "danger")
+            return render_template("register.html", form=form), 503
 
         try:
             # Create the new user
@@ -170,19 +234,53 @@ def login():
     form = LoginForm()
     if form.validate_on_submit():
         user = User.get_or_none(User.username == form.username.data)
-        # if user and check_password_hash(user.password_hash, form.password.data):
-        if user and bcrypt.check_password_hash(user.password_hash, form.password.data):
+        try:
+            valid = user is not None and password_hasher.check(
+                user.password_hash, form.password.data
+            )
+            if valid and password_hasher.needs_rehash(user.password_hash):
+                _rehash_password(user, form.password.data)
+        except PasswordHasherBusy:
+            flash("The server is busy, please try again in a moment.", "danger")
+            return render_template("login.html", form=form), 503
+        if valid and not user.is_active:
+            flash("This account is disabled.", "danger")
+        elif valid:
             login_user(user)
+            identity.remember(user)  # Later requests load the user from the cache
             flash("Login successful!", "success")
             return redirect(url_for("routes.index"))
-        flash("Invalid username or password", "danger")
+        else:
+            flash("Invalid username or password", "danger")
     return render_template("login.html", form=form)
 
 
+def _rehash_password(user, password):
+    """
+    Store the password hashed at the configured cost, after a successful login
+    with a hash made at another cost.
+    """
+    password_hash = password_hasher.hash(password)
+    with db.atomic():
+        # Unless the password changed meanwhile
+        updated = (
+            User.update(password_hash=password_hash)
+            .where((User.id == user.id) & (User.password_hash == user.password_hash))
+            .execute()
+        )
+        if updated:
+            user.auth_version = identity.touch_user(user.id)
+    if updated:
+        identity.forget_user(user.id)
+        user.password_hash = password_hash
+        password_hasher.record_rehash()
+
+
 @bp.route("/logout")
 @login_required
 def logout():
     logout_user()
+    session.pop(identity.SESSION_KEY, None)
     flash("Logged out successfully!", "info")
     return redirect(url_for("routes.index"))
 
@@ -194,16 +292,28 @@ def add_comment(post_id):
     if not post:
         flash("Post not found.", "danger")
         return redirect(url_for("routes.index"))
-    tags = [post_tag.tag.name for post_tag in post.tags]
     content = request.form.get("content")
     if content:
-        # Create the comment
-        Comment.create(content=content, post=post, author=current_user)
+        # Queue the comment for the writer thread
+        _queued_write(write_queue.add_comment(post.id, current_user.id, content))
         flash("Comment added successfully!", "success")
 
     return redirect(url_for("routes.post_detail", post_id=post.id))
 
 
+def _queued_write(future):
+    """
+    Wait for a write submitted to the write-behind queue to be committed, unless
+    the app is configured to return before the write is durable.
+    """
+    if current_app.config["WRITE_BEHIND_WAIT"]:
+        # Hand the request's connection back while waiting, so the writer thread
+        # can't be starved of pooled connections by requests waiting on it
+        if not db.in_transaction():
+            db.close()
+        future.result(timeout=current_app.config["WRITE_BEHIND_TIMEOUT"])
+
+
 @bp.route("/rate_post/<int:post_id>", methods=["POST"])
 @login_required
 def rate_post(post_id):
@@ -222,23 +332,14 @@ def rate_post(post_id):
     score = int(score)
 
     try:
-        # Either update the existing rating or create a new one
-        rating, created = Rating.get_or_create(
-            post=post,
-            user=current_user,
-            defaults={"rating": score, "created_at": datetime.datetime.now()},
-        )
-        if not created:  # If rating already exists, update the rating
-            rating.rating = score
-            rating.updated_at = (
-                datetime.datetime.now()
-            )  # You might want to add an updated_at field
-            rating.save()
-            print(f"Rating for post {post.id} by user {current_user.id}: {score}")
+        # Queue an upsert of the rating; the writer thread also updates the
+        # rating aggregates stored on the post
+        _queued_write(write_queue.rate(post.id, current_user.id, score))
+        logger.debug("Rating for post %s by user %s: %s", post.id, current_user.id, score)
         flash("Thank you for your rating!", "success")
     except Exception as e:
         flash("An error occurred while saving your rating.", "danger")
-        print(f"Error: {e}")
+        logger.error("Error saving the rating of post %s: %s", post.id, e)
 
     return redirect(url_for("routes.view_post", post_id=post_id))
 
@@ -246,16 +347,16 @@ def rate_post(post_id):
 @bp.route("/view_post/<int:post_id>", methods=["GET", "POST"], endpoint="view_post")
 @login_required
 def view_post(post_id):
-    post = Post.get_or_none(Post.id == post_id)
+    post = loaders.load_post(post_id)
     if not post:
         flash("Post not found.", "danger")
         return redirect(url_for("routes.index"))
 
-    # Convert the Markdown content to HTML
-    post_content_html = markdown.markdown(post.content)
+    # HTML rendered from the Markdown content when the post was saved
+    post_content_html = rendering.post_html(post)
 
     # Retrieve tags specific to this post
-    tags = [post_tag.tag.name for post_tag in post.tags]
+    tags = post.tag_names
 
     # Fetch the current user's rating for the post (if any)
     user_rating = Rating.get_or_none(
@@ -266,19 +367,16 @@ def view_post(post_id):
 
     average_rating_value = Rating.average_rating(post)
 
-    print(average_rating_value)
-
     form = CommentForm()  # Create an instance of the CommentForm
 
     if form.validate_on_submit():
         # Handle comment submission
         comment_content = form.content.data
-        Comment.create(content=comment_content, post=post, author=current_user)
+        _queued_write(write_queue.add_comment(post.id, current_user.id, comment_content))
         flash("Your comment has been posted!", "success")
         return redirect(url_for("routes.view_post", post_id=post.id))
 
-    print(f"Average Rating for post {post.id}: {average_rating_value}")
-    print("post is this", post)
+    logger.debug("Average rating for post %s: %s", post.id, average_rating_value)
     response = render_template(
         "view_post.html",
         post=post,
@@ -287,22 +385,24 @@ def view_post(post_id):
         average_rating=average_rating_value,
         user_rating=user_rating_value,
         post_content_html=post_content_html,
+        comments=_comments_page(post.id, request.args.get("comments_after")),
     )
 
     return response
 
 
 @bp.route("/post/<int:post_id>", endpoint="post_detail")
+@caching.anonymous_cache(caching.post_stamp)
 def post_detail(post_id):
-    post = Post.get_or_none(Post.id == post_id)
+    post = loaders.load_post(post_id)
     if not post:
         flash("Post not found.", "danger")
         return redirect(url_for("routes.index"))
 
-    # Convert the Markdown content to HTML
-    post_content_html = markdown.markdown(post.content)
+    # HTML rendered from the Markdown content when the post was saved
+    post_content_html = rendering.post_html(post)
     # Retrieve tags specific to this post
-    tags = [post_tag.tag.name for post_tag in post.tags]
+    tags = post.tag_names
     # Calculate the average rating for the post
     average_rating_value = Rating.average_rating(post)
     form = CommentForm()
@@ -313,19 +413,42 @@ def post_detail(post_id):
         form=form,
         average_rating=average_rating_value,
         post_content_html=post_content_html,
+        comments=_comments_page(post.id, request.args.get("comments_after")),
+    )
+
+
+def _comments_page(post_id, after=None):
+    """
+    One page of the comments of a post. The post pages show the first one (or the
+    one after `comments_after`, for browsers without JavaScript), the following
+    ones are fetched from post_comments() by the "More comments" button.
+    """
+    return loaders.load_comments(
+        post_id, per_page=current_app.config["COMMENTS_PER_PAGE"], after=after
+    )
+
+
+@bp.route("/post/<int:post_id>/comments", endpoint="post_comments")
+@caching.anonymous_cache(caching.post_stamp)
+def post_comments(post_id):
+    """A page of the comments of a post, as an HTML fragment for the post pages."""
+    return render_template(
+        "comments.html",
+        post_id=post_id,
+        comments=_comments_page(post_id, request.args.get("after")),
     )
 
 
 @bp.route("/edit_post/<int:post_id>", methods=["GET", "POST"])
 @login_required
 def edit_post(post_id):
-    post = Post.get_or_none(Post.id == post_id)
+    post = loaders.load_post(post_id)
     if not post or post.author_id != current_user.id:
         flash("You are not authorized to edit this post", "danger")
         return redirect(url_for("routes.index"))
 
     categories = Category.select()  # Get all categories
-    print(f"Categories in DB: {[category.name for category in categories]}")
+    logger.debug("Categories in DB: %s", [category.name for category in categories])
     form = PostForm()
 
     form.category.choices = [
@@ -336,36 +459,25 @@ def edit_post(post_id):
         form.title.data = post.title
         form.content.data = post.content
         form.category.data = str(post.category.id) if post.category else None
-        form.tags.data = ", ".join([post_tag.tag.name for post_tag in post.tags])
+        form.tags.data = ", ".join(post.tag_names)
 
         # Set the choices for category dropdown, including 'Add New Category'
 
-        print(f"form.category.data (GET): {form.category.data}")  # Debugging line
-        print(f"Choices: {form.category.choices}")  # Debugg
+        logger.debug("form.category.data (GET): %s", form.category.data)
+        logger.debug("Choices: %s", form.category.choices)
 
-    print(f"Request method: {request.method}")  # Debugging line
-    print(f"Form data: {form.data}")
-    print(f"Form errors: {form.errors}")
+    logger.debug("Request method: %s", request.method)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Form data: %s", form.data)
+        logger.debug("Form errors: %s", form.errors)
 
     if form.validate_on_submit():
 
-        print(f"form.category.data (POST): {form.category.data}")  # Debugging line
+        logger.debug("form.category.data (POST): %s", form.category.data)
 
         post.title = form.title.data
         post.content = form.content.data
-        # post.tags = form.tags.data
-        if form.tags.data:
-            # Clean and process tags: remove empty tags and strip spaces
-            new_tags = [tag.strip() for tag in form.tags.data.split(",") if tag.strip()]
-
-            # Clear current tags and add new ones
-            PostTag.delete().where(PostTag.post == post).execute()
-
-            for tag_name in new_tags:
-                if tag_name:
-                    tag, created = Tag.get_or_create(name=tag_name)
-                    PostTag.create(post=post, tag=tag)
-
+        old_category = post.category_id
         # Handle category selection
         if form.category.data == "new_category" and form.new_category.data:
             # Create a new category if 'new_category' is selected
@@ -381,16 +493,33 @@ def edit_post(post_id):
                 return redirect(url_for("routes.edit_post", post_id=post.id))
         elif form.category.data == "":
             pass
-        # Handle image upload if any
-        if form.image.data:
-            file = form.image.data
-            filename = secure_filename(file.filename)
-            image_path = os.path.join(current_app.config["UPLOAD_FOLDER"], filename)
-            file.save(image_path)
-            post.image = filename
-
         post.updated_at = datetime.datetime.now()  # Update the timestamp
-        post.save()
+        rendering.render_post(post)  # Store the HTML of the new content
+        post.changed_at = datetime.datetime.utcnow()
+        upload_folder = current_app.config["UPLOAD_FOLDER"]
+        old_image = post.image
+        with db.atomic():
+            # Handle image upload if any
+            if form.image.data:
+                file = form.image.data
+                post.image = storage.save_upload(file, file.filename, upload_folder)
+                StoredFile.release(old_image)
+                if post.image != old_image:
+                    post.image_variants = None  # Until the new variants are generated
+            post.save()
+            if post.category_id != old_category:
+                FacetCount.adjust("category", [old_category], -1)
+                FacetCount.adjust("category", [post.category_id], 1)
+            if form.tags.data:
+                # Only the tags that were added or removed are written
+                tagging.set_post_tags(post, tagging.parse_tags(form.tags.data))
+            post_search.index_post(post)  # Keep the search index in sync
+            caching.invalidate_post(post.id)  # Expire cached copies of the post and feed
+        storage.collect_garbage(upload_folder, [old_image])  # If it was replaced
+        if form.image.data:
+            images.process_post_image(
+                current_app.config["UPLOAD_FOLDER"], post.id, post.image
+            )
         flash("Post updated successfully!", "success")
         return redirect(url_for("routes.view_post", post_id=post.id))
 
@@ -407,24 +536,18 @@ def edit_post(post_id):
 @login_required
 def delete_post(post_id):
     post = Post.get_or_none(Post.id == post_id)
-    if not post or post.author.id != current_user.id:
+    if not post or post.author_id != current_user.id:
         flash("You are not authorized to delete this post", "danger")
         return redirect(url_for("routes.index"))
 
     try:
-        # Delete associated ratings
-        Rating.delete().where(Rating.post == post).execute()
-
-        # Delete associated comments
-        Comment.delete().where(Comment.post == post).execute()
-        # Optionally, delete the associated image file
-        if post.image:
-            image_path = os.path.join(current_app.config["UPLOAD_FOLDER"], post.image)
-            if os.path.exists(image_path):
-                os.remove(image_path)
-
-        # Delete the post
-        post.delete_instance()
+        with db.atomic():
+            # The post with its comments, ratings, tags, search index entry, trending
+            # score, archive and facet counts
+            _, paths = purge.delete_posts([post.id])
+        caching.forget_posts([post.id])
+        # The image file is deleted off the request once no other post or user uses it
+        purge_runner.collect_files(paths)
 
         flash("Post deleted successfully!", "success")
     except Exception as e:
@@ -454,15 +577,6 @@ def create_post():
             flash("Category is required!", "danger")
             return render_template("create_post.html", form=form, categories=categories)
 
-        # Handle image upload
-        image_filename = None
-        if form.image.data:
-            file = form.image.data
-            filename = secure_filename(file.filename)  # Sanitize the filename
-            image_path = os.path.join(current_app.config["UPLOAD_FOLDER"], filename)
-            file.save(image_path)  # Save the file to the specified directory
-            image_filename = filename
-
         # If a new category was entered, create it and set the category_value to the new category
         if category_value == "new_category" and new_category_name:
             category, created = Category.get_or_create(name=new_category_name)
@@ -482,28 +596,40 @@ def create_post():
         if title and content:
             # Create the post in the database
             with db.atomic():
+                # Handle image upload; identical files are stored once
+                image_filename = None
+                if form.image.data:
+                    file = form.image.data
+                    image_filename = storage.save_upload(
+                        file, file.filename, current_app.config["UPLOAD_FOLDER"]
+                    )
+
                 post = Post.create(
                     title=title,
                     content=content,
                     author=current_user.id,
                     category_id=category_value,  # Store the category_id with the post
                     image=image_filename,  # Store the image filename
+                    content_html=rendering.render_markdown(content),
+                    content_html_version=rendering.RENDERER_VERSION,
                 )
 
                 if form.tags.data:
-                    new_tags = [
-                        tag.strip() for tag in form.tags.data.split(",") if tag.strip()
-                    ]
-                    PostTag.delete().where(PostTag.post == post).execute()
-                    for tag_name in new_tags:
-                        if tag_name:
-                            tag, created = Tag.get_or_create(
-                                name=tag_name
-                            )  # Ensure no duplicate tags
-                            PostTag.create(post=post, tag=tag)
+                    tagging.set_post_tags(post, tagging.parse_tags(form.tags.data))
                 else:
                     flash("No tags entered. Please provide valid tags.", "danger")
-                # print(f"Tags to be added: {tags}")
+
+                post_search.index_post(post)  # Add the new post to the search index
+                MonthlyPostCount.adjust(post.created_at, 1)  # Archive sidebar count
+                trending.refresh([post.id])  # New posts start with a trending score
+                FacetCount.adjust("category", [post.category_id], 1)  # Sidebar counts
+                FacetCount.adjust("author", [post.author_id], 1)
+                caching.invalidate_feed()
+            if image_filename:
+                # Resize in the background; the original is served until then
+                images.process_post_image(
+                    current_app.config["UPLOAD_FOLDER"], post.id, image_filename
+                )
             flash("Post created successfully!", "success")
             # return redirect(url_for("routes.index"))
             return redirect(url_for("routes.post_detail", post_id=post.id))
@@ -532,21 +658,23 @@ def user_profile(user_id):
         if file:
             # Ensure file type is valid
             if allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-
-                # Define the path where to save the uploaded file
-                upload_folder = os.path.join(
-                    current_app.config["UPLOAD_FOLDER"], "profile_pics"
+                upload_folder = current_app.config["UPLOAD_FOLDER"]
+                old_picture = user.profile_picture
+                with db.atomic():
+                    # Identical files are stored once, shared by every user and post
+                    user.profile_picture = storage.save_upload(
+                        file, file.filename, upload_folder
+                    )
+                    StoredFile.release(old_picture)
+                    if user.profile_picture != old_picture:
+                        user.profile_picture_variants = None
+                    user.save()
+                    identity.touch_user(user.id)
+                identity.forget_user(user.id)
+                storage.collect_garbage(upload_folder, [old_picture])
+                images.process_profile_picture(
+                    upload_folder, user.id, user.profile_picture
                 )
-                if not os.path.exists(upload_folder):
-                    os.makedirs(upload_folder)
-
-                file_path = os.path.join(upload_folder, filename)
-                file.save(file_path)
-
-                # Update the profile picture field for the user
-                user.profile_picture = f"profile_pics/{filename}"
-                user.save()
 
                 flash("Profile picture updated successfully!", "success")
             else:
@@ -562,76 +690,96 @@ def user_profile(user_id):
     posts_per_page = 10
     posts = Post.select().where(Post.author == user).order_by(Post.created_at.desc())
     posts_paginated = posts.paginate(page, posts_per_page)
+    ratings = loaders.load_user_ratings(user)
 
     return render_template(
-        "user_profile.html", user=user, posts=posts_paginated, form=form
+        "user_profile.html",
+        user=user,
+        posts=posts_paginated,
+        post_count=posts.count(),
+        ratings=ratings,
+        rating_count=len(ratings),
+        form=form,
     )
 
 
-from peewee import fn
-
-
 @bp.route("/search", methods=["GET"])
 def search():
-    query = request.args.get("q", "").strip()
-    category = request.args.get("category")
-    author = request.args.get("author")
-    sort_by = request.args.get("sort_by", "created_at")
-    month = request.args.get("month")  # Get the month filter (e.g., "November")
-
-    posts = Post.select()
-
-    # If there's a query, filter by content or title
-    if query:
-        posts = posts.where(Post.content.contains(query) | Post.title.contains(query))
-
-    # Filter by category if specified
-    if category:
-        posts = posts.where(Post.category == category)
-
-    # Filter by author if specified
-    if author:
-        posts = posts.join(User).where(User.username.contains(author))
-    elif query.startswith("month:"):
-        month_name = query.split(":", 1)[1].capitalize()
+    """Old search URL; the homepage serves the same searches and filters."""
+    return redirect(url_for("routes.index", **request.args.to_dict(flat=False)))
+
+
+@bp.route("/admin/metrics")
+@login_required
+def metrics():
+    """Internal performance counters, for admins only."""
+    if current_user.role != "admin":
+        abort(403)
+    return jsonify(
+        write_queue=write_queue.stats(),
+        page_cache=caching.page_cache.stats(),
+        identity_cache=identity.identity_cache.stats(),
+        password_hasher=password_hasher.stats(),
+        trending=trending.stats(),
+        purge=purge_runner.stats(),
+        sql=instrumentation.stats(),
+        # Requests per worker process, when served by `flask serve`
+        workers=server.current_server.stats() if server.current_server else None,
+    )
+
+
+@bp.route("/admin/export")
+@login_required
+def export():
+    """Download an NDJSON export of the blog (see transfer.py), for admins only."""
+    if current_user.role != "admin":
+        abort(403)
+    filename = f"blog-{datetime.datetime.utcnow():%Y%m%d-%H%M%S}.ndjson"
+    # Streamed while it's read from the database, in the request's connection
+    return Response(
+        stream_with_context(transfer.export_chunks()),
+        mimetype="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+@bp.route("/admin/purges", methods=["GET", "POST"])
+@login_required
+def purges():
+    """
+    Delete a user or a tag with all its posts, comments and ratings, in a background
+    job (see purge.py), and follow the progress of the jobs. For admins only.
+    """
+    if current_user.role != "admin":
+        abort(403)
+    form = PurgeForm()
+    if form.validate_on_submit():
         try:
-            # Map month names to month numbers (e.g., "November" -> 11)
-            month_map = {
-                "January": 1,
-                "February": 2,
-                "March": 3,
-                "April": 4,
-                "May": 5,
-                "June": 6,
-                "July": 7,
-                "August": 8,
-                "September": 9,
-                "October": 10,
-                "November": 11,
-                "December": 12,
-            }
-
-            # Get the month number from the map
-            month_number = month_map.get(month_name)
-
-            if month_number:
-                # Filter posts based on the extracted month
-                posts = posts.where(
-                    fn.strftime("%m", Post.created_at) == str(month_number).zfill(2)
-                )
-        except ValueError:
-            pass  # Invalid month, no filtering applied
+            job = purge_runner.request(
+                form.kind.data, form.name.data.strip(), requested_by=current_user.username
+            )
+            flash(f"Purge of the {job.kind} {job.target_name} queued.", "success")
+        except purge.PurgeError as e:
+            flash(str(e), "danger")
+        return redirect(url_for("routes.purges"))
 
-    # Sort by popularity or creation date
-    if sort_by == "popularity":
-        posts = posts.order_by(Post.ratings.avg().desc())
-    else:
-        posts = posts.order_by(Post.created_at.desc())
+    jobs = list(
+        PurgeJob.select().order_by(PurgeJob.created_at.desc(), PurgeJob.id.desc()).limit(50)
+    )
+    return render_template(
+        "admin_purges.html",
+        form=form,
+        jobs=jobs,
+        active=any(job.status in purge.UNFINISHED for job in jobs),
+    )
 
-    # Filter by tags if any tags are present in the search query
-    tags = request.args.getlist("tags")
-    if tags:
-        for tag in tags:
-            posts = posts.join(PostTag).join(Tag).where(Tag.name == tag)
 
-    return render_template("search_results.html", posts=posts, query=query)
+@bp.route("/admin/purges/<int:job_id>/retry", methods=["POST"])
+@login_required
+def retry_purge(job_id):
+    """Run a failed purge job again, from the chunk that failed. For admins only."""
+    if current_user.role != "admin":
+        abort(403)
+    if purge_runner.retry(job_id):
+        flash("Purge job restarted.", "success")
+    return redirect(url_for("routes.purges"))
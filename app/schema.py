@@ -0,0 +1,350 @@
+from peewee import OperationalError, Tuple, fn, __exception_wrapper__
+from playhouse.migrate import SqliteMigrator, migrate
+
+from app.database import db
+from app.models import (
+    User,
+    Post,
+    Comment,
+    Rating,
+    Category,
+    Tag,
+    PostTag,
+    ChangeStamp,
+    StoredFile,
+    MonthlyPostCount,
+    TrendingScore,
+    FacetCount,
+    ImportCheckpoint,
+    ImportedRow,
+    PurgeJob,
+    SchemaMigration,
+)
+from app import search
+from app.loaders import with_post_relations
+from app.trending import trending
+
+# Every regular table of the application, in creation order
+MODELS = [
+    User,
+    Post,
+    Comment,
+    Rating,
+    Category,
+    Tag,
+    PostTag,
+    ChangeStamp,
+    StoredFile,
+    MonthlyPostCount,
+    TrendingScore,
+    FacetCount,
+    ImportCheckpoint,
+    ImportedRow,
+    PurgeJob,
+]
+
+
+def add_missing_columns(models):
+    """
+    Add the columns declared on the models that are missing from existing tables,
+    so databases created by an older version of the app pick up new fields.
+    Tables that don't exist yet are left for create_tables().
+    :param models: List of model classes to check.
+    :return: List of the fields that were added.
+    """
+    migrator = SqliteMigrator(db)
+    added = []
+    for model in models:
+        table = model._meta.table_name
+        if not db.table_exists(table):
+            continue
+        existing = {column.name for column in db.get_columns(table)}
+        for field in model._meta.sorted_fields:
+            if field.column_name not in existing:
+                migrate(migrator.add_column(table, field.column_name, field))
+                added.append(field)
+    return added
+
+
+def rebuild_post_tags():
+    """
+    Give a PostTag table created without a key the composite (post, tag) key:
+    the table is rebuilt keeping one row per (post, tag) and dropping the rows
+    whose post or tag no longer exists.
+    :return: Number of rows dropped, or None if the table already has its key.
+    """
+    table = PostTag._meta.table_name
+    if not db.table_exists(table) or db.get_primary_keys(table):
+        return None
+
+    old_table = table + "_old"
+    db.execute_sql(f'ALTER TABLE "{table}" RENAME TO "{old_table}"')
+    # The old indexes keep their names; drop them so the new table can reuse them
+    for index in db.get_indexes(old_table):
+        db.execute_sql(f'DROP INDEX "{index.name}"')
+    db.create_tables([PostTag])
+
+    before = db.execute_sql(f'SELECT COUNT(*) FROM "{old_table}"').fetchone()[0]
+    db.execute_sql(
+        f'INSERT OR IGNORE INTO "{table}" (post_id, tag_id) '
+        f'SELECT post_id, tag_id FROM "{old_table}" '
+        f'WHERE post_id IN (SELECT id FROM "{Post._meta.table_name}") '
+        f'AND tag_id IN (SELECT id FROM "{Tag._meta.table_name}")'
+    )
+    db.execute_sql(f'DROP TABLE "{old_table}"')
+    return before - PostTag.select().count()
+
+
+def create_indexes(*models):
+    """Create the indexes declared on the models that don't exist yet."""
+    for model in models:
+        model._schema.create_indexes(safe=True)
+
+
+def drop_indexes(*names):
+    """Drop indexes by name, ignoring the ones that don't exist."""
+    for name in names:
+        db.execute_sql(f'DROP INDEX IF EXISTS "{name}"')
+
+
+# Migrations
+#
+# Each migration runs once per database, in its own transaction, and records its
+# version in SchemaMigration. Add new ones at the end with the next version number
+# and never change a migration that was released: existing databases skip it.
+# A migration may run on a database already created with the final models (the
+# baseline creates every table and index declared today), so migrations must be
+# idempotent: create_indexes(), drop_indexes() and add_missing_columns() are.
+
+
+def _baseline():
+    # Bring a database created before migrations existed up to the models
+    added = add_missing_columns(MODELS)
+    rebuild_post_tags()  # Before create_tables() adds the new PostTag indexes
+    # Indexes of existing tables are left to the migrations that introduced them
+    db.create_tables([model for model in MODELS if not db.table_exists(model._meta.table_name)])
+    # Create and populate the full-text search index if this database predates it
+    search.ensure_index()
+
+    if Post.rating_sum in added:
+        Rating.reconcile_aggregates(fix=True)
+    if Post.changed_at in added:
+        Post.update(changed_at=Post.updated_at).execute()
+
+
+def _query_indexes():
+    # Composite indexes matching the filters and orderings used by the routes (and
+    # the feed indexes added before migrations existed). They replace the
+    # single-column foreign key indexes they start with.
+    create_indexes(Post, Comment, Rating)
+    drop_indexes(
+        "post_author_id",  # by (author_id, created_at)
+        "post_category_id",  # by (category_id, created_at, id)
+        "comment_post_id",  # by (post_id, created_at, id)
+        "rating_post_id",  # by the unique (post_id, user_id)
+        "rating_user_id",  # by (user_id, created_at)
+    )
+    db.execute_sql("ANALYZE")  # Statistics for the query planner
+
+
+def _monthly_post_counts():
+    db.create_tables([MonthlyPostCount])
+    MonthlyPostCount.rebuild()
+
+
+def _user_auth_version():
+    add_missing_columns([User])
+
+
+def _trending_scores():
+    db.create_tables([TrendingScore])
+    trending.rebuild()
+
+
+def _facet_counts():
+    db.create_tables([FacetCount])
+    FacetCount.rebuild()
+
+
+def _post_comment_count():
+    add_missing_columns([Post])
+    Comment.refresh_counts()
+
+
+def _import_checkpoints():
+    db.create_tables([ImportCheckpoint, ImportedRow])
+
+
+def _purge_jobs():
+    db.create_tables([PurgeJob])
+
+
+MIGRATIONS = [
+    (1, "baseline schema", _baseline),
+    (2, "indexes for the feed, profile, comment and rating queries", _query_indexes),
+    (3, "monthly post counts for the archive", _monthly_post_counts),
+    (4, "auth version of the users", _user_auth_version),
+    (5, "trending scores", _trending_scores),
+    (6, "facet counts for the homepage sidebar", _facet_counts),
+    (7, "comment count of the posts", _post_comment_count),
+    (8, "checkpoints of the NDJSON imports", _import_checkpoints),
+    (9, "background purge jobs", _purge_jobs),
+]
+
+
+def schema_version():
+    """Version of the last migration applied to the database, 0 if none."""
+    if not db.table_exists(SchemaMigration._meta.table_name):
+        return 0
+    return SchemaMigration.select(fn.MAX(SchemaMigration.version)).scalar() or 0
+
+
+def pending_migrations():
+    """List of (version, name, function) of the migrations not applied yet."""
+    version = schema_version()
+    return [migration for migration in MIGRATIONS if migration[0] > version]
+
+
+def migrate_database(explain=False):
+    """
+    Apply the pending migrations, each in its own transaction.
+    :param explain: Also report how the migrations changed the hot query plans.
+    :return: List of (version, name) of the applied migrations, and with explain
+        also a list of report lines, see describe_plans().
+    """
+    pending = pending_migrations()
+    before = None
+
+    # Adding a NOT NULL column rebuilds the table (copy, drop, rename). With foreign
+    # keys enforced, dropping the old table would cascade-delete the rows referencing
+    # it, so enforcement is suspended (it can't be changed inside a transaction).
+    foreign_keys = db.foreign_keys
+    db.foreign_keys = False
+    applied = []
+    try:
+        db.create_tables([SchemaMigration])
+        for version, name, migration in pending:
+            if explain and before is None and version > 1:
+                # Plans can't be compared with a schema older than the baseline
+                before = query_plans()
+            with db.atomic():
+                migration()
+                SchemaMigration.create(version=version, name=name)
+            applied.append((version, name))
+    finally:
+        db.foreign_keys = foreign_keys
+
+    if explain:
+        return applied, describe_plans(before, query_plans())
+    return applied
+
+
+# Query plans
+
+
+def hot_queries():
+    """
+    The queries run by the busiest routes, for EXPLAIN QUERY PLAN.
+    :return: Dict of description -> peewee query.
+    """
+    user_id = User.select(fn.MIN(User.id)).scalar() or 1
+    post_id = Post.select(fn.MIN(Post.id)).scalar() or 1
+    category_id = Category.select(fn.MIN(Category.id)).scalar() or 1
+    newest = (Post.created_at.desc(), Post.id.desc())
+    return {
+        "index: newest posts": with_post_relations(Post.select())
+        .order_by(*newest)
+        .limit(13),
+        "index: category filter": with_post_relations(Post.select())
+        .where(Post.category.in_([category_id]))
+        .order_by(*newest)
+        .limit(13),
+        "index: tag filter": with_post_relations(Post.select())
+        .where(Post.id.in_(PostTag.select(PostTag.post).join(Tag).where(Tag.name == "")))
+        .order_by(*newest)
+        .limit(13),
+        "index: popularity": with_post_relations(Post.select())
+        .where(Post.rating_count > 0)
+        .order_by(Post.rating_avg.desc(), Post.id.desc())
+        .limit(13),
+        "index: trending": with_post_relations(Post.select())
+        .join(TrendingScore, on=(TrendingScore.post + 0 == Post.id))  # As feed.py
+        .order_by(TrendingScore.score.desc(), TrendingScore.post.desc())
+        .limit(13),
+        "archive: month": with_post_relations(Post.select())
+        .where((Post.created_at >= "2024-12-01") & (Post.created_at < "2025-01-01"))
+        .order_by(*newest)
+        .limit(13),
+        "user_profile: posts": Post.select()
+        .where(Post.author == user_id)
+        .order_by(Post.created_at.desc())
+        .limit(10),
+        "user_profile: ratings": Rating.select(Rating, Post)
+        .join(Post)
+        .where(Rating.user == user_id)
+        .order_by(Rating.created_at.desc()),
+        "view_post: comments": Comment.select(Comment, User)
+        .join(User)
+        .where(
+            (Comment.post == post_id)
+            & (Tuple(Comment.created_at, Comment.id) > Tuple("2024-12-01", 0))
+        )
+        .order_by(Comment.created_at, Comment.id)
+        .limit(21),
+        "rate_post: user rating": Rating.select()
+        .where((Rating.post == post_id) & (Rating.user == user_id)),
+    }
+
+
+def explain(query):
+    """
+    EXPLAIN QUERY PLAN of a query.
+    :return: List of plan steps, indented by depth, e.g. ["SCAN post USING INDEX ..."].
+    """
+    return explain_sql(*query.sql())
+
+
+def explain_sql(sql, params=None):
+    """
+    EXPLAIN QUERY PLAN of an SQL statement, see explain(). Runs on a raw cursor, so
+    the statement isn't reported to the query listeners (e.g. the slow-query log).
+    """
+    depth = {0: -1}
+    steps = []
+    with __exception_wrapper__:  # Raise peewee's errors, as db.execute_sql() does
+        rows = db.cursor().execute("EXPLAIN QUERY PLAN " + sql, params or ())
+    for node_id, parent, _, detail in rows:
+        depth[node_id] = depth.get(parent, -1) + 1
+        steps.append("  " * depth[node_id] + detail)
+    return steps
+
+
+def query_plans():
+    """EXPLAIN QUERY PLAN of every hot query: dict of description -> plan steps."""
+    plans = {}
+    for name, query in hot_queries().items():
+        try:
+            plans[name] = explain(query)
+        except OperationalError as e:
+            # e.g. the query uses a column an older schema doesn't have yet
+            plans[name] = [f"(no plan: {e})"]
+    return plans
+
+
+def describe_plans(before, after):
+    """
+    Report of the query plans, showing the previous plan of the queries whose
+    plan changed.
+    :param before: query_plans() before the change, or None.
+    :param after: query_plans() after the change.
+    :return: List of lines.
+    """
+    lines = []
+    for name, plan in after.items():
+        lines.append(name)
+        if before is not None and before[name] != plan:
+            lines.append("  before:")
+            lines += ["    " + step for step in before[name]]
+            lines.append("  after:")
+        lines += ["    " + step for step in plan]
+    return lines
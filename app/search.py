@@ -0,0 +1,151 @@
+from peewee import fn, JOIN
+
+from app.database import db
+from app.models import Post, Category, Tag, PostTag, PostSearch
+
+
+# Columns searched by the ">" prefix (posts only, no category or tag names)
+POST_TEXT_COLUMNS = ("title", "content")
+
+
+def build_match_expression(query, columns=None):
+    """
+    Turn free text typed by a user into a safe FTS5 MATCH expression.
+    Every word is quoted (so characters like '-' or ':' are not parsed as FTS5
+    operators) and used as a prefix, which keeps partial words matching the way
+    the old LIKE '%q%' search did.
+    :param query: Raw search text.
+    :param columns: Optional list of index columns to restrict the match to.
+    :return: MATCH expression, or None if the query has no searchable words.
+    """
+    terms = ['"%s"*' % word.replace('"', '""') for word in query.split()]
+    if not terms:
+        return None
+
+    expression = " ".join(terms)
+    if columns:
+        expression = "{%s}: (%s)" % (" ".join(columns), expression)
+    return expression
+
+
+def search_posts(posts, query, columns=None):
+    """
+    Restrict a Post query to the posts matching a full-text search.
+    :param posts: Post select query to filter.
+    :param query: Raw search text.
+    :param columns: Optional list of index columns to restrict the match to.
+    :return: (posts, matched) where posts is the filtered query, or the query
+        unchanged if there is nothing to search, and matched tells whether a MATCH
+        was applied (only then can the results be ordered by rank()).
+    """
+    expression = build_match_expression(query, columns)
+    if expression is None:
+        return posts, False
+
+    posts = posts.join(
+        PostSearch, on=(Post.id == PostSearch.rowid)
+    ).where(PostSearch.match(expression))
+    return posts, True
+
+
+def rank():
+    """
+    Relevance of a match for a query produced by search_posts(). This is the bm25
+    score, where lower values are better matches.
+    """
+    return PostSearch.bm25()
+
+
+def order_by_rank(posts):
+    """
+    Order a query produced by search_posts() by bm25 relevance (best match first).
+    """
+    return posts.order_by(rank(), Post.created_at.desc())
+
+
+def index_post(post):
+    """
+    Add or refresh the search index entry for a post. Call this after the post,
+    its category and its tags have been saved.
+    :param post: The post object to index.
+    """
+    tags = (
+        Tag.select(Tag.name)
+        .join(PostTag)
+        .where(PostTag.post == post.id)
+        .tuples()
+    )
+    category = Category.get_or_none(Category.id == post.category_id)
+
+    with db.atomic():
+        remove_post(post.id)
+        PostSearch.insert(
+            {
+                PostSearch.rowid: post.id,
+                PostSearch.title: post.title,
+                PostSearch.content: post.content,
+                PostSearch.category: category.name if category else "",
+                PostSearch.tags: " ".join(name for (name,) in tags),
+            }
+        ).execute()
+
+
+def remove_post(post_id):
+    """
+    Remove a post from the search index.
+    :param post_id: Id of the deleted post.
+    """
+    PostSearch.delete().where(PostSearch.rowid == post_id).execute()
+
+
+def remove_posts(post_ids):
+    """
+    Remove several posts from the search index, with one statement.
+    :param post_ids: Ids of the deleted posts.
+    """
+    PostSearch.delete().where(PostSearch.rowid.in_(list(post_ids))).execute()
+
+
+def rebuild_index():
+    """
+    Rebuild the whole search index from the Post table in a single statement.
+    :return: Number of posts indexed.
+    """
+    tag_names = (
+        Tag.select(fn.COALESCE(fn.GROUP_CONCAT(Tag.name, " "), ""))
+        .join(PostTag)
+        .where(PostTag.post == Post.id)
+    )
+    source = Post.select(
+        Post.id,
+        Post.title,
+        Post.content,
+        fn.COALESCE(Category.name, ""),
+        tag_names,
+    ).join(Category, on=(Post.category == Category.id), join_type=JOIN.LEFT_OUTER)
+
+    with db.atomic():
+        PostSearch.delete().execute()
+        PostSearch.insert_from(
+            source,
+            [
+                PostSearch.rowid,
+                PostSearch.title,
+                PostSearch.content,
+                PostSearch.category,
+                PostSearch.tags,
+            ],
+        ).execute()
+        PostSearch.optimize()
+
+    return PostSearch.select().count()
+
+
+def ensure_index():
+    """
+    Create the search index on databases that predate it and populate it from the
+    existing posts. Does nothing if the index already exists.
+    """
+    if not PostSearch.table_exists():
+        PostSearch.create_table()
+        rebuild_index()
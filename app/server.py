@@ -0,0 +1,305 @@
+import logging
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import threading
+import time
+
+from werkzeug.serving import make_server
+
+from app.database import db, init_database
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two checks of the stop flag while waiting for connections
+POLL_INTERVAL = 0.5
+
+
+def multiprocess_settings(config):
+    """
+    Make the database settings safe for several processes writing to the same
+    SQLite file: WAL journal (readers don't block the writer, and vice versa) and
+    a busy timeout, so a process waits for the write lock instead of failing.
+    :param config: The app config, changed in place.
+    :return: List of the settings that were changed.
+    """
+    if config["DATABASE"] in ("", ":memory:"):
+        raise ValueError("An in-memory database can't be shared by worker processes")
+    changed = []
+    if config["SQLITE_JOURNAL_MODE"].lower() != "wal":
+        config["SQLITE_JOURNAL_MODE"] = "wal"
+        changed.append("SQLITE_JOURNAL_MODE=wal")
+    if config["SQLITE_BUSY_TIMEOUT"] < 5000:
+        config["SQLITE_BUSY_TIMEOUT"] = 5000
+        changed.append("SQLITE_BUSY_TIMEOUT=5000")
+    if changed:
+        init_database(config)
+    return changed
+
+
+class PreforkServer:
+    """
+    Pre-forking HTTP server. The app is created once in the master process, which
+    listens on the socket and forks `workers` processes serving requests from it
+    with the Werkzeug WSGI server, each with `threads` threads.
+
+    - A worker exits after about `max_requests` requests (plus a random jitter, so
+      the workers don't restart together), and the master forks a fresh one.
+    - SIGHUP replaces the workers one at a time, the others serving meanwhile.
+    - SIGTERM or SIGINT stops the workers gracefully: each one finishes its
+      requests in progress, and is killed after `graceful_timeout` seconds.
+    - SIGUSR1 logs the number of requests served by each worker.
+    """
+
+    def __init__(
+        self,
+        app,
+        host="127.0.0.1",
+        port=8000,
+        workers=2,
+        threads=1,
+        max_requests=0,
+        max_requests_jitter=0,
+        graceful_timeout=30,
+        backlog=128,
+    ):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.threads = threads
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.graceful_timeout = graceful_timeout
+        self.backlog = backlog
+        self.socket = None
+        # Shared with the workers: pid and requests served of the worker in each slot
+        self._pids = multiprocessing.RawArray("q", workers)
+        self._requests = multiprocessing.RawArray("q", workers)
+        self._slots = {}  # pid -> slot, in the master
+        self._stopping = False
+        self._reload = False
+        self._report = False
+
+    # Master
+
+    def run(self):
+        """Listen, fork the workers and supervise them until stopped."""
+        self.socket = socket.create_server(
+            (self.host, self.port), backlog=self.backlog, reuse_port=False
+        )
+        # Every worker waits on the socket, but only one accepts each connection;
+        # the others must not block in accept()
+        self.socket.setblocking(False)
+        logger.info(
+            "Serving on http://%s:%s with %s workers (master pid %s)",
+            self.host,
+            self.port,
+            self.workers,
+            os.getpid(),
+        )
+
+        # Connections can't be shared with forked processes; each worker opens its own
+        db.close_all()
+
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        signal.signal(signal.SIGHUP, self._handle_reload)
+        signal.signal(signal.SIGUSR1, self._handle_report)
+
+        for slot in range(self.workers):
+            self._spawn(slot)
+        try:
+            while not self._stopping:
+                time.sleep(POLL_INTERVAL)
+                self._reap()
+                if self._reload:
+                    self._reload = False
+                    self._rolling_restart()
+                if self._report:
+                    self._report = False
+                    self.report()
+        finally:
+            self._stop_workers()
+            self.socket.close()
+        logger.info("Server stopped")
+
+    def _handle_stop(self, signum, frame):
+        self._stopping = True
+
+    def _handle_reload(self, signum, frame):
+        self._reload = True
+
+    def _handle_report(self, signum, frame):
+        self._report = True
+
+    def _spawn(self, slot):
+        self._requests[slot] = 0
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                self._worker(slot)
+            except BaseException:
+                logger.exception("Worker %s failed", os.getpid())
+                code = 1
+            finally:
+                os._exit(code)
+        self._pids[slot] = pid
+        self._slots[pid] = slot
+        logger.info("Started worker %s (pid %s)", slot, pid)
+        return pid
+
+    def _reap(self, respawn=True):
+        """Collect the exited workers, forking a replacement for each unless stopping."""
+        while self._slots:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            slot = self._slots.pop(pid, None)
+            if slot is None:
+                continue
+            logger.info(
+                "Worker %s (pid %s) exited with status %s after %s requests",
+                slot,
+                pid,
+                os.waitstatus_to_exitcode(status),
+                self._requests[slot],
+            )
+            self._pids[slot] = 0
+            if respawn and not self._stopping:
+                self._spawn(slot)
+
+    def _rolling_restart(self):
+        logger.info("Restarting the workers one at a time")
+        for pid, slot in list(self._slots.items()):
+            if self._stopping:
+                return
+            self._stop_worker(pid)
+            self._wait_for(pid)
+            logger.info(
+                "Worker %s (pid %s) stopped after %s requests", slot, pid, self._requests[slot]
+            )
+            self._slots.pop(pid, None)
+            self._pids[slot] = 0
+            self._spawn(slot)
+
+    def _stop_worker(self, pid):
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    def _wait_for(self, pid):
+        """Wait for a worker to exit, killing it after the graceful timeout."""
+        deadline = time.monotonic() + self.graceful_timeout
+        while True:
+            try:
+                done, _ = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if done:
+                return
+            if time.monotonic() > deadline:
+                logger.warning("Worker pid %s didn't stop in time, killing it", pid)
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+                return
+            time.sleep(0.05)
+
+    def _stop_workers(self):
+        for pid in list(self._slots):
+            self._stop_worker(pid)
+        for pid in list(self._slots):
+            self._wait_for(pid)
+            self._slots.pop(pid, None)
+
+    def stats(self):
+        """Pid and number of requests served by the current worker of each slot."""
+        return [
+            {"worker": slot, "pid": self._pids[slot], "requests": self._requests[slot]}
+            for slot in range(self.workers)
+        ]
+
+    def report(self):
+        for worker in self.stats():
+            logger.info(
+                "Worker %s (pid %s): %s requests", worker["worker"], worker["pid"], worker["requests"]
+            )
+
+    # Worker
+
+    def _worker(self, slot):
+        global current_server
+        current_server = self
+        random.seed()  # Don't share the master's random state
+        stopping = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # The master stops the workers
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+
+        limit = 0
+        if self.max_requests:
+            limit = self.max_requests + random.randint(0, self.max_requests_jitter)
+        lock = threading.Lock()
+
+        def counted(environ, start_response):
+            with lock:
+                self._requests[slot] += 1
+                if limit and self._requests[slot] >= limit:
+                    stopping.set()  # Recycle once the requests in progress are done
+            return self.app(environ, start_response)
+
+        server = make_server(
+            self.host,
+            self.port,
+            counted,
+            threaded=self.threads > 1,
+            fd=self.socket.fileno(),
+        )
+        server.timeout = POLL_INTERVAL
+        # Wait for the request threads when closing, instead of abandoning them
+        server.daemon_threads = False
+        if self.threads > 1:
+            # Accept no more connections than threads, so busy workers leave the
+            # new connections to the idle ones
+            slots = threading.BoundedSemaphore(self.threads)
+            # Connections holding a slot. shutdown_request() is also called for
+            # connections that never got one, and after process_request() failed.
+            holding = set()
+            holding_lock = threading.Lock()
+            process_request = server.process_request
+
+            def bounded_process_request(request, client_address):
+                slots.acquire()
+                with holding_lock:
+                    holding.add(request)
+                process_request(request, client_address)
+
+            def release(request):
+                try:
+                    server.__class__.shutdown_request(server, request)
+                finally:
+                    with holding_lock:
+                        held = request in holding
+                        holding.discard(request)
+                    if held:
+                        slots.release()
+
+            server.process_request = bounded_process_request
+            server.shutdown_request = release
+
+        while not stopping.is_set():
+            server.handle_request()
+        server.server_close()  # Waits for the request threads
+        db.close_all()
+
+
+# The server of this worker process, None outside `flask serve` workers
+current_server = None
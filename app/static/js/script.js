@@ -16,3 +16,27 @@ document.getElementById('dark-mode-toggle').addEventListener('click', function()
 if (localStorage.getItem('darkMode') === 'true') {
     document.body.classList.add('dark-mode');
 }
+
+// "More comments" button of the post pages: replace it with the next page of comments
+document.addEventListener('click', function(event) {
+    const button = event.target.closest('.load-more-comments');
+    if (!button) {
+        return;
+    }
+    event.preventDefault();
+    button.classList.add('disabled');
+    fetch(button.dataset.url)
+        .then(function(response) {
+            if (!response.ok) {
+                throw new Error(response.statusText);
+            }
+            return response.text();
+        })
+        .then(function(html) {
+            button.outerHTML = html;
+        })
+        .catch(function() {
+            // Fall back to loading the page with the next comments
+            window.location.href = button.href;
+        });
+});
@@ -0,0 +1,210 @@
+import glob
+import hashlib
+import os
+import tempfile
+
+from flask import request
+
+from app.database import db
+from app.models import StoredFile, Post, User
+from app.images import variant_paths
+
+# Sub-folder of the upload folder holding the stored files, sharded by hash prefix:
+# objects/ab/cd/abcd...ef.jpg
+STORE_FOLDER = "objects"
+
+# Files served from these sub-folders of the upload folder never change content,
+# since their name is derived from it
+IMMUTABLE_FOLDERS = ("uploads/objects/", "uploads/variants/objects/")
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+CHUNK_SIZE = 64 * 1024
+
+
+def store_path(digest, extension):
+    """Path of a stored file relative to the upload folder."""
+    return f"{STORE_FOLDER}/{digest[:2]}/{digest[2:4]}/{digest}{extension}"
+
+
+def is_stored(path):
+    """Whether a Post.image / User.profile_picture value points into the store."""
+    return bool(path) and path.startswith(STORE_FOLDER + "/")
+
+
+def _extension(filename):
+    extension = os.path.splitext(filename)[1].lower()
+    return ".jpg" if extension == ".jpeg" else extension
+
+
+def save_upload(stream, filename, upload_folder):
+    """
+    Store an uploaded file once, under the hash of its content, and add a reference
+    to it. The file is hashed while it is streamed to a temporary file, which is
+    then moved into place. Call inside the transaction saving the reference, so
+    collect_garbage() can't remove the file before the reference is committed.
+    :param stream: File-like object, e.g. a werkzeug FileStorage.
+    :param filename: Name of the uploaded file; only its extension is kept.
+    :param upload_folder: Absolute path of the upload folder.
+    :return: Path of the stored file relative to the upload folder.
+    """
+    store = os.path.join(upload_folder, STORE_FOLDER)
+    os.makedirs(store, exist_ok=True)
+
+    digest = hashlib.sha256()
+    size = 0
+    # In the store, so moving it into place is an atomic rename
+    with tempfile.NamedTemporaryFile(dir=store, prefix=".upload-", delete=False) as temp:
+        try:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+                temp.write(chunk)
+                size += len(chunk)
+        except BaseException:
+            os.remove(temp.name)
+            raise
+
+    path = store_path(digest.hexdigest(), _extension(filename))
+    StoredFile.acquire(path, size)
+    target = os.path.join(upload_folder, path)
+    if os.path.exists(target):
+        os.remove(temp.name)  # Already stored
+    else:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(temp.name, target)
+    return path
+
+
+def collect_garbage(upload_folder, paths=None):
+    """
+    Delete stored files that are no longer referenced, and their image variants.
+    Files saved under their original name, before the store existed (see
+    `flask import-uploads`), are deleted once no post or user references them.
+    Call after the transaction releasing the references is committed.
+    :param paths: Only consider these paths; all unreferenced stored files if None.
+    :return: List of the deleted paths.
+    """
+    legacy = [path for path in paths or () if path and not is_stored(path)]
+    paths = [path for path in paths if is_stored(path)] if paths is not None else None
+    if paths == [] and not legacy:
+        return []
+
+    # Take the write lock first, so no upload can acquire a file while it's deleted
+    with db.atomic("IMMEDIATE"):
+        garbage = []
+        if paths != []:
+            query = StoredFile.select(StoredFile.path).where(StoredFile.ref_count <= 0)
+            if paths is not None:
+                query = query.where(StoredFile.path.in_(paths))
+            garbage = [stored.path for stored in query]
+        for path in garbage:
+            remove_file(upload_folder, path)
+        if garbage:
+            StoredFile.delete().where(StoredFile.path.in_(garbage)).execute()
+
+        for path in set(legacy):
+            if not _is_referenced(path) and _in_folder(upload_folder, path):
+                remove_file(upload_folder, path)
+                garbage.append(path)
+    return garbage
+
+
+def _is_referenced(path):
+    """Whether a post or a user references a file saved under its original name."""
+    return (
+        Post.select().where(Post.image == path).exists()
+        or User.select().where(User.profile_picture == path).exists()
+    )
+
+
+def _in_folder(upload_folder, path):
+    """Whether a path taken from the database stays inside the upload folder."""
+    root = os.path.realpath(upload_folder)
+    return os.path.realpath(os.path.join(root, path)).startswith(root + os.sep)
+
+
+def remove_file(upload_folder, path):
+    """
+    Delete a file of the upload folder and its image variants, if they exist, with
+    the shard folders of the store they leave empty.
+    """
+    for name in [path] + variant_paths(upload_folder, path):
+        full_path = os.path.join(upload_folder, name)
+        if os.path.exists(full_path):
+            os.remove(full_path)
+        if is_stored(path):
+            _remove_empty_shards(os.path.dirname(full_path))
+
+
+def _remove_empty_shards(folder):
+    """Delete the shard folders of a removed stored file (ab/cd/, then ab/) if empty."""
+    for _ in range(2):
+        try:
+            os.rmdir(folder)
+        except OSError:
+            return  # Not empty, or already deleted
+        folder = os.path.dirname(folder)
+
+
+def immutable_cache_headers(response):
+    """
+    after_request hook giving stored files and their variants far-future immutable
+    caching, since a new upload always gets a new URL.
+    """
+    if (
+        request.endpoint == "static"
+        and response.status_code == 200
+        and request.view_args.get("filename", "").startswith(IMMUTABLE_FOLDERS)
+    ):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    return response
+
+
+def register_referenced(upload_folder):
+    """
+    Register the stored files that posts or users reference but that have no
+    StoredFile row, e.g. copied from another instance along with an import. Their
+    reference counts are set by StoredFile.reconcile_references().
+    :return: Number of referenced stored files missing from the upload folder.
+    """
+    missing = 0
+    known = StoredFile.select(StoredFile.path)
+    for field in (Post.image, User.profile_picture):
+        paths = (
+            field.model.select(field)
+            .where(field.startswith(STORE_FOLDER + "/") & field.not_in(known))
+            .distinct()
+            .tuples()
+        )
+        for (path,) in list(paths):
+            full_path = os.path.join(upload_folder, path)
+            if os.path.exists(full_path):
+                StoredFile.insert(path=path, size=os.path.getsize(full_path)).on_conflict_ignore().execute()
+            else:
+                missing += 1
+    return missing
+
+
+def collect_orphans(upload_folder):
+    """
+    Delete files in the store that have no StoredFile row, e.g. left by a crash
+    between storing an upload and committing its reference.
+    :return: List of the deleted paths.
+    """
+    # Uploads hold the write lock from registering a file until they commit
+    with db.atomic("IMMEDIATE"):
+        stored = {stored.path for stored in StoredFile.select(StoredFile.path)}
+        pattern = os.path.join(upload_folder, STORE_FOLDER, "*", "*", "*")
+        orphans = [
+            path
+            for path in (
+                os.path.relpath(full_path, upload_folder).replace(os.sep, "/")
+                for full_path in glob.glob(pattern)
+            )
+            if path not in stored
+        ]
+        for path in orphans:
+            remove_file(upload_folder, path)
+    return orphans
@@ -0,0 +1,59 @@
+from peewee import Value
+
+from app.models import Tag, PostTag, FacetCount
+
+
+def parse_tags(text):
+    """
+    Split a comma-separated tag list, dropping blanks and repeated tags.
+    :param text: e.g. "python, flask, ,python"
+    :return: List of tag names in their original order, e.g. ["python", "flask"].
+    """
+    names = (name.strip() for name in (text or "").split(","))
+    return list(dict.fromkeys(name for name in names if name))
+
+
+def set_post_tags(post, names):
+    """
+    Replace the tags of a post with set-based writes: the current tags are diffed
+    with the new ones, missing tags are created with one INSERT OR IGNORE, and the
+    links are added (INSERT ... SELECT) and removed with one statement each, so the
+    number of queries doesn't depend on the number of tags. The tag counts of the
+    facet sidebar are adjusted the same way.
+    Call inside the transaction saving the post.
+    :param post: Saved Post object.
+    :param names: List of tag names, see parse_tags().
+    :return: (added tag names, removed tag names)
+    """
+    current = dict(
+        PostTag.select(Tag.name, Tag.id)
+        .join(Tag)
+        .where(PostTag.post == post.id)
+        .tuples()
+    )
+    added = [name for name in names if name not in current]
+    removed = [name for name in current if name not in names]
+
+    if added:
+        Tag.insert_many([{"name": name} for name in added]).on_conflict_ignore().execute()
+        # Link the post to the ids of the new tags, existing or just created
+        PostTag.insert_from(
+            Tag.select(Value(post.id), Tag.id).where(Tag.name.in_(added)),
+            [PostTag.post, PostTag.tag],
+        ).on_conflict_ignore().execute()
+        FacetCount.insert_from(
+            Tag.select(Value("tag"), Tag.id, Value(1)).where(Tag.name.in_(added)),
+            [FacetCount.facet, FacetCount.value, FacetCount.count],
+        ).on_conflict(
+            conflict_target=[FacetCount.facet, FacetCount.value],
+            update={FacetCount.count: FacetCount.count + 1},
+        ).execute()
+    if removed:
+        removed_ids = [current[name] for name in removed]
+        PostTag.delete().where(
+            (PostTag.post == post.id) & PostTag.tag.in_(removed_ids)
+        ).execute()
+        FacetCount.adjust("tag", removed_ids, -1)
+
+    post.tag_names = sorted(names)  # Same order as attach_tag_names()
+    return added, removed
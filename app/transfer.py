@@ -0,0 +1,296 @@
+import datetime
+import json
+import uuid
+
+from peewee import fn
+
+from app.database import db
+from app.models import (
+    User,
+    Category,
+    Tag,
+    Post,
+    PostTag,
+    Comment,
+    Rating,
+    StoredFile,
+    MonthlyPostCount,
+    FacetCount,
+    ImportCheckpoint,
+    ImportedRow,
+)
+from app import search
+from app import caching
+from app import rendering
+from app import storage
+from app.trending import trending
+
+# Version of the NDJSON format, in the header line of every export
+FORMAT_VERSION = 1
+
+# Rows inserted per transaction by an import
+CHUNK_SIZE = 500
+
+# Exported record types and their fields, in dependency order: a record only
+# references records of the types before it. Derived data (rating aggregates,
+# comment counts, rendered HTML, image variants, counters, search index) isn't
+# exported; the import recomputes it.
+EXPORTED = {
+    "user": (
+        User,
+        [
+            "id",
+            "username",
+            "email",
+            "password_hash",
+            "role",
+            "bio",
+            "profile_picture",
+            "created_at",
+            "is_active",
+        ],
+    ),
+    "category": (Category, ["id", "name"]),
+    "tag": (Tag, ["id", "name"]),
+    "post": (
+        Post,
+        ["id", "title", "content", "author", "category", "image", "created_at", "updated_at"],
+    ),
+    "post_tag": (PostTag, ["post", "tag"]),
+    "comment": (Comment, ["id", "post", "author", "content", "created_at"]),
+    "rating": (Rating, ["id", "post", "user", "rating", "created_at"]),
+}
+
+# Foreign keys of each record type: field -> referenced record type
+REFERENCES = {
+    "post": {"author": "user", "category": "category"},
+    "post_tag": {"post": "post", "tag": "tag"},
+    "comment": {"post": "post", "author": "user"},
+    "rating": {"post": "post", "user": "user"},
+}
+
+# Unique fields by which imported records are matched with existing rows, which
+# are then reused instead of inserted (e.g. a tag both instances have)
+NATURAL_KEYS = {"user": ("username", "email"), "category": ("name",), "tag": ("name",)}
+
+
+class TransferError(Exception):
+    """The file to import isn't a valid export."""
+
+
+def _json_value(value):
+    # Datetimes in the text format SQLite stores them in, which peewee parses back
+    return str(value) if isinstance(value, datetime.datetime) else value
+
+
+def export_records():
+    """
+    Generate the records of an export: a header, then every exported row as a dict
+    with its `type`. Rows are streamed from the database cursor, so memory use
+    doesn't depend on the size of the database. Everything is read in one
+    transaction, so the export is a consistent snapshot even while the app writes.
+    Requires an open connection.
+    """
+    yield {
+        "type": "header",
+        "format": FORMAT_VERSION,
+        "export_id": uuid.uuid4().hex,
+        "exported_at": str(datetime.datetime.utcnow()),
+    }
+    with db.atomic():
+        for kind, (model, fields) in EXPORTED.items():
+            columns = [getattr(model, name) for name in fields]
+            order = [PostTag.post, PostTag.tag] if model is PostTag else [model.id]
+            query = model.select(*columns).order_by(*order)
+            for row in query.tuples().iterator():
+                record = {"type": kind}
+                record.update(zip(fields, map(_json_value, row)))
+                yield record
+
+
+def export_ndjson():
+    """Generate the lines of an export, one JSON record per line."""
+    for record in export_records():
+        yield json.dumps(record, separators=(",", ":"), ensure_ascii=False) + "\n"
+
+
+def export_chunks(size=64 * 1024):
+    """Generate the export in chunks of about `size` bytes, for streaming responses."""
+    buffer, length = [], 0
+    for line in export_ndjson():
+        buffer.append(line)
+        length += len(line)
+        if length >= size:
+            yield "".join(buffer)
+            buffer, length = [], 0
+    if buffer:
+        yield "".join(buffer)
+
+
+def _parse(line, number):
+    try:
+        record = json.loads(line)
+    except ValueError as e:
+        raise TransferError(f"Line {number}: invalid JSON ({e})")
+    if not isinstance(record, dict) or record.get("type") not in EXPORTED:
+        raise TransferError(f"Line {number}: unknown record type")
+    return record
+
+
+def import_ndjson(lines, upload_folder=None, chunk_size=CHUNK_SIZE, restart=False):
+    """
+    Import an export into this database, next to the existing content.
+
+    Records are inserted in chunks of `chunk_size`, each in its own transaction
+    with multi-row INSERTs. Users, categories and tags that already exist (same
+    username or email, same name) are reused. Every other record gets a new id,
+    and the foreign keys referencing it are remapped through ImportedRow. Each
+    chunk commits the import's checkpoint with its rows, so after an interruption
+    the same file can be imported again and resumes after the last committed
+    chunk. The derived data is recomputed once everything is imported.
+    Requires an open connection, outside a transaction.
+    :param lines: Iterable of the lines of the export, e.g. the open file.
+    :param upload_folder: Upload folder, to register the stored files the imported
+        posts and users reference (copy them there before importing).
+    :param chunk_size: Records per transaction.
+    :param restart: Import the file again from the start, even if it was imported.
+    :return: Dict of counts: "<type>" records inserted, "matched" existing rows
+        reused, "skipped" records whose references are missing, "resumed" lines
+        skipped because an earlier run committed them, "missing_uploads" stored
+        files referenced by the imported rows but not found in the upload folder.
+    :raise TransferError: If the file isn't a valid export or was already imported.
+    """
+    lines = iter(lines)
+    try:
+        header = json.loads(next(lines, "") or "null")
+    except ValueError:
+        header = None
+    if not isinstance(header, dict) or header.get("type") != "header":
+        raise TransferError("Line 1: missing export header")
+    if header.get("format") != FORMAT_VERSION or not header.get("export_id"):
+        raise TransferError(f"Unsupported export format {header.get('format')}")
+    export_id = header["export_id"]
+
+    with db.atomic():
+        if restart:
+            ImportCheckpoint.delete().where(ImportCheckpoint.export_id == export_id).execute()
+            ImportedRow.delete().where(ImportedRow.export_id == export_id).execute()
+        checkpoint, _ = ImportCheckpoint.get_or_create(export_id=export_id)
+    if checkpoint.completed:
+        raise TransferError("This export was already imported (use --restart to import it again)")
+
+    counts = {"matched": 0, "skipped": 0, "resumed": checkpoint.line and checkpoint.line - 1}
+    kind, chunk, last = None, [], checkpoint.line
+    for number, line in enumerate(lines, start=2):
+        if number <= checkpoint.line or not line.strip():
+            continue
+        record = _parse(line, number)
+        if chunk and (record["type"] != kind or len(chunk) >= chunk_size):
+            _import_chunk(export_id, kind, chunk, last, counts)
+            chunk = []
+        kind = record["type"]
+        chunk.append(record)
+        last = number
+    if chunk:
+        _import_chunk(export_id, kind, chunk, last, counts)
+
+    counts["missing_uploads"] = _rebuild_derived_data(upload_folder)
+    with db.atomic():
+        ImportCheckpoint.update(completed=True, updated_at=datetime.datetime.utcnow()).where(
+            ImportCheckpoint.export_id == export_id
+        ).execute()
+        # The remapping is only needed to resume
+        ImportedRow.delete().where(ImportedRow.export_id == export_id).execute()
+    caching.invalidate_feed()
+    caching.page_cache.clear()
+    return counts
+
+
+def _new_ids(export_id, kind, old_ids):
+    """Map exported ids of a record type to the ids given by this import."""
+    rows = ImportedRow.select(ImportedRow.old_id, ImportedRow.new_id).where(
+        (ImportedRow.export_id == export_id)
+        & (ImportedRow.kind == kind)
+        & ImportedRow.old_id.in_(list(old_ids))
+    )
+    return dict(rows.tuples())
+
+
+def _existing_ids(kind, records):
+    """Map the exported ids of records matching existing rows to their ids."""
+    model = EXPORTED[kind][0]
+    existing = {}
+    for name in NATURAL_KEYS[kind]:
+        field = getattr(model, name)
+        by_value = {record[name]: record["id"] for record in records}
+        for row_id, value in model.select(model.id, field).where(field.in_(list(by_value))).tuples():
+            existing.setdefault(by_value[value], row_id)
+    return existing
+
+
+def _import_chunk(export_id, kind, records, line, counts):
+    model, fields = EXPORTED[kind]
+    # Take the write lock first, so the ids picked below stay free until the commit
+    with db.atomic("IMMEDIATE"):
+        for field, referenced in REFERENCES.get(kind, {}).items():
+            mapping = _new_ids(export_id, referenced, {record[field] for record in records})
+            kept = []
+            for record in records:
+                if record[field] in mapping:
+                    record[field] = mapping[record[field]]
+                elif record[field] is not None:
+                    counts["skipped"] += 1  # e.g. a hand-edited file missing the row
+                    continue
+                kept.append(record)
+            records = kept
+
+        mapped = {}
+        if kind in NATURAL_KEYS:
+            mapped = _existing_ids(kind, records)
+            counts["matched"] += len(mapped)
+            records = [record for record in records if record["id"] not in mapped]
+
+        if "id" in fields:
+            # New ids are given here rather than by SQLite, so they are known
+            # without reading the rows back
+            next_id = (model.select(fn.MAX(model.id)).scalar() or 0) + 1
+            for offset, record in enumerate(records):
+                mapped[record["id"]] = next_id + offset
+                record["id"] = next_id + offset
+            if kind in ("user", "category", "tag", "post"):
+                ImportedRow.insert_many(
+                    [
+                        {"export_id": export_id, "kind": kind, "old_id": old_id, "new_id": new_id}
+                        for old_id, new_id in mapped.items()
+                    ]
+                ).on_conflict_replace().execute()
+
+        rows = [{name: record[name] for name in fields} for record in records]
+        if rows:
+            # A post carries a tag once and a user rates a post once
+            model.insert_many(rows).on_conflict_ignore().execute()
+        counts[kind] = counts.get(kind, 0) + len(rows)
+
+        ImportCheckpoint.update(line=line, updated_at=datetime.datetime.utcnow()).where(
+            ImportCheckpoint.export_id == export_id
+        ).execute()
+
+
+def _rebuild_derived_data(upload_folder):
+    """
+    Recompute the data derived from the imported rows.
+    :return: Number of stored files referenced but missing from the upload folder.
+    """
+    missing = 0
+    with db.atomic():
+        Rating.reconcile_aggregates(fix=True)
+        Comment.refresh_counts()
+        MonthlyPostCount.rebuild()
+        FacetCount.rebuild()
+        if upload_folder:
+            missing = storage.register_referenced(upload_folder)
+            StoredFile.reconcile_references(fix=True)
+    search.rebuild_index()
+    trending.rebuild()
+    rendering.rerender_stale_posts()  # The imported posts have no rendered HTML
+    return missing
@@ -0,0 +1,211 @@
+import datetime
+import logging
+import os
+import threading
+import time
+
+from peewee import chunked
+
+from app.database import db
+from app.models import Post, Comment, Rating, ChangeStamp, TrendingScore
+from app.caching import invalidate_feed
+from app.writer import write_queue
+
+logger = logging.getLogger(__name__)
+
+# Weight of each event adding to a post's score. A rating weighs RATING_WEIGHT
+# times its value out of 5, so both the number of ratings and their average count.
+POST_WEIGHT = 1.0
+COMMENT_WEIGHT = 1.0
+RATING_WEIGHT = 2.0
+
+# Events older than this many half-lives are ignored (they add less than 0.1%)
+WINDOW_HALF_LIVES = 10
+
+# Name of the ChangeStamp recording the last decay sweep
+SWEEP_STAMP = "trending"
+
+BATCH_SIZE = 500
+
+
+class TrendingScores:
+    """
+    Trending ranking of the posts, materialized in the TrendingScore table.
+
+    The score of a post is the sum of its events (being published, comments and
+    ratings), each decayed exponentially with its age:
+    score = sum(weight * 0.5 ** (age / half life)).
+    The scores of a post are recomputed when it's created and after its comments
+    and ratings are committed. A background thread decays every stored score to
+    the current time each `sweep_interval` seconds and drops the ones below
+    `min_score`, so the trending feed is a top-N read of a small indexed table.
+    """
+
+    def __init__(self, half_life_hours=24.0, min_score=0.01, sweep_interval=300.0):
+        self.half_life_hours = half_life_hours
+        self.min_score = min_score
+        self.sweep_interval = sweep_interval
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._refreshed = 0
+        self._sweeps = 0
+        self._last_sweep = 0.0
+
+    def decay(self, age):
+        """Factor by which a score decays over `age` (a timedelta)."""
+        hours = max(age.total_seconds(), 0) / 3600
+        return 0.5 ** (hours / self.half_life_hours)
+
+    def compute(self, now, post_ids=None):
+        """
+        Score posts from their recent events.
+        :param now: Time the scores are computed for.
+        :param post_ids: Posts to score; every post with recent events if None.
+        :return: Dict of post id -> score, for the posts with recent events.
+        """
+        since = now - datetime.timedelta(hours=self.half_life_hours * WINDOW_HALF_LIVES)
+        posts = Post.select(Post.id, Post.created_at).where(Post.created_at >= since)
+        comments = Comment.select(Comment.post, Comment.created_at).where(
+            Comment.created_at >= since
+        )
+        ratings = Rating.select(Rating.post, Rating.created_at, Rating.rating).where(
+            Rating.created_at >= since
+        )
+        if post_ids is not None:
+            post_ids = list(post_ids)
+            posts = posts.where(Post.id.in_(post_ids))
+            comments = comments.where(Comment.post.in_(post_ids))
+            ratings = ratings.where(Rating.post.in_(post_ids))
+
+        scores = {}
+        for post_id, created_at in posts.tuples():
+            scores[post_id] = scores.get(post_id, 0.0) + POST_WEIGHT * self.decay(now - created_at)
+        for post_id, created_at in comments.tuples():
+            scores[post_id] = scores.get(post_id, 0.0) + COMMENT_WEIGHT * self.decay(
+                now - created_at
+            )
+        for post_id, created_at, rating in ratings.tuples():
+            scores[post_id] = scores.get(post_id, 0.0) + RATING_WEIGHT * rating / 5 * self.decay(
+                now - created_at
+            )
+        return scores
+
+    def _store(self, scores, now):
+        # Upsert the scores above the threshold, drop the rest
+        rows = [
+            {"post": post_id, "score": score, "computed_at": now}
+            for post_id, score in scores.items()
+            if score >= self.min_score
+        ]
+        for batch in chunked(rows, BATCH_SIZE):
+            TrendingScore.insert_many(batch).on_conflict(
+                conflict_target=[TrendingScore.post],
+                preserve=[TrendingScore.score, TrendingScore.computed_at],
+            ).execute()
+        dropped = [post_id for post_id, score in scores.items() if score < self.min_score]
+        for batch in chunked(dropped, BATCH_SIZE):
+            TrendingScore.delete().where(TrendingScore.post.in_(batch)).execute()
+
+    def refresh(self, post_ids):
+        """
+        Recompute the scores of some posts, e.g. after they got comments or ratings.
+        Can be called inside the transaction writing the change.
+        """
+        post_ids = set(post_ids)
+        if not post_ids:
+            return
+        now = datetime.datetime.utcnow()
+        scores = self.compute(now, post_ids)
+        # Posts without recent events (or deleted) lose their score
+        scores.update({post_id: 0.0 for post_id in post_ids - set(scores)})
+        with db.atomic():
+            self._store(scores, now)
+        with self._stats_lock:
+            self._refreshed += len(post_ids)
+
+    def rebuild(self):
+        """
+        Recompute every score from the events.
+        :return: Number of posts with a score.
+        """
+        now = datetime.datetime.utcnow()
+        scores = self.compute(now)
+        with db.atomic():
+            TrendingScore.delete().execute()
+            self._store(scores, now)
+        return TrendingScore.select().count()
+
+    def sweep(self, force=False):
+        """
+        Decay every stored score to the current time, dropping the ones below the
+        threshold. Skipped if another process swept less than half an interval ago.
+        :return: Whether the scores were swept.
+        """
+        started = time.perf_counter()
+        now = datetime.datetime.utcnow()
+        # Take the write lock first, so two processes can't both sweep
+        with db.atomic("IMMEDIATE"):
+            _, last_sweep = ChangeStamp.current(SWEEP_STAMP)
+            if not force and now - last_sweep < datetime.timedelta(seconds=self.sweep_interval / 2):
+                return False
+            rows = TrendingScore.select(
+                TrendingScore.post, TrendingScore.score, TrendingScore.computed_at
+            ).tuples()
+            scores = {
+                post_id: score * self.decay(now - computed_at)
+                for post_id, score, computed_at in rows
+            }
+            self._store(scores, now)
+            ChangeStamp.bump(SWEEP_STAMP)
+        if scores:
+            invalidate_feed()  # The trending order of the cached feed pages changed
+        with self._stats_lock:
+            self._sweeps += 1
+            self._last_sweep = time.perf_counter() - started
+        return True
+
+    def ensure_started(self):
+        """Start the sweeping thread of this process if it isn't running."""
+        # Threads don't survive fork(), so each server worker starts its own
+        if self.sweep_interval <= 0 or (
+            self._thread is not None and self._thread.is_alive() and self._pid == os.getpid()
+        ):
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive() or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(
+                    target=self._run, name="trending-sweep", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                with db.connection_context():
+                    self.sweep()
+            except Exception:
+                logger.exception("Trending sweep failed")
+
+    def stats(self):
+        """Refresh and sweep counters."""
+        with self._stats_lock:
+            return {
+                "half_life_hours": self.half_life_hours,
+                "refreshed_posts": self._refreshed,
+                "sweeps": self._sweeps,
+                "last_sweep_ms": round(self._last_sweep * 1000, 3),
+            }
+
+
+# Shared trending scores used by the routes
+trending = TrendingScores()
+
+
+@write_queue.on_flush
+def _refresh_after_flush(commented, rated):
+    """Rescore the posts that got comments or ratings once they are committed."""
+    trending.refresh(commented | rated)
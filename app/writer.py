@@ -0,0 +1,209 @@
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from peewee import EXCLUDED
+
+from app.database import db
+from app.models import Comment, Rating
+from app.caching import touch_posts, forget_posts
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindQueue:
+    """
+    In-process write-behind queue for comments and ratings.
+
+    Requests submit writes to the queue instead of committing them on their own.
+    A single writer thread collects everything submitted within `flush_interval`
+    seconds and commits it in one transaction: comments with one multi-row INSERT
+    and ratings with one INSERT ... ON CONFLICT(post, user) DO UPDATE, where
+    repeated ratings of the same post by the same user collapse to the latest one.
+    Under bursts this turns many competing write transactions into a few.
+
+    Each submit returns a Future that is resolved once the write is committed, so
+    callers can wait for durability or return immediately.
+    """
+
+    def __init__(self, flush_interval=0.005, max_batch=500):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._flushes = 0
+        self._written = 0
+        self._failed = 0
+        self._last_flush = 0.0
+        self._max_flush = 0.0
+        self._total_flush = 0.0
+        # Hooks called with (comment post ids, rated post ids) after each commit
+        self._listeners = []
+
+    def configure(self, flush_interval=None, max_batch=None):
+        """Change the flush interval (seconds) and the maximum writes per transaction."""
+        if flush_interval is not None:
+            self.flush_interval = flush_interval
+        if max_batch is not None:
+            self.max_batch = max_batch
+
+    def on_flush(self, listener):
+        """
+        Register a function called after every committed batch with the set of post
+        ids that received comments and the set of post ids that received ratings.
+        """
+        self._listeners.append(listener)
+        return listener
+
+    def add_comment(self, post_id, author_id, content):
+        """
+        Queue a new comment.
+        :return: Future resolved when the comment is committed.
+        """
+        return self._submit(
+            ("comment", {"post": post_id, "author": author_id, "content": content})
+        )
+
+    def rate(self, post_id, user_id, score):
+        """
+        Queue a rating, replacing the user's previous rating of the post if any.
+        :return: Future resolved when the rating is committed.
+        """
+        return self._submit(("rating", {"post": post_id, "user": user_id, "rating": score}))
+
+    def stats(self):
+        """Queue depth and flush latency (milliseconds) counters."""
+        with self._stats_lock:
+            flushes = self._flushes
+            return {
+                "depth": self._queue.qsize(),
+                "flushes": flushes,
+                "written": self._written,
+                "failed": self._failed,
+                "last_flush_ms": round(self._last_flush * 1000, 3),
+                "max_flush_ms": round(self._max_flush * 1000, 3),
+                "avg_flush_ms": round(self._total_flush * 1000 / flushes, 3) if flushes else 0,
+            }
+
+    def _submit(self, item):
+        future = Future()
+        self._ensure_started()
+        self._queue.put((item, future))
+        return future
+
+    def _ensure_started(self):
+        # Threads don't survive fork(), so a forked worker starts its own writer
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive() or self._pid != os.getpid():
+                if self._pid != os.getpid():
+                    # Writes queued in the parent process belong to the parent
+                    self._queue = queue.Queue()
+                self._pid = os.getpid()
+                self._thread = threading.Thread(
+                    target=self._run, name="write-behind", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            # Give concurrent requests a moment to join this transaction
+            deadline = time.perf_counter() + self.flush_interval
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self._flush(batch)
+            except Exception as e:
+                # e.g. no connection could be taken from the pool
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _flush(self, batch):
+        started = time.perf_counter()
+        with db.connection_context():
+            try:
+                commented, rated = self._write(batch)
+            except Exception:
+                # Commit the rest of the batch, failing only the writes that error
+                commented, rated = set(), set()
+                for entry in batch:
+                    try:
+                        written = self._write([entry])
+                    except Exception as e:
+                        entry[1].set_exception(e)
+                        with self._stats_lock:
+                            self._failed += 1
+                    else:
+                        commented |= written[0]
+                        rated |= written[1]
+                batch = [entry for entry in batch if not entry[1].done()]
+
+            elapsed = time.perf_counter() - started
+            with self._stats_lock:
+                self._flushes += 1
+                self._written += len(batch)
+                self._last_flush = elapsed
+                self._max_flush = max(self._max_flush, elapsed)
+                self._total_flush += elapsed
+
+            forget_posts(commented | rated, feed=bool(rated))
+
+            # The writes are committed; a failing listener must not fail them
+            for listener in self._listeners:
+                try:
+                    listener(commented, rated)
+                except Exception:
+                    logger.exception("Write-behind listener %r failed", listener)
+
+        for _, future in batch:
+            future.set_result(True)
+
+    @staticmethod
+    def _write(batch):
+        """
+        Commit a batch of writes in one transaction.
+        :return: (post ids that received comments, post ids that received ratings)
+        """
+        comments = [data for (kind, data), _ in batch if kind == "comment"]
+        # Later ratings by the same user of the same post supersede earlier ones
+        ratings = {}
+        for (kind, data), _ in batch:
+            if kind == "rating":
+                ratings[(data["post"], data["user"])] = data
+
+        with db.atomic():
+            if comments:
+                Comment.insert_many(comments).execute()
+                Comment.refresh_counts({data["post"] for data in comments})
+            if ratings:
+                Rating.insert_many(list(ratings.values())).on_conflict(
+                    conflict_target=[Rating.post, Rating.user],
+                    update={Rating.rating: EXCLUDED.rating},
+                ).execute()
+                Rating.refresh_aggregates({post for post, _ in ratings})
+
+            commented = {data["post"] for data in comments}
+            rated = {post for post, _ in ratings}
+            # Ratings change the popularity order of the feed, comments don't show on it
+            touch_posts(commented | rated, feed=bool(rated))
+
+        return commented, rated
+
+
+# Shared queue used by the routes
+write_queue = WriteBehindQueue()
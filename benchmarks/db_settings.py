@@ -0,0 +1,129 @@
+"""
+Concurrent read/write throughput of the SQLite settings used by the app.
+
+Compares the old setup (default rollback journal and pragmas, a new connection
+opened and closed around every request) with the tuned setup from
+app/database.py (WAL, synchronous=NORMAL, cache/mmap, busy_timeout, pooled
+connections). Reader threads run the homepage feed query while writer threads
+insert comments, each operation standing in for one request.
+
+Usage: python benchmarks/db_settings.py [--readers 8] [--writers 2] [--seconds 5]
+"""
+
+import argparse
+import datetime
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from peewee import OperationalError, SqliteDatabase  # noqa: E402
+
+from app.database import db, init_database, load_config  # noqa: E402
+from app.models import User, Post, Category, Comment  # noqa: E402
+from app.schema import MODELS, migrate_database  # noqa: E402
+
+
+def seed(path, posts=2000):
+    """Create a database with one author, one category and some posts."""
+    database = SqliteDatabase(path)
+    with database.bind_ctx(MODELS), database.connection_context():
+        database.create_tables(MODELS)
+        with database.atomic():
+            author = User.create(username="bench", email="bench@example.com", password_hash="x")
+            category = Category.create(name="bench")
+            now = datetime.datetime.utcnow()
+            Post.insert_many(
+                [
+                    {
+                        "title": f"Post {i}",
+                        "content": "Lorem ipsum dolor sit amet. " * 40,
+                        "author": author.id,
+                        "category": category.id,
+                        "created_at": now - datetime.timedelta(minutes=i),
+                        "updated_at": now,
+                    }
+                    for i in range(posts)
+                ]
+            ).execute()
+    database.close()
+
+
+def run(database, readers, writers, seconds):
+    """
+    Run reader and writer threads against the database for a fixed duration.
+    :return: Dict with read/write counts and lock errors.
+    """
+    counts = {"reads": 0, "writes": 0, "errors": 0}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def request(operation, key):
+        while time.perf_counter() < deadline:
+            try:
+                database.connect(reuse_if_open=True)
+                operation()
+            except OperationalError:
+                key_done = "errors"
+            else:
+                key_done = key
+            finally:
+                database.close()
+            with lock:
+                counts[key_done] += 1
+
+    def read():
+        list(Post.select().order_by(Post.created_at.desc(), Post.id.desc()).limit(12))
+
+    def write():
+        with database.atomic():
+            Comment.create(content="Nice post!", post=1, author=1)
+
+    threads = [threading.Thread(target=request, args=(read, "reads")) for _ in range(readers)]
+    threads += [threading.Thread(target=request, args=(write, "writes")) for _ in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return counts
+
+
+def report(name, counts, seconds):
+    print(
+        f"{name:<9} reads/s={counts['reads'] / seconds:>9.1f}  "
+        f"writes/s={counts['writes'] / seconds:>8.1f}  lock errors={counts['errors']}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=2)
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Before: what create_app() used to do
+        path = os.path.join(tmp, "baseline.db")
+        seed(path)
+        baseline = SqliteDatabase(path, check_same_thread=False)
+        with baseline.bind_ctx(MODELS):
+            report("baseline", run(baseline, args.readers, args.writers, args.seconds), args.seconds)
+
+        # After: the configured pool and pragmas
+        path = os.path.join(tmp, "tuned.db")
+        seed(path)
+        config = load_config()
+        config["DATABASE"] = path
+        init_database(config)
+        with db.connection_context():
+            migrate_database()
+        report("tuned", run(db, args.readers, args.writers, args.seconds), args.seconds)
+        db.close_all()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,461 @@
+"""
+Latency, throughput and queries per request of every route of the blueprint.
+
+Each scenario sends requests to one route through the Flask test client from
+concurrent threads, every thread with its own client (and its own logged-in
+user for the routes that need one). The database is seeded with
+benchmarks/seed.py, or copied from --database, and every run starts from a
+fresh copy so runs are comparable.
+
+Results are printed and can be saved as JSON with --output. With --baseline,
+they are compared with a saved run and the exit status is 1 if a route got
+slower (or runs more queries) by more than --tolerance. The exit status is also
+1 if every request of a scenario failed, whose timings would be meaningless.
+
+Usage: python benchmarks/routes.py [--posts 5000] [--requests 200] [--threads 4]
+       [--only index,view_post] [--output run.json] [--baseline base.json]
+"""
+
+import argparse
+import contextlib
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from seed import PASSWORD, seed  # noqa: E402
+
+# Queries run by the current thread, counted by the patched db.execute_sql()
+_counter = threading.local()
+
+
+class Scenario:
+    """
+    One route under load.
+    :param request: Function (rng, session) -> (method, url, form data or None).
+    :param user: "user" to log in as a seeded user, "admin" as the admin, or None.
+    :param prepare: Function (rng, session) run before each request, not measured.
+    """
+
+    def __init__(self, name, request, user=None, prepare=None):
+        self.name = name
+        self.request = request
+        self.user = user
+        self.prepare = prepare
+
+
+class Session:
+    """A test client of one thread, with what the scenarios need to know about the data."""
+
+    def __init__(self, app, dataset, user_id, thread):
+        self.client = app.test_client()
+        self.dataset = dataset
+        self.user_id = user_id
+        self.thread = thread
+        self.own_posts = []
+        self.counter = 0
+
+    def login(self, user_id):
+        return self.client.post(
+            "/login", data={"username": f"user{user_id}", "password": PASSWORD}
+        )
+
+    def unique(self):
+        self.counter += 1
+        return f"t{self.thread}n{self.counter}"
+
+
+def _word(rng):
+    return rng.choice(("flask", "sqlite", "cache", "travel", "python", "archive"))
+
+
+def _post(rng, session):
+    return rng.randint(1, session.dataset["posts"])
+
+
+def _post_form(rng, session):
+    return {
+        "title": f"Benchmark post {session.unique()}",
+        "content": "Some **Markdown** with a [link](https://example.com).\n\n- one\n- two",
+        "category": rng.randint(1, session.dataset["categories"]),
+        "new_category": "",
+        "tags": ", ".join(f"tag{rng.randint(1, session.dataset['tags'])}" for _ in range(3)),
+    }
+
+
+def _create_own_post(rng, session):
+    """Create a post of the session's user, without measuring it."""
+    response = session.client.post("/create_post", data=_post_form(rng, session))
+    location = response.headers.get("Location", "")
+    if "/post/" in location:
+        session.own_posts.append(int(location.rstrip("/").rsplit("/", 1)[1]))
+
+
+def _own_post(rng, session):
+    if not session.own_posts:
+        _create_own_post(rng, session)
+    return rng.choice(session.own_posts)
+
+
+def _pop_own_post(rng, session):
+    _create_own_post(rng, session)
+    return session.own_posts.pop()
+
+
+def _month(rng, session):
+    # Seeded posts are spread over the year before EPOCH
+    return rng.choice([(2024, month) for month in range(1, 13)])
+
+
+def _register(rng, session):
+    name = f"bench{session.unique()}x{rng.randrange(10**9)}"
+    return (
+        "POST",
+        "/register",
+        {
+            "username": name,
+            "email": f"{name}@example.com",
+            "password": PASSWORD,
+            "confirm_password": PASSWORD,
+        },
+    )
+
+
+SCENARIOS = [
+    Scenario("index", lambda rng, s: ("GET", "/", None)),
+    Scenario("index_logged_in", lambda rng, s: ("GET", "/", None), user="user"),
+    Scenario("index_popularity", lambda rng, s: ("GET", "/?sort_by=popularity", None), user="user"),
+    Scenario("index_trending", lambda rng, s: ("GET", "/?sort_by=trending", None), user="user"),
+    Scenario(
+        "index_category",
+        lambda rng, s: ("GET", f"/?category=Category%20{rng.randint(1, s.dataset['categories'])}", None),
+        user="user",
+    ),
+    Scenario("index_search", lambda rng, s: ("GET", f"/?q={_word(rng)}", None), user="user"),
+    Scenario(
+        "index_tag",
+        lambda rng, s: ("GET", f"/?q=%23tag{rng.randint(1, s.dataset['tags'])}", None),
+        user="user",
+    ),
+    Scenario(
+        "archive",
+        lambda rng, s: ("GET", "/archive/{}/{}".format(*_month(rng, s)), None),
+        user="user",
+    ),
+    Scenario("post_detail", lambda rng, s: ("GET", f"/post/{_post(rng, s)}", None)),
+    Scenario("view_post", lambda rng, s: ("GET", f"/view_post/{_post(rng, s)}", None), user="user"),
+    Scenario("post_comments", lambda rng, s: ("GET", f"/post/{_post(rng, s)}/comments", None)),
+    Scenario(
+        "view_post_comment",
+        lambda rng, s: ("POST", f"/view_post/{_post(rng, s)}", {"content": "Nice post!"}),
+        user="user",
+    ),
+    Scenario(
+        "add_comment",
+        lambda rng, s: ("POST", f"/post/{_post(rng, s)}/add_comment", {"content": "Thanks!"}),
+        user="user",
+    ),
+    Scenario(
+        "rate_post",
+        lambda rng, s: ("POST", f"/rate_post/{_post(rng, s)}", {"rating": rng.randint(1, 5)}),
+        user="user",
+    ),
+    Scenario(
+        "user_profile",
+        lambda rng, s: ("GET", f"/user/{rng.randint(1, s.dataset['users'])}", None),
+    ),
+    Scenario(
+        "api_posts",
+        lambda rng, s: (
+            "GET",
+            "/api/posts?ids=" + ",".join(str(_post(rng, s)) for _ in range(10)),
+            None,
+        ),
+    ),
+    Scenario("api_feed", lambda rng, s: ("GET", "/api/feed?exclude=content,content_html", None)),
+    Scenario("api_post_bundle", lambda rng, s: ("GET", f"/api/posts/{_post(rng, s)}", None)),
+    Scenario("register_form", lambda rng, s: ("GET", "/register", None)),
+    Scenario("register", _register),
+    Scenario("login_form", lambda rng, s: ("GET", "/login", None)),
+    Scenario(
+        "login",
+        lambda rng, s: (
+            "POST",
+            "/login",
+            {"username": f"user{rng.randint(2, s.dataset['users'])}", "password": PASSWORD},
+        ),
+    ),
+    Scenario(
+        "logout",
+        lambda rng, s: ("GET", "/logout", None),
+        prepare=lambda rng, s: s.login(s.user_id),
+    ),
+    Scenario("create_post_form", lambda rng, s: ("GET", "/create_post", None), user="user"),
+    Scenario(
+        "create_post",
+        lambda rng, s: ("POST", "/create_post", _post_form(rng, s)),
+        user="user",
+    ),
+    Scenario(
+        "edit_post_form",
+        lambda rng, s: ("GET", f"/edit_post/{_own_post(rng, s)}", None),
+        user="user",
+    ),
+    Scenario(
+        "edit_post",
+        lambda rng, s: ("POST", f"/edit_post/{_own_post(rng, s)}", _post_form(rng, s)),
+        user="user",
+    ),
+    Scenario(
+        "delete_post",
+        lambda rng, s: ("POST", f"/delete_post/{s.target}", None),
+        user="user",
+        prepare=lambda rng, s: setattr(s, "target", _pop_own_post(rng, s)),
+    ),
+    Scenario("admin_metrics", lambda rng, s: ("GET", "/admin/metrics", None), user="admin"),
+]
+
+
+def count_queries(db):
+    """Patch db.execute_sql() to count the queries of each thread."""
+    execute_sql = db.execute_sql
+
+    def counted(*args, **kwargs):
+        _counter.queries = getattr(_counter, "queries", 0) + 1
+        return execute_sql(*args, **kwargs)
+
+    db.execute_sql = counted
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a sorted list."""
+    if not values:
+        return 0.0
+    index = max(int(round(fraction * len(values) + 0.5)) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+def run_scenario(app, scenario, dataset, requests, threads, seed):
+    """
+    Send `requests` requests to a scenario's route from `threads` threads.
+    :return: Dict of the scenario's statistics.
+    """
+    sessions = []
+    for thread in range(threads):
+        # Seeded users 2.. are regular users, user1 is the admin
+        user_id = 1 if scenario.user == "admin" else 2 + thread % (dataset["users"] - 1)
+        session = Session(app, dataset, user_id, thread)
+        if scenario.user:
+            session.login(user_id)
+        sessions.append(session)
+
+    latencies, queries, statuses = [], [], {}
+    # Measured time of each thread, without the unmeasured prepare() calls
+    busy = [0.0] * threads
+    lock = threading.Lock()
+    barrier = threading.Barrier(threads + 1)
+
+    def worker(session, count):
+        rng = random.Random(f"{seed}-{scenario.name}-{session.thread}")
+        barrier.wait()
+        for _ in range(count):
+            if scenario.prepare:
+                scenario.prepare(rng, session)
+            method, url, data = scenario.request(rng, session)
+            _counter.queries = 0
+            started = time.perf_counter()
+            response = session.client.open(url, method=method, data=data)
+            elapsed = time.perf_counter() - started
+            busy[session.thread] += elapsed
+            with lock:
+                latencies.append(elapsed)
+                queries.append(_counter.queries)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    workers = [
+        threading.Thread(target=worker, args=(session, requests // threads + (i < requests % threads)))
+        for i, session in enumerate(sessions)
+    ]
+    for thread in workers:
+        thread.start()
+    barrier.wait()
+    for thread in workers:
+        thread.join()
+
+    latencies.sort()
+    elapsed = max(busy)
+    return {
+        "requests": len(latencies),
+        "errors": sum(count for status, count in statuses.items() if status >= 400),
+        "statuses": {str(status): count for status, count in sorted(statuses.items())},
+        "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "mean_ms": round(1000 * sum(latencies) / max(len(latencies), 1), 2),
+        "p50_ms": round(1000 * percentile(latencies, 0.50), 2),
+        "p95_ms": round(1000 * percentile(latencies, 0.95), 2),
+        "p99_ms": round(1000 * percentile(latencies, 0.99), 2),
+        "queries_per_request": round(sum(queries) / max(len(queries), 1), 2),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare results with a baseline run.
+    :return: List of (scenario, metric, baseline value, value) regressions.
+    """
+    regressions = []
+    for name, stats in results.items():
+        before = baseline.get(name)
+        if not before:
+            continue
+        for metric in ("p50_ms", "p95_ms", "p99_ms"):
+            if stats[metric] > before[metric] * (1 + tolerance):
+                regressions.append((name, metric, before[metric], stats[metric]))
+        if stats["throughput_rps"] < before["throughput_rps"] * (1 - tolerance):
+            regressions.append((name, "throughput_rps", before["throughput_rps"], stats["throughput_rps"]))
+        if stats["queries_per_request"] > before["queries_per_request"]:
+            regressions.append(
+                (name, "queries_per_request", before["queries_per_request"], stats["queries_per_request"])
+            )
+        if stats["errors"] > before["errors"]:
+            regressions.append((name, "errors", before["errors"], stats["errors"]))
+    return regressions
+
+
+def failed(stats):
+    """Whether every request of a scenario failed."""
+    return stats["requests"] > 0 and stats["errors"] == stats["requests"]
+
+
+def report(results, baseline=None):
+    print(
+        f"{'route':<20} {'reqs':>5} {'errors':>6} {'req/s':>8} {'p50 ms':>8} "
+        f"{'p95 ms':>8} {'p99 ms':>8} {'queries':>8}"
+    )
+    for name, stats in results.items():
+        if failed(stats):
+            statuses = ", ".join(f"{status}: {count}" for status, count in stats["statuses"].items())
+            print(f"{name:<20} {stats['requests']:>5} {stats['errors']:>6}  FAILED ({statuses})")
+            continue
+        line = (
+            f"{name:<20} {stats['requests']:>5} {stats['errors']:>6} {stats['throughput_rps']:>8.1f} "
+            f"{stats['p50_ms']:>8.2f} {stats['p95_ms']:>8.2f} {stats['p99_ms']:>8.2f} "
+            f"{stats['queries_per_request']:>8.2f}"
+        )
+        if baseline and name in baseline:
+            before = baseline[name]["p50_ms"]
+            change = (stats["p50_ms"] - before) / before * 100 if before else 0.0
+            line += f"  p50 {change:+.0f}%"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--database", help="Seeded database to copy, instead of seeding one.")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--posts", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=1, help="Random seed of the data and requests.")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per route.")
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--only", help="Comma-separated scenarios to run, e.g. index,view_post.")
+    parser.add_argument("--output", help="Save the results as JSON.")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare with.")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="Allowed slowdown, 0.2 = 20%%."
+    )
+    args = parser.parse_args()
+
+    scenarios = SCENARIOS
+    if args.only:
+        names = set(args.only.split(","))
+        unknown = names - {scenario.name for scenario in SCENARIOS}
+        if unknown:
+            parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+        scenarios = [scenario for scenario in SCENARIOS if scenario.name in names]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        if args.database:
+            shutil.copy(args.database, path)
+        else:
+            print(f"Seeding {args.posts} posts...")
+            seed(path, users=args.users, posts=args.posts, seed=args.seed)
+
+        # Read before the app opens the database
+        with contextlib.closing(sqlite3.connect(path)) as connection:
+            dataset = {
+                table: connection.execute(f"SELECT max(id) FROM {table}").fetchone()[0] or 0
+                for table in ("user", "post", "category", "tag")
+            }
+        dataset = {
+            "users": dataset["user"],
+            "posts": dataset["post"],
+            "categories": dataset["category"],
+            "tags": dataset["tag"],
+        }
+
+        os.environ["DATABASE"] = path
+        from app import create_app
+        from app.database import db
+
+        os.environ.setdefault("LOG_LEVEL", "WARNING")
+        app = create_app()
+        app.config["WTF_CSRF_ENABLED"] = False
+        # Errors are counted, their tracebacks would drown the report
+        app.logger.setLevel(logging.CRITICAL)
+        count_queries(db)
+
+        results = {}
+        for scenario in scenarios:
+            results[scenario.name] = run_scenario(
+                app, scenario, dataset, args.requests, args.threads, args.seed
+            )
+            print(f"{scenario.name}: {results[scenario.name]['p50_ms']} ms p50", file=sys.stderr)
+
+        db.close_all()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)["results"]
+    print()
+    report(results, baseline)
+
+    broken = [name for name, stats in results.items() if failed(stats)]
+    if broken:
+        # A failing route isn't measured; don't save it as a baseline either
+        print(f"\nFAILED: every request of {', '.join(broken)} returned an error")
+        sys.exit(1)
+
+    if args.output:
+        meta = {
+            "created_at": datetime.datetime.utcnow().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "dataset": dict(dataset, seed=args.seed),
+            "requests": args.requests,
+            "threads": args.threads,
+        }
+        with open(args.output, "w") as file:
+            json.dump({"meta": meta, "results": results}, file, indent=2)
+        print(f"\nSaved {args.output}")
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        for name, metric, before, after in regressions:
+            print(f"REGRESSION {name} {metric}: {before} -> {after}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
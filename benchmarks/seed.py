@@ -0,0 +1,234 @@
+"""
+Deterministic seed dataset for benchmarks.
+
+Builds an SQLite database with users, categories, tags, posts with Markdown
+content, comments and ratings. The same options always produce the same data,
+so benchmark results are comparable between runs. Rows are inserted in bulk and
+the derived data (rendered HTML, rating aggregates, archive counts, search index)
+is computed once at the end.
+
+Every seeded user can log in with the password "password"; the first one is an
+admin.
+
+Usage: python benchmarks/seed.py seed.db [--users 200] [--posts 5000] [--seed 1]
+"""
+
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from flask_bcrypt import generate_password_hash  # noqa: E402
+from peewee import chunked  # noqa: E402
+
+from app.database import db, init_database, load_config  # noqa: E402
+from app.models import (  # noqa: E402
+    User,
+    Post,
+    Comment,
+    Rating,
+    Category,
+    Tag,
+    PostTag,
+    MonthlyPostCount,
+)
+from app.schema import migrate_database  # noqa: E402
+from app import rendering, search  # noqa: E402
+
+PASSWORD = "password"
+
+# Creation times are spread over the year before this date
+EPOCH = datetime.datetime(2025, 1, 1)
+
+WORDS = (
+    "flask python sqlite query index cache latency request template render page "
+    "post comment rating author category tag archive search markdown image upload "
+    "server worker thread process pool connection transaction journal write read "
+    "fast slow simple small large blog travel food photo city mountain river code "
+    "the a of and to in is for on with that this it as be by from at or an"
+).split()
+
+BATCH_SIZE = 500
+
+
+def sentence(rng, words=(6, 16)):
+    text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(*words)))
+    return text.capitalize() + "."
+
+
+def markdown_body(rng):
+    """A post body using the usual Markdown constructs."""
+    blocks = []
+    for _ in range(rng.randint(2, 5)):
+        kind = rng.random()
+        if kind < 0.15:
+            blocks.append("## " + sentence(rng, (2, 5)).rstrip("."))
+        elif kind < 0.3:
+            blocks.append("\n".join("- " + sentence(rng, (3, 8)) for _ in range(rng.randint(2, 5))))
+        elif kind < 0.4:
+            code = "\n".join(f"    {rng.choice(WORDS)} = {rng.randint(0, 99)}" for _ in range(3))
+            blocks.append(code)
+        else:
+            words = [sentence(rng) for _ in range(rng.randint(2, 6))]
+            words[0] = f"**{words[0]}**"
+            if rng.random() < 0.5:
+                words.append(f"[{rng.choice(WORDS)}](https://example.com/{rng.choice(WORDS)})")
+            blocks.append(" ".join(words))
+    return "\n\n".join(blocks)
+
+
+def random_time(rng, after=None):
+    """A creation time in the year before EPOCH, later than `after` if given."""
+    start = after or EPOCH - datetime.timedelta(days=365)
+    span = max((EPOCH - start).total_seconds(), 1)
+    return start + datetime.timedelta(seconds=rng.uniform(0, span))
+
+
+def insert_all(model, rows):
+    for batch in chunked(rows, BATCH_SIZE):
+        model.insert_many(batch).execute()
+
+
+def seed(path, users=200, posts=5000, categories=12, tags=300, comments=5, ratings=8, seed=1):
+    """
+    Create a database at `path` and fill it with a deterministic dataset.
+    :param comments: Average number of comments per post.
+    :param ratings: Average number of ratings per post (at most one per user).
+    :return: Dict of row counts per table.
+    """
+    rng = random.Random(seed)
+    config = load_config()
+    config["DATABASE"] = path
+    init_database(config)
+
+    with db.connection_context():
+        migrate_database()
+        password_hash = generate_password_hash(PASSWORD).decode("utf-8")
+
+        with db.atomic():
+            insert_all(
+                User,
+                [
+                    {
+                        "id": i,
+                        "username": f"user{i}",
+                        "email": f"user{i}@example.com",
+                        "password_hash": password_hash,
+                        "role": "admin" if i == 1 else "user",
+                        "bio": sentence(rng),
+                        "created_at": random_time(rng),
+                    }
+                    for i in range(1, users + 1)
+                ],
+            )
+            insert_all(
+                Category, [{"id": i, "name": f"Category {i}"} for i in range(1, categories + 1)]
+            )
+            insert_all(Tag, [{"id": i, "name": f"tag{i}"} for i in range(1, tags + 1)])
+
+            post_times = {}
+            post_rows = []
+            for i in range(1, posts + 1):
+                content = markdown_body(rng)
+                created_at = random_time(rng)
+                post_times[i] = created_at
+                post_rows.append(
+                    {
+                        "id": i,
+                        "title": sentence(rng, (3, 8)).rstrip("."),
+                        "content": content,
+                        "content_html": rendering.render_markdown(content),
+                        "content_html_version": rendering.RENDERER_VERSION,
+                        # A few authors write most of the posts
+                        "author": min(int(rng.paretovariate(1.2)), users),
+                        "category": rng.randint(1, categories),
+                        "created_at": created_at,
+                        "updated_at": created_at,
+                        "changed_at": created_at,
+                    }
+                )
+            insert_all(Post, post_rows)
+
+            insert_all(
+                PostTag,
+                [
+                    {"post": post_id, "tag": tag_id}
+                    for post_id in post_times
+                    for tag_id in rng.sample(range(1, tags + 1), rng.randint(1, min(5, tags)))
+                ],
+            )
+
+            comment_rows = []
+            rating_rows = []
+            for post_id, created_at in post_times.items():
+                for _ in range(rng.randint(0, 2 * comments)):
+                    comment_rows.append(
+                        {
+                            "post": post_id,
+                            "author": rng.randint(1, users),
+                            "content": sentence(rng),
+                            "created_at": random_time(rng, after=created_at),
+                        }
+                    )
+                raters = rng.sample(range(1, users + 1), min(rng.randint(0, 2 * ratings), users))
+                for user_id in raters:
+                    rating_rows.append(
+                        {
+                            "post": post_id,
+                            "user": user_id,
+                            "rating": rng.randint(1, 5),
+                            "created_at": random_time(rng, after=created_at),
+                        }
+                    )
+            insert_all(Comment, comment_rows)
+            insert_all(Rating, rating_rows)
+
+            Rating.refresh_aggregates(list(post_times))
+            Comment.refresh_counts(list(post_times))
+            MonthlyPostCount.rebuild()
+            search.rebuild_index()
+
+        db.execute_sql("ANALYZE")
+        counts = {
+            model.__name__: model.select().count()
+            for model in (User, Category, Tag, Post, PostTag, Comment, Rating)
+        }
+    db.close_all()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("database", help="Path of the database to create.")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--posts", type=int, default=5000)
+    parser.add_argument("--categories", type=int, default=12)
+    parser.add_argument("--tags", type=int, default=300)
+    parser.add_argument("--comments", type=int, default=5, help="Average comments per post.")
+    parser.add_argument("--ratings", type=int, default=8, help="Average ratings per post.")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed.")
+    args = parser.parse_args()
+
+    if os.path.exists(args.database):
+        parser.error(f"{args.database} already exists")
+    started = time.perf_counter()
+    counts = seed(
+        args.database,
+        users=args.users,
+        posts=args.posts,
+        categories=args.categories,
+        tags=args.tags,
+        comments=args.comments,
+        ratings=args.ratings,
+        seed=args.seed,
+    )
+    print(", ".join(f"{count} {name}" for name, count in counts.items()))
+    print(f"Seeded {args.database} in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
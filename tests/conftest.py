@@ -0,0 +1,77 @@
+import os
+
+import pytest
+
+
+@pytest.fixture(scope="session")
+def app(tmp_path_factory):
+    """App on a fresh database in a temporary directory, shared by the tests."""
+    os.environ["DATABASE"] = str(tmp_path_factory.mktemp("db") / "test.db")
+    os.environ.setdefault("BCRYPT_LOG_ROUNDS", "4")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+    from app import create_app
+    from app.purge import purge_runner
+
+    app = create_app()
+    app.config["WTF_CSRF_ENABLED"] = False
+    app.config["TESTING"] = True
+    # Uploads go to a temporary folder too, not to app/static/uploads
+    app.config["UPLOAD_FOLDER"] = str(tmp_path_factory.mktemp("uploads"))
+    purge_runner.upload_folder = app.config["UPLOAD_FOLDER"]
+    return app
+
+
+@pytest.fixture()
+def client(app):
+    return app.test_client()
+
+
+def login(client, username, password="password123"):
+    """Register the user unless it exists, then log in."""
+    client.post(
+        "/register",
+        data={
+            "username": username,
+            "email": f"{username}@example.com",
+            "password": password,
+            "confirm_password": password,
+        },
+    )
+    return client.post("/login", data={"username": username, "password": password})
+
+
+@pytest.fixture(scope="session")
+def sample_posts(app):
+    """
+    A few posts by two authors, with tags, comments and ratings, created through
+    the routes so that the derived data (search index, counters) is filled in.
+    :return: Dict with the ids of the posts and of the authors.
+    """
+    from app.models import Post, User
+
+    clients = {name: app.test_client() for name in ("alice", "bob")}
+    for name, client in clients.items():
+        login(client, name)
+        for i in range(6):
+            client.post(
+                "/create_post",
+                data={
+                    "title": f"Widgets {name} {i}",
+                    "content": f"All about **frobnication** number {i}",
+                    "category": "new_category",
+                    "new_category": "Science",
+                    "tags": f"physics, tag{i}",
+                },
+            )
+
+    post_ids = [post.id for post in Post.select(Post.id).order_by(Post.id)]
+    for client in clients.values():
+        for post_id in post_ids[:4]:
+            client.post(f"/post/{post_id}/add_comment", data={"content": "Nice one"})
+            client.post(f"/rate_post/{post_id}", data={"rating": "4"})
+
+    return {
+        "post_ids": post_ids,
+        "user_ids": {user.username: user.id for user in User.select()},
+    }
@@ -0,0 +1,41 @@
+import pytest
+
+from conftest import login
+
+
+@pytest.mark.parametrize("page", ["/", "/post/{}"])
+def test_anonymous_revalidation_gets_not_modified(client, sample_posts, page):
+    url = page.format(sample_posts["post_ids"][1])
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.headers["Cache-Control"] == "no-cache"
+    etag = response.headers["ETag"]
+
+    revalidated = client.get(url, headers={"If-None-Match": etag})
+    assert revalidated.status_code == 304
+    assert revalidated.data == b""
+    assert revalidated.headers["ETag"] == etag
+
+
+def test_new_comment_changes_the_etag(app, client, sample_posts):
+    url = f"/post/{sample_posts['post_ids'][1]}"
+    etag = client.get(url).headers["ETag"]
+
+    writer = app.test_client()
+    login(writer, "alice")
+    writer.post(f"/post/{sample_posts['post_ids'][1]}/add_comment", data={"content": "Fresh"})
+
+    response = client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert b"Fresh" in client.get(f"{url}/comments").data
+
+
+def test_logged_in_users_bypass_the_cache(app, sample_posts):
+    client = app.test_client()
+    login(client, "alice")
+    url = f"/post/{sample_posts['post_ids'][1]}"
+    response = client.get(url)
+    assert response.status_code == 200
+    assert "ETag" not in response.headers
+    assert client.get(url, headers={"If-None-Match": '"anything"'}).status_code == 200
@@ -0,0 +1,37 @@
+import re
+
+from conftest import login
+
+
+def author_facet(html):
+    """Links of the author facet: dict of username -> (href, count)."""
+    section = html.split("Authors</h4>", 1)[1].split("</ul>", 1)[0]
+    return {
+        name: (href.replace("&amp;", "&"), int(count))
+        for href, name, count in re.findall(
+            r'<a href="([^"]+)"[^>]*>([^<]+)</a>\s*<span[^>]*>(\d+)</span>', section
+        )
+    }
+
+
+def test_author_facet_lists_as_many_posts_as_it_counts(app, sample_posts):
+    # "bob" is contained in "bobby", but the facet of bob selects bob's posts only
+    client = app.test_client()
+    login(client, "bobby")
+    client.post(
+        "/create_post",
+        data={
+            "title": "Widgets bobby",
+            "content": "All about frobnication",
+            "category": "new_category",
+            "new_category": "Science",
+            "tags": "physics",
+        },
+    )
+
+    facet = author_facet(client.get("/", query_string={"q": "frobnication"}).data.decode())
+    for name in ("bob", "bobby"):
+        href, count = facet[name]
+        listing = client.get(href).data
+        assert listing.count(b"Read More") == count
+        assert author_facet(listing.decode())[name][1] == count
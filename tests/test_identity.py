@@ -0,0 +1,20 @@
+from app import identity
+from app.models import User
+
+from conftest import login
+
+
+def test_change_made_by_another_worker_is_seen_at_once(app):
+    client = app.test_client()
+    login(client, "dave")
+    assert client.get("/create_post").status_code == 200  # The snapshot is cached
+
+    # Another server worker deactivates the user: it can't drop the snapshot cached
+    # by this process, but bumps the user's shared change stamp
+    user = User.get(User.username == "dave")
+    User.update(is_active=False, auth_version=User.auth_version + 1).where(User.id == user.id).execute()
+    identity.change_stamps.bump(user.id)
+
+    response = client.get("/create_post")
+    assert response.status_code == 302
+    assert "/login" in response.headers["Location"]
@@ -0,0 +1,118 @@
+import re
+
+import pytest
+
+from app.models import Post, User
+
+from conftest import login
+
+
+@pytest.fixture(scope="module")
+def paged_posts(app):
+    """
+    Nine posts by one author, four of them sharing the same creation time so that
+    only the post id orders them.
+    :return: (author id, post ids in feed order).
+    """
+    client = app.test_client()
+    login(client, "paula")
+    for i in range(9):
+        client.post(
+            "/create_post",
+            data={
+                "title": f"Paged {i}",
+                "content": f"Page filler {i}",
+                "category": "new_category",
+                "new_category": "Paging",
+                "tags": "paging",
+            },
+        )
+    author_id = User.get(User.username == "paula").id
+    post_ids = [
+        post.id for post in Post.select(Post.id).where(Post.author == author_id).order_by(Post.id)
+    ]
+    tied = Post.get_by_id(post_ids[2]).created_at
+    Post.update(created_at=tied).where(Post.id.in_(post_ids[2:6])).execute()
+
+    ordered = (
+        Post.select(Post.id)
+        .where(Post.author == author_id)
+        .order_by(Post.created_at.desc(), Post.id.desc())
+    )
+    return author_id, [post.id for post in ordered]
+
+
+def walk(client, author_id, cursor_param="after", cursor=None):
+    """Follow the API feed cursors of an author from a page; list of the pages' ids."""
+    pages = []
+    while True:
+        query = {"author_id": author_id, "limit": 4, "fields": "id"}
+        if cursor:
+            query[cursor_param] = cursor
+        body = client.get("/api/feed", query_string=query).get_json()
+        pages.append([post["id"] for post in body["posts"]])
+        cursor = body["next" if cursor_param == "after" else "prev"]
+        if cursor is None:
+            return pages, body
+
+
+def test_cursors_walk_every_post_once_in_order(client, paged_posts):
+    author_id, expected = paged_posts
+    pages, last = walk(client, author_id)
+    assert [len(page) for page in pages] == [4, 4, 1]
+    assert [post_id for page in pages for post_id in page] == expected
+
+    # Back from the last page to the first
+    back, _ = walk(client, author_id, "before", last["prev"])
+    assert back == pages[-2::-1]
+
+
+def test_homepage_next_links(app, monkeypatch, paged_posts):
+    author_id, expected = paged_posts
+    monkeypatch.setitem(app.config, "POSTS_PER_PAGE", 4)
+    client = app.test_client()
+
+    url, seen = f"/?author_id={author_id}", []
+    while url:
+        html = client.get(url).data.decode()
+        seen += [int(post_id) for post_id in re.findall(r'href="/post/(\d+)"', html)]
+        match = re.search(r'<a href="([^"]+)" class="btn btn-outline-primary">Next</a>', html)
+        url = match and match.group(1).replace("&amp;", "&")
+    assert list(dict.fromkeys(seen)) == expected
+
+
+def test_malformed_cursor_serves_the_first_page(client, paged_posts):
+    author_id, expected = paged_posts
+    body = client.get(
+        "/api/feed",
+        query_string={"author_id": author_id, "limit": 4, "fields": "id", "after": "not-a-cursor"},
+    ).get_json()
+    assert [post["id"] for post in body["posts"]] == expected[:4]
+
+
+def test_next_page_is_stable_when_a_post_is_added(app, paged_posts):
+    # Last, as the new post joins the author's feed
+    author_id, expected = paged_posts
+    client = app.test_client()
+    first = client.get(
+        "/api/feed", query_string={"author_id": author_id, "limit": 4, "fields": "id"}
+    ).get_json()
+
+    login(client, "paula")
+    created = client.post(
+        "/create_post",
+        data={
+            "title": "Late",
+            "content": "Late post",
+            "category": "new_category",
+            "new_category": "Paging",
+            "tags": "paging",
+        },
+    )
+    assert created.status_code == 302
+
+    second = client.get(
+        "/api/feed",
+        query_string={"author_id": author_id, "limit": 4, "fields": "id", "after": first["next"]},
+    ).get_json()
+    assert [post["id"] for post in second["posts"]] == expected[4:8]
@@ -0,0 +1,110 @@
+import time
+
+import pytest
+
+from app.models import FacetCount, Post, PurgeJob, Tag, User
+from app.purge import PurgeError, purge_runner
+
+from conftest import login
+
+
+def create_posts(client, title, count, tags):
+    for i in range(count):
+        client.post(
+            "/create_post",
+            data={
+                "title": f"{title} {i}",
+                "content": f"Doomed content {i}",
+                "category": "new_category",
+                "new_category": "Doomed",
+                "tags": tags,
+            },
+        )
+
+
+def run_job(job, timeout=10):
+    """Wait until the purge thread has finished a job, and return it."""
+    purge_runner.ensure_started()
+    deadline = time.monotonic() + timeout
+    while True:
+        job = PurgeJob.get_by_id(job.id)
+        if job.status not in ("pending", "running"):
+            return job
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.05)
+
+
+@pytest.fixture()
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(purge_runner, "chunk_rows", 2)
+    monkeypatch.setattr(purge_runner, "pause", 0)
+
+
+def test_user_purge_deletes_their_content_in_chunks(app, sample_posts, small_chunks):
+    other_post = sample_posts["post_ids"][0]
+    before = Post.get_by_id(other_post)
+
+    client = app.test_client()
+    login(client, "mallory")
+    create_posts(client, "Mallory", 3, "mallory")
+    mallory = User.get(User.username == "mallory")
+    own_post = Post.get(Post.author == mallory).id
+    for content in ("First", "Second"):
+        client.post(f"/post/{other_post}/add_comment", data={"content": content})
+    client.post(f"/rate_post/{other_post}", data={"rating": "1"})
+    commenter = app.test_client()
+    login(commenter, "alice")
+    commenter.post(f"/post/{own_post}/add_comment", data={"content": "Bye"})
+
+    chunks = purge_runner.stats()["chunks"]
+    job = purge_runner.request("user", "mallory", requested_by="admin")
+    # Logged out at once, before their content is deleted
+    assert "/login" in client.get("/create_post").headers["Location"]
+
+    job = run_job(job)
+    assert job.status == "done"
+    assert job.progress == 100
+    assert job.deleted == {
+        "comments": 3,
+        "ratings": 1,
+        "post_tags": 3,
+        "posts": 3,
+        "users": 1,
+    }
+    assert purge_runner.stats()["chunks"] - chunks > 3  # Several chunks of two rows
+
+    assert User.get_or_none(User.username == "mallory") is None
+    assert not Post.select().where(Post.author == mallory.id).exists()
+    after = Post.get_by_id(other_post)
+    assert (after.comment_count, after.rating_count, after.rating_sum) == (
+        before.comment_count,
+        before.rating_count,
+        before.rating_sum,
+    )
+    assert b"Read More" not in client.get("/?q=Mallory").data
+
+
+def test_tag_purge_deletes_the_tagged_posts(app, small_chunks):
+    client = app.test_client()
+    login(client, "tess")
+    create_posts(client, "Tagged", 3, "ephemeral")
+    tag = Tag.get(Tag.name == "ephemeral")
+
+    job = run_job(purge_runner.request("tag", "ephemeral"))
+    assert job.status == "done"
+    assert job.deleted["posts"] == 3
+    assert Tag.get_or_none(Tag.name == "ephemeral") is None
+    assert not FacetCount.select().where(
+        (FacetCount.facet == "tag") & (FacetCount.value == tag.id)
+    ).exists()
+    # The author stays
+    assert User.get(User.username == "tess").is_active
+
+
+def test_purge_requests_are_validated(app, sample_posts):
+    with pytest.raises(PurgeError):
+        purge_runner.request("user", "nobody")
+    with pytest.raises(PurgeError):
+        purge_runner.request("user", "alice", requested_by="alice")
+    with pytest.raises(PurgeError):
+        purge_runner.request("category", "Science")
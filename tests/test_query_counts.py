@@ -0,0 +1,63 @@
+import re
+
+import pytest
+
+from conftest import login
+
+
+def query_count(response):
+    """Number of SQL statements run by the request, from its Server-Timing header."""
+    match = re.search(r'sql;desc="(\d+) queries"', response.headers["Server-Timing"])
+    return int(match.group(1))
+
+
+@pytest.fixture()
+def reader(app, sample_posts):
+    """Logged-in client, so that the pages aren't served from the page cache."""
+    client = app.test_client()
+    login(client, "carol")
+    return client
+
+
+@pytest.mark.parametrize(
+    "url, shown",
+    [
+        ("/", 12),
+        ("/?q=frobnication", 12),
+        ("/?sort_by=popularity", 4),
+        ("/?sort_by=trending", 12),
+        ("/?category=Science&tags=physics", 12),
+    ],
+)
+def test_index(reader, url, shown):
+    # A page of posts with their authors, categories and tags
+    response = reader.get(url)
+    assert response.status_code == 200
+    assert response.data.count(b"Read More") == shown
+    assert query_count(response) <= 5
+
+
+@pytest.mark.parametrize("endpoint, most", [("post", 3), ("view_post", 4)])
+def test_post_pages(reader, sample_posts, endpoint, most):
+    # The same number of queries for a post with comments and ratings as for one without
+    commented, quiet = sample_posts["post_ids"][0], sample_posts["post_ids"][-1]
+    counts = []
+    for post_id in (commented, quiet):
+        response = reader.get(f"/{endpoint}/{post_id}")
+        assert response.status_code == 200
+        counts.append(query_count(response))
+    assert counts[0] == counts[1] <= most
+
+
+def test_user_profile(reader):
+    # Posts, ratings (with the rated posts) and their counts, whatever their number
+    from app.models import User
+
+    responses = [
+        reader.get(f"/user/{User.get(User.username == username).id}")
+        for username in ("alice", "carol")
+    ]
+    assert [response.status_code for response in responses] == [200, 200]
+    assert b"Total Ratings:</strong> 4" in responses[0].data
+    assert b"Total Posts:</strong> 6" in responses[0].data
+    assert query_count(responses[0]) == query_count(responses[1]) <= 4
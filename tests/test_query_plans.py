@@ -0,0 +1,14 @@
+from app.database import db
+from app.schema import explain, hot_queries
+
+
+def test_trending_feed_reads_the_score_index(sample_posts):
+    # Statistics of the post table but none of trendingscore, as on a database
+    # analyzed before the trending scores were added
+    db.execute_sql("ANALYZE post")
+    db.execute_sql("DELETE FROM sqlite_stat1 WHERE tbl = 'trendingscore'")
+    db.execute_sql("ANALYZE sqlite_schema")  # Reload the statistics
+
+    plan = explain(hot_queries()["index: trending"])
+    assert "USING COVERING INDEX trendingscore_score_post_id" in plan[0]
+    assert not any("TEMP B-TREE" in step for step in plan)
@@ -0,0 +1,32 @@
+import pytest
+
+
+@pytest.mark.parametrize("query", ["frobnic", ">widgets", "#physics", "@alice"])
+def test_search_finds_posts(client, sample_posts, query):
+    response = client.get("/", query_string={"q": query})
+    assert response.status_code == 200
+    assert b"Read More" in response.data
+
+
+@pytest.mark.parametrize("query", [">", ">  ", "   "])
+def test_search_without_words_lists_all_posts(client, sample_posts, query):
+    # No MATCH is applied, so the results must not be ordered by bm25
+    response = client.get("/", query_string={"q": query})
+    assert response.status_code == 200
+    assert b"Read More" in response.data
+
+    response = client.get("/api/feed", query_string={"q": query})
+    assert response.status_code == 200
+    assert response.get_json()["posts"]
+
+
+@pytest.mark.parametrize("query", ['"', '-:', '>"*', "a OR"])
+def test_search_with_punctuation_is_not_an_error(client, sample_posts, query):
+    assert client.get("/", query_string={"q": query}).status_code == 200
+    assert client.get("/api/feed", query_string={"q": query}).status_code == 200
+
+
+def test_old_search_url_redirects_to_the_homepage(client):
+    response = client.get("/search?q=physics&tags=a&tags=b")
+    assert response.status_code == 302
+    assert response.headers["Location"] == "/?q=physics&tags=a&tags=b"
@@ -0,0 +1,64 @@
+import io
+import os
+import time
+
+from PIL import Image
+
+from app.models import Post, StoredFile
+
+from conftest import login
+
+
+def png_bytes():
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 48), "teal").save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def wait_until(condition, timeout=10):
+    """Poll a condition set by a background thread or process."""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.05)
+
+
+def test_identical_uploads_are_stored_once_and_collected_with_the_last_post(app):
+    client = app.test_client()
+    login(client, "uma")
+    image = png_bytes()
+    post_ids = []
+    for i in range(2):
+        response = client.post(
+            "/create_post",
+            data={
+                "title": f"Picture {i}",
+                "content": "Same picture",
+                "category": "new_category",
+                "new_category": "Pictures",
+                "tags": "pictures",
+                "image": (io.BytesIO(image), f"upload-{i}.png"),
+            },
+            content_type="multipart/form-data",
+        )
+        post_ids.append(int(response.headers["Location"].rsplit("/", 1)[1]))
+
+    first, second = (Post.get_by_id(post_id) for post_id in post_ids)
+    assert first.image == second.image
+    path = os.path.join(app.config["UPLOAD_FOLDER"], first.image)
+    assert StoredFile.get_by_id(first.image).ref_count == 2
+    with open(path, "rb") as stored:
+        assert stored.read() == image
+    # Wait for the variants, so they aren't written after the file is deleted
+    wait_until(lambda: Post.get_by_id(post_ids[0]).image_variants is not None)
+
+    client.post(f"/delete_post/{post_ids[0]}")
+    assert StoredFile.get_by_id(first.image).ref_count == 1
+    assert os.path.exists(path)
+    assert StoredFile.reconcile_references() == []
+
+    client.post(f"/delete_post/{post_ids[1]}")
+    # The file is deleted by the purge thread, in the transaction dropping its row
+    wait_until(lambda: StoredFile.get_or_none(StoredFile.path == first.image) is None)
+    assert not os.path.exists(path)
+    assert not os.listdir(os.path.join(app.config["UPLOAD_FOLDER"], "objects"))
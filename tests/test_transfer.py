@@ -0,0 +1,89 @@
+import json
+import os
+import subprocess
+import sys
+
+from app import transfer
+from app.models import Comment, Post, PostTag, Rating, Tag, User
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Imports the export into a fresh database in another process, stopping after
+# `interrupt_after` lines, then imports it again, which resumes
+IMPORT_SCRIPT = """
+import itertools, json, sys
+from app import create_app
+from app import transfer
+from app.database import db
+from test_transfer import content_snapshot
+
+path, interrupt_after = sys.argv[1], int(sys.argv[2])
+create_app()
+
+
+def interrupted(lines):
+    yield from itertools.islice(lines, interrupt_after)
+    raise KeyboardInterrupt
+
+
+with db.connection_context():
+    with open(path, encoding="utf-8") as source:
+        try:
+            transfer.import_ndjson(interrupted(source), chunk_size=3)
+        except KeyboardInterrupt:
+            pass
+    with open(path, encoding="utf-8") as source:
+        counts = transfer.import_ndjson(source, chunk_size=3)
+    print(json.dumps({"counts": counts, "content": content_snapshot()}))
+"""
+
+
+def content_snapshot():
+    """The content of the database, without ids, as JSON-compatible lists."""
+    tags = {}
+    for post_id, name in PostTag.select(PostTag.post, Tag.name).join(Tag).tuples():
+        tags.setdefault(post_id, []).append(name)
+    posts = sorted(
+        [
+            post.title,
+            post.author.username,
+            post.category.name,
+            sorted(tags.get(post.id, [])),
+            post.comment_count,
+            post.rating_count,
+            post.rating_sum,
+            bool(post.content_html),
+        ]
+        for post in Post.select(Post, User).join(User)
+    )
+    users = sorted(user.username for user in User.select(User.username))
+    return {
+        "posts": posts,
+        "users": users,
+        "comments": Comment.select().count(),
+        "ratings": Rating.select().count(),
+    }
+
+
+def test_export_imports_into_an_empty_database_after_an_interruption(app, sample_posts, tmp_path):
+    path = tmp_path / "export.ndjson"
+    with open(path, "w", encoding="utf-8") as output:
+        output.writelines(transfer.export_ndjson())
+    expected = content_snapshot()
+
+    env = dict(os.environ, DATABASE=str(tmp_path / "imported.db"))
+    env["PYTHONPATH"] = os.pathsep.join([ROOT, os.path.join(ROOT, "tests")])
+    result = subprocess.run(
+        [sys.executable, "-c", IMPORT_SCRIPT, str(path), "20"],
+        cwd=ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+        timeout=120,
+    )
+    assert result.returncode == 0, result.stderr
+    imported = json.loads(result.stdout.splitlines()[-1])
+
+    # The second run skipped the lines committed by the first one
+    assert 0 < imported["counts"]["resumed"] <= 20
+    assert imported["content"] == expected
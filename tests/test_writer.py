@@ -0,0 +1,44 @@
+from app.models import Comment, Post, Rating, User
+from app.writer import WriteBehindQueue
+
+from conftest import login
+
+
+def test_burst_is_committed_in_one_batch_with_ratings_collapsed(app, sample_posts):
+    post_id = sample_posts["post_ids"][0]
+    client = app.test_client()
+    login(client, "wendy")
+    user_id = User.get(User.username == "wendy").id
+    before = Post.get_by_id(post_id)
+
+    # A long flush interval, so the whole burst joins the first transaction
+    queue = WriteBehindQueue(flush_interval=0.5)
+    flushed = []
+    queue.on_flush(lambda commented, rated: flushed.append((commented, rated)))
+    futures = [queue.rate(post_id, user_id, score) for score in (1, 5, 2)]
+    futures += [queue.add_comment(post_id, user_id, f"Burst {i}") for i in range(3)]
+    assert all(future.result(timeout=10) for future in futures)
+
+    assert queue.stats()["flushes"] == 1
+    assert flushed == [({post_id}, {post_id})]
+    # The latest rating wins, and only one row is written
+    assert [rating.rating for rating in Rating.select().where(Rating.user == user_id)] == [2]
+    assert Comment.select().where(Comment.author == user_id).count() == 3
+
+    after = Post.get_by_id(post_id)
+    assert after.rating_count == before.rating_count + 1
+    assert after.rating_sum == before.rating_sum + 2
+    assert after.comment_count == before.comment_count + 3
+
+
+def test_failing_write_only_fails_its_own_future(app, sample_posts):
+    post_id = sample_posts["post_ids"][1]
+    user_id = User.get(User.username == "alice").id
+    queue = WriteBehindQueue(flush_interval=0.5)
+
+    good = queue.add_comment(post_id, user_id, "Still written")
+    bad = queue.add_comment(post_id, user_id, None)  # Comment.content is NOT NULL
+    assert good.result(timeout=10)
+    assert bad.exception(timeout=10) is not None
+    assert queue.stats()["failed"] == 1
+    assert Comment.select().where(Comment.content == "Still written").exists()